@@ -0,0 +1,266 @@
+"""
+Array-backed experience replay, uniform or prioritized.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+
+# Observation fields stored with a smaller type than the environment gives them
+COMPACT_DTYPES = {"map": np.uint8}  # tiles are 0 to 4
+# Observation fields that are stacks of frames when the buffer has frames > 1
+STACKED_FIELDS = ("map",)
+
+
+class SumTree:
+    """
+    Binary tree where each parent holds the sum of its children.
+
+    Leaves are the priorities of the buffer rows, so sampling proportionally
+    to priority and updating a priority both cost O(log n).
+    """
+
+    def __init__(self, capacity):
+        self.leaves = 1 << max(0, int(capacity - 1).bit_length())
+        self.tree = np.zeros(2 * self.leaves, dtype=np.float64)  # root at index 1
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def update(self, indices, priorities):
+        """Set the priority of rows, vectorized over a batch."""
+        nodes = np.asarray(indices) + self.leaves
+        self.tree[nodes] = priorities
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.tree[2 * nodes] + self.tree[2 * nodes + 1]
+
+    def get(self, indices):
+        return self.tree[np.asarray(indices) + self.leaves]
+
+    def find(self, values):
+        """Rows whose cumulative priority range contains each value."""
+        nodes = np.ones(len(values), dtype=np.int64)
+        values = np.array(values, dtype=np.float64)
+        while nodes[0] < self.leaves:
+            left = 2 * nodes
+            go_right = values > self.tree[left]
+            values -= np.where(go_right, self.tree[left], 0.0)
+            nodes = left + go_right
+        return nodes - self.leaves
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of transitions made of preallocated NumPy arrays.
+
+    Every observation is stored once: row i holds an observation, the action
+    taken there and what followed, and next_rows[i] is the row of its next
+    observation. A transition starting from the next time step of an earlier
+    one (the same object) shares its row, so a buffer of n transitions holds
+    about n observations instead of 2n, also when several environments
+    interleave their steps.
+
+    With frames > 1 the maps are stacks of the last frames (see
+    observations.FrameStack). A row then keeps only the newest frame and the
+    row of the frame before it, the stacks being rebuilt when sampled, so
+    stacking k frames does not take k times the memory.
+    """
+
+    def __init__(self, capacity, prioritized=False, alpha=0.6, beta=0.4,
+                 beta_steps=100_000, epsilon=1e-3, dtypes=None, seed=None,
+                 frames=1, max_chains=256):
+        """
+        Initialize the buffer.
+
+        Args:
+            capacity: Maximum number of rows (observations) kept
+            prioritized: Sample proportionally to the TD error instead of uniformly
+            alpha: How much the priorities count, 0 is uniform
+            beta: Initial importance sampling exponent, annealed to 1
+            beta_steps: Number of samples over which beta reaches 1
+            epsilon: Added to the TD errors so every transition can still be sampled
+            dtypes: Storage type of observation fields, defaults to COMPACT_DTYPES
+            seed: Seed of the sampling generator
+            frames: Number of frames in the stacked fields (STACKED_FIELDS)
+            max_chains: Next time steps remembered for transitions to share their
+                row, at least one per environment feeding the buffer
+        """
+        self.capacity = capacity
+        self.prioritized = prioritized
+        self.alpha = alpha
+        self.beta = beta
+        self._beta_increment = (1.0 - beta) / max(1, beta_steps)
+        self.epsilon = epsilon
+        self.dtypes = COMPACT_DTYPES if dtypes is None else dtypes
+        self.rng = np.random.default_rng(seed)
+        self.frames = frames
+        self.max_chains = max_chains
+
+        self.observations = None  # field name -> (capacity, *shape) array, allocated on first add
+        self.actions = np.zeros(capacity, dtype=np.int32)
+        self.rewards = np.zeros(capacity, dtype=np.float32)
+        self.dones = np.zeros(capacity, dtype=bool)
+        self.has_next = np.zeros(capacity, dtype=bool)  # row i starts a stored transition
+        self.next_rows = np.zeros(capacity, dtype=np.int64)
+        self.previous_rows = np.full(capacity, -1, dtype=np.int64)  # row of the frame before, -1 if none
+        self.serials = np.full(capacity, -1, dtype=np.int64)  # number of the write that filled each row
+
+        self._cursor = 0
+        self._rows = 0
+        self._writes = 0
+        self._transitions = 0
+        self._chains = {}  # id(next time step) -> (next time step, its row, serial of the row)
+        self._channels = {}  # stacked field -> channels of one frame
+
+        self._tree = SumTree(capacity) if prioritized else None
+        self._max_priority = 1.0
+
+    def __len__(self):
+        """Number of transitions that can be sampled."""
+        return self._transitions
+
+    def _allocate(self, observation):
+        self.observations = {}
+        for key, value in observation.items():
+            value = np.asarray(value)
+            dtype = self.dtypes.get(key, value.dtype)
+            shape = value.shape
+            if self.frames > 1 and key in STACKED_FIELDS:
+                self._channels[key] = shape[-1] // self.frames
+                shape = (*shape[:-1], self._channels[key])
+            self.observations[key] = np.zeros((self.capacity, *shape), dtype=dtype)
+
+    def _invalidate(self, row):
+        if self.has_next[row]:
+            self.has_next[row] = False
+            self._transitions -= 1
+            if self._tree is not None:
+                self._tree.update([row], [0.0])
+
+    def _write(self, observation, previous_row=-1, frame=None):
+        """
+        Store an observation in the next row, dropping the transition of the old one.
+
+        Rows are overwritten oldest first and a transition's next row is newer
+        than its own, so a transition always goes before its next observation.
+
+        Args:
+            observation: Observation to store
+            previous_row: Row of the frame before this one, for the stacked fields
+            frame: Frame of the stacked fields to store, by default the newest
+        """
+        if self.observations is None:
+            self._allocate(observation)
+
+        row = self._cursor
+        self._invalidate(row)
+        frame = self.frames - 1 if frame is None else frame
+        for key, column in self.observations.items():
+            if key in self._channels:
+                channels = self._channels[key]
+                column[row] = np.asarray(observation[key])[..., frame * channels:(frame + 1) * channels]
+            else:
+                column[row] = observation[key]
+        self.previous_rows[row] = previous_row
+        self.serials[row] = self._writes
+
+        self._writes += 1
+        self._cursor = (row + 1) % self.capacity
+        self._rows = min(self._rows + 1, self.capacity)
+        return row
+
+    def _write_first(self, time_step):
+        """Store the time step a transition starts from when it is not chained on an earlier one."""
+        previous_row = -1
+        if self._channels and not time_step.is_first():
+            # the older frames of the stack come first, as rows with no transition
+            for frame in range(self.frames - 1):
+                previous_row = self._write(time_step.observation, previous_row, frame)
+        return self._write(time_step.observation, previous_row)
+
+    def add(self, time_step, action, next_time_step):
+        """Store a transition, sharing the row of time_step when it chains on an earlier one."""
+        chain = self._chains.pop(id(time_step), None)
+        if chain is not None and chain[0] is time_step and self.serials[chain[1]] == chain[2]:
+            row = chain[1]
+        else:
+            row = self._write_first(time_step)
+        next_row = self._write(next_time_step.observation, row)
+
+        self.actions[row] = action
+        self.rewards[row] = float(np.asarray(next_time_step.reward))
+        self.dones[row] = bool(next_time_step.is_last())
+        self.next_rows[row] = next_row
+        self.has_next[row] = True
+        self._transitions += 1
+        if self._tree is not None:
+            self._tree.update([row], [self._max_priority ** self.alpha])
+
+        if not next_time_step.is_last():
+            self._chains[id(next_time_step)] = (next_time_step, next_row, self.serials[next_row])
+            if len(self._chains) > self.max_chains:
+                del self._chains[next(iter(self._chains))]  # the oldest
+
+    def _gather(self, rows):
+        batch = {key: column[rows] for key, column in self.observations.items() if key not in self._channels}
+        if self._channels:
+            # rows of each frame, newest first, the oldest one known standing in for the missing ones
+            frame_rows = [rows]
+            for _ in range(self.frames - 1):
+                current = frame_rows[-1]
+                previous = self.previous_rows[current]
+                # a row overwritten since it was linked is newer than the row after it
+                linked = (previous >= 0) & (self.serials[previous] < self.serials[current])
+                frame_rows.append(np.where(linked, previous, current))
+            for key in self._channels:
+                column = self.observations[key]
+                batch[key] = np.concatenate([column[r] for r in reversed(frame_rows)], axis=-1)
+        return batch
+
+    def sample(self, batch_size):
+        """
+        Sample a batch of transitions.
+
+        Returns:
+            Dictionary with observations and next_observations (dictionaries of
+            batched fields), actions, rewards, dones, the sampled indices (to
+            update their priorities) and importance sampling weights
+        """
+        if self._tree is None:
+            rows = self.rng.choice(np.flatnonzero(self.has_next), size=batch_size)
+            weights = np.ones(batch_size, dtype=np.float32)
+        else:
+            # one value in each of batch_size equal segments of the total priority
+            segment = self._tree.total / batch_size
+            values = (np.arange(batch_size) + self.rng.random(batch_size)) * segment
+            rows = np.minimum(self._tree.find(values), self.capacity - 1)
+            # rounding can land on an empty leaf next to a segment boundary
+            stray = ~self.has_next[rows]
+            if stray.any():
+                rows[stray] = self.rng.choice(np.flatnonzero(self.has_next), size=stray.sum())
+
+            probabilities = self._tree.get(rows) / self._tree.total
+            weights = (len(self) * probabilities) ** -self.beta
+            weights = (weights / weights.max()).astype(np.float32)
+            self.beta = min(1.0, self.beta + self._beta_increment)
+
+        next_rows = self.next_rows[rows]
+        return {
+            "observations": self._gather(rows),
+            "actions": self.actions[rows],
+            "rewards": self.rewards[rows],
+            "next_observations": self._gather(next_rows),
+            "dones": self.dones[rows],
+            "indices": rows,
+            "weights": weights,
+        }
+
+    def update_priorities(self, indices, td_errors):
+        """Set the priorities of sampled transitions from their new TD errors."""
+        if self._tree is None:
+            return
+        priorities = np.abs(np.asarray(td_errors, dtype=np.float64)) + self.epsilon
+        self._max_priority = max(self._max_priority, priorities.max())
+        # a row may have been overwritten since it was sampled
+        priorities = np.where(self.has_next[indices], priorities ** self.alpha, 0.0)
+        self._tree.update(indices, priorities)
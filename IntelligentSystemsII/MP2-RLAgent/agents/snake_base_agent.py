@@ -4,6 +4,9 @@ Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
 """
 from abc import ABC, abstractmethod
 
+import numpy as np
+import tensorflow as tf
+
 
 class SnakeBaseAgent(ABC):
     """
@@ -45,6 +48,32 @@ class SnakeBaseAgent(ABC):
         """
         pass
 
+    def get_actions(self, time_step, use_exploration_policy=True):
+        """
+        Get one action per environment of a batched time step.
+
+        Agents override this to pick every action with a single forward pass,
+        the default asks get_action() for each environment in turn.
+
+        Args:
+            time_step: Batched time step, see batched_snake_env.py
+            use_exploration_policy: Whether to use the exploration policy or the evaluation policy
+
+        Returns:
+            Array of actions (0-3)
+        """
+        batch_size = len(time_step.step_type)
+        return np.array(
+            [
+                self.get_action(
+                    tf.nest.map_structure(lambda value, i=i: value[i], time_step),
+                    use_exploration_policy,
+                )
+                for i in range(batch_size)
+            ],
+            dtype=np.int32,
+        )
+
     @abstractmethod
     def store_experience(self, state, action, next_state):
         """
@@ -54,9 +83,44 @@ class SnakeBaseAgent(ABC):
             state: Current time step
             action: Action taken
             next_state: Next time step
+
+        Returns:
+            Whether the experience was stored
         """
         pass
 
+    def store_experiences(self, states, actions, next_states):
+        """
+        Store one step of a batched environment.
+
+        Args:
+            states: Time step of each environment before the step
+            actions: Action taken in each environment
+            next_states: Time step of each environment after the step
+        """
+        for state, action, next_state in zip(states, actions, next_states):
+            if not state.is_last():  # otherwise the environment was reset, not stepped
+                self.store_experience(state, int(action), next_state)
+
+    def prefill(self, dataset, limit=None):
+        """
+        Store transitions recorded offline, see dataset_builder.py.
+
+        Args:
+            dataset: ShardDataset to read from, recorded with the observation
+                options of the agent's environment
+            limit: Maximum number of transitions, the most recent ones are kept
+
+        Returns:
+            Number of transitions stored
+        """
+        dataset.check(self.env)
+        stored = 0
+        for time_step, action, next_time_step in dataset.time_steps(limit):
+            if self.store_experience(time_step, action, next_time_step):
+                stored += 1
+        return stored
+
     @abstractmethod
     def train_step(self):
         """
@@ -94,6 +158,26 @@ class SnakeBaseAgent(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_weights(self):
+        """
+        Get the parameters an acting copy of the agent needs, see distributed.py.
+
+        Returns:
+            List of NumPy arrays
+        """
+        pass
+
+    @abstractmethod
+    def set_weights(self, weights):
+        """
+        Load parameters returned by get_weights() of another copy of the agent.
+
+        Args:
+            weights: List of NumPy arrays
+        """
+        pass
+
     @abstractmethod
     def save(self, filepath):
         """Save the trained model.
@@ -1,18 +1,21 @@
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
-from collections import deque
-import random
 import json
+import logging
 import os
+from agents.replay_buffer import ReplayBuffer
 from agents.snake_base_agent import SnakeBaseAgent
 
+logger = logging.getLogger("DQNAgent")
+
 
 class DQNAgent(SnakeBaseAgent):
     """Deep Q-Network agent for Snake game with dynamic observation handling."""
     
     def __init__(self, env, learning_rate=0.0005, epsilon=0.95, epsilon_decay=0.9995, 
-                 epsilon_min=0.05, memory_size=50000, batch_size=64, target_update_freq=500):
+                 epsilon_min=0.05, memory_size=50000, batch_size=64, target_update_freq=500,
+                 prioritized_replay=False, priority_alpha=0.6, priority_beta=0.4):
         """Initialize the DQN agent with improved hyperparameters."""
         super().__init__(env)
 
@@ -24,14 +27,18 @@ class DQNAgent(SnakeBaseAgent):
         self.memory_size = memory_size
         self.batch_size = batch_size
         self.target_update_freq = target_update_freq
+        self.prioritized_replay = prioritized_replay
         
-        # Experience replay buffer
-        self.memory = deque(maxlen=memory_size)
+        # Experience replay buffer, storing each frame of stacked maps once
+        self.memory = ReplayBuffer(memory_size, prioritized=prioritized_replay,
+                                   alpha=priority_alpha, beta=priority_beta,
+                                   frames=getattr(env, 'frames', 1))
         
         # Networks - will be initialized on first state
         self.q_network = None
         self.target_network = None
         self.optimizer = None
+        self._train_function = None
         
         # Current network input shape (will be set dynamically)
         self.current_map_shape = None
@@ -48,7 +55,7 @@ class DQNAgent(SnakeBaseAgent):
         # Set action size - assuming 4 actions for snake (up, down, left, right)
         self.action_size = 4
         
-    def _create_network(self, map_shape):
+    def _create_network(self, map_shape, moves_shape=None):
         """Create a simpler but more effective neural network architecture."""
         # Input layers for each observation component
         map_input = keras.layers.Input(shape=map_shape, name='map_input')
@@ -58,7 +65,13 @@ class DQNAgent(SnakeBaseAgent):
         timeout_input = keras.layers.Input(shape=(), name='timeout_input')
         
         # Process map with simplified CNN
-        map_expanded = keras.layers.Reshape((*map_shape, 1))(map_input)
+        # the full map has one channel of tile codes, other maps have their own channels,
+        # scaled to [0, 1] as some count steps
+        if len(map_shape) == 3:
+            maximum = np.broadcast_to(self.env.observation_spec()['map'].maximum, map_shape)[0, 0]
+            map_expanded = keras.layers.Rescaling((1.0 / maximum.astype(np.float32)).tolist())(map_input)
+        else:
+            map_expanded = keras.layers.Reshape((*map_shape, 1))(map_input)
         
         # Simpler CNN architecture
         conv1 = keras.layers.Conv2D(16, (3, 3), activation='relu', padding='same')(map_expanded)
@@ -85,17 +98,19 @@ class DQNAgent(SnakeBaseAgent):
         direction_flat = keras.layers.Flatten()(direction_embedded)
         
         # Simpler timeout processing
-        timeout_normalized = keras.layers.Lambda(lambda x: tf.cast(x, tf.float32) / 1000.0)(timeout_input)
+        timeout_normalized = keras.layers.Rescaling(1.0 / 1000.0)(timeout_input)  # no Lambda, for policy_export.py
         timeout_reshaped = keras.layers.Reshape((1,))(timeout_normalized)
         
+        inputs = [map_input, traverse_input, range_input, direction_input, timeout_input]
+        features = [map_features, traverse_flat, range_flat, direction_flat, timeout_reshaped]
+        # Area and food distance of each move, already in [0, 1]
+        if moves_shape is not None:
+            moves_input = keras.layers.Input(shape=moves_shape, name='moves_input')
+            inputs.append(moves_input)
+            features.append(keras.layers.Flatten()(moves_input))
+
         # Combine features
-        combined = keras.layers.Concatenate()([
-            map_features,
-            traverse_flat,
-            range_flat,
-            direction_flat,
-            timeout_reshaped
-        ])
+        combined = keras.layers.Concatenate()(features)
         
         # Simplified dense layers
         dense1 = keras.layers.Dense(256, activation='relu')(combined)
@@ -110,23 +125,21 @@ class DQNAgent(SnakeBaseAgent):
         q_values = keras.layers.Dense(self.action_size, activation='linear', name='q_values')(dense3)
         
         # Create model
-        model = keras.Model(
-            inputs=[map_input, traverse_input, range_input, direction_input, timeout_input],
-            outputs=q_values
-        )
+        model = keras.Model(inputs=inputs, outputs=q_values)
         
         return model
     
     def _initialize_networks(self, observation):
         """Initialize networks based on first observation."""
         map_shape = observation['map'].shape
+        moves_shape = observation['moves'].shape if 'moves' in observation else None
         self.current_map_shape = map_shape
         
-        print(f"Initializing networks with map shape: {map_shape}")
+        logger.info(f"Initializing networks with map shape: {map_shape}")
         
         # Create main and target networks
-        self.q_network = self._create_network(map_shape)
-        self.target_network = self._create_network(map_shape)
+        self.q_network = self._create_network(map_shape, moves_shape)
+        self.target_network = self._create_network(map_shape, moves_shape)
         
         # Use a more conservative optimizer
         self.optimizer = keras.optimizers.Adam(
@@ -136,20 +149,26 @@ class DQNAgent(SnakeBaseAgent):
         
         # Copy weights to target network
         self.target_network.set_weights(self.q_network.get_weights())
+
+        # Compiled update, traced again for the new networks on the next train_step
+        self._train_function = None
         
-        print("Networks initialized successfully")
-        print(f"Network summary:")
-        self.q_network.summary()
+        logger.info("Networks initialized successfully")
+        logger.info("Network summary:")
+        self.q_network.summary(print_fn=logger.info)
     
     def _preprocess_observation(self, observation):
         """Preprocess observation for network input."""
-        return [
+        inputs = [
             np.expand_dims(observation['map'].astype(np.float32), axis=0),
             np.expand_dims(observation['traverse'], axis=0),
             np.expand_dims(np.clip(observation['range'], 0, 10), axis=0),  # Clip range
             np.expand_dims(observation['direction'], axis=0),
             np.expand_dims(observation['timeout'].astype(np.float32), axis=0)
         ]
+        if 'moves' in observation:
+            inputs.append(np.expand_dims(observation['moves'], axis=0))
+        return inputs
     
     def get_action(self, time_step, use_exploration_policy=True):
         """Get action using epsilon-greedy policy with improved exploration."""
@@ -177,11 +196,26 @@ class DQNAgent(SnakeBaseAgent):
             print(f"Error in get_action: {e}")
             return np.random.randint(0, self.action_size)
     
+    def get_actions(self, time_step, use_exploration_policy=True):
+        """Epsilon-greedy actions for a batched time step, with one forward pass."""
+        observation = time_step.observation
+        map_shape = observation['map'].shape[1:]
+        if self.q_network is None or map_shape != self.current_map_shape:
+            self._initialize_networks({key: value[0] for key, value in observation.items()})
+
+        q_values = self.q_network(self._prepare_batch_inputs(observation), training=False)
+        actions = np.argmax(q_values, axis=1).astype(np.int32)
+
+        if use_exploration_policy:
+            explore = np.random.random(len(actions)) <= self.epsilon
+            actions[explore] = np.random.randint(0, self.action_size, explore.sum())
+        return actions
+
     def store_experience(self, state, action, next_state):
         """Store experience in replay buffer with validation."""
-        # Only store if networks are initialized and shapes match
+        # Experience can arrive before the first action, e.g. when prefilling
         if self.q_network is None:
-            return
+            self._initialize_networks(state.observation)
             
         # Validate state shapes
         current_shape = state.observation['map'].shape
@@ -189,93 +223,46 @@ class DQNAgent(SnakeBaseAgent):
         
         if (current_shape != self.current_map_shape or 
             next_shape != self.current_map_shape):
-            return  # Skip storing if shapes don't match
+            return False  # Skip storing if shapes don't match
         
         # Validate action
         if not (0 <= action <= 3):
-            return
+            return False
             
-        self.memory.append((state, action, next_state))
+        self.memory.add(state, action, next_state)
+        return True
     
+    def prefill(self, dataset, limit=None):
+        """Fill the replay memory from an offline dataset, at most memory_size transitions."""
+        return super().prefill(dataset, limit if limit is not None else self.memory_size)
+
     def train_step(self):
         """Improved training step with better stability."""
         if (len(self.memory) < max(self.batch_size, self.warmup_steps) or 
             self.q_network is None):
             return None
         
-        # Sample batch
-        try:
-            batch = random.sample(self.memory, self.batch_size)
-        except ValueError:
-            return None
-        
-        # Process batch
-        states = []
-        actions = []
-        rewards = []
-        next_states = []
-        dones = []
-        
-        for state, action, next_state in batch:
-            # Validate shapes
-            if (state.observation['map'].shape != self.current_map_shape or
-                next_state.observation['map'].shape != self.current_map_shape):
-                continue
-                
-            states.append(state.observation)
-            actions.append(action)
-            
-            # Handle reward properly
-            reward = next_state.reward
-            if hasattr(reward, 'numpy'):
-                reward_value = float(reward.numpy())
-            elif isinstance(reward, np.ndarray):
-                reward_value = float(reward.item() if reward.size == 1 else reward.mean())
-            else:
-                reward_value = float(reward)
-            
-            # Clip extreme rewards for stability
-            reward_value = np.clip(reward_value, -100, 100)
-            rewards.append(reward_value)
-            
-            next_states.append(next_state.observation)
-            dones.append(next_state.is_last())
-        
-        if len(states) < self.batch_size // 2:  # Need minimum samples
-            return None
+        batch = self.memory.sample(self.batch_size)
+        actions = batch['actions']
+        rewards = np.clip(batch['rewards'], -100, 100)  # Clip extreme rewards for stability
+        dones = batch['dones']
         
         try:
             # Prepare batch inputs
-            current_inputs = self._prepare_batch_inputs(states)
-            next_inputs = self._prepare_batch_inputs(next_states)
-            
-            # Get Q-values
-            current_q_values = self.q_network(current_inputs, training=False)
-            next_q_values = self.target_network(next_inputs, training=False)
+            current_inputs = self._prepare_batch_inputs(batch['observations'])
+            next_inputs = self._prepare_batch_inputs(batch['next_observations'])
             
-            # Compute targets using Double DQN
-            next_actions = tf.argmax(self.q_network(next_inputs, training=False), axis=1)
-            next_q_values_selected = tf.reduce_sum(
-                next_q_values * tf.one_hot(next_actions, self.action_size), axis=1
+            if self._train_function is None:
+                self._train_function = tf.function(self._double_dqn_update, reduce_retracing=True)
+            loss, td_errors = self._train_function(
+                current_inputs,
+                next_inputs,
+                actions.astype(np.int32),
+                rewards.astype(np.float32),
+                dones.astype(np.float32),
+                batch['weights'],
             )
-            
-            # Compute target Q-values
-            targets = current_q_values.numpy()
-            for i in range(len(states)):
-                if dones[i]:
-                    targets[i][actions[i]] = rewards[i]
-                else:
-                    targets[i][actions[i]] = rewards[i] + 0.99 * next_q_values_selected[i]
-            
-            # Train network
-            with tf.GradientTape() as tape:
-                q_values = self.q_network(current_inputs, training=True)
-                loss = keras.losses.Huber()(targets, q_values)  # Use Huber loss for stability
-            
-            gradients = tape.gradient(loss, self.q_network.trainable_variables)
-            # Clip gradients
-            gradients = [tf.clip_by_norm(g, 1.0) for g in gradients]
-            self.optimizer.apply_gradients(zip(gradients, self.q_network.trainable_variables))
+            self.memory.update_priorities(batch['indices'], td_errors.numpy())
             
             # Update target network
             self.step_count += 1
@@ -287,7 +274,7 @@ class DQNAgent(SnakeBaseAgent):
             if self.epsilon > self.epsilon_min:
                 self.epsilon = max(self.epsilon_min, self.epsilon * self.epsilon_decay)
             
-            loss_value = tf.reduce_mean(loss).numpy()
+            loss_value = loss.numpy()
             self.training_losses.append(loss_value)
             
             return loss_value
@@ -296,15 +283,43 @@ class DQNAgent(SnakeBaseAgent):
             print(f"Error in training step: {e}")
             return None
     
+    def _double_dqn_update(self, inputs, next_inputs, actions, rewards, dones, weights):
+        """One Double DQN update on a batch, compiled with tf.function by train_step."""
+        # Double DQN: the online network picks the next action, the target network values it
+        next_actions = tf.argmax(self.q_network(next_inputs, training=False), axis=1, output_type=tf.int32)
+        next_q_values = self.target_network(next_inputs, training=False)
+        batch_rows = tf.range(tf.shape(actions)[0])
+        next_values = tf.gather_nd(next_q_values, tf.stack([batch_rows, next_actions], axis=1))
+        target_values = rewards + 0.99 * next_values * (1.0 - dones)
+
+        taken = tf.stack([batch_rows, actions], axis=1)
+        with tf.GradientTape() as tape:
+            q_values = self.q_network(inputs, training=True)
+            # Only the taken actions get a new target, the others keep their own value
+            targets = tf.tensor_scatter_nd_update(tf.stop_gradient(q_values), taken, target_values)
+            # Huber loss for stability, each sample weighted by its importance sampling weight
+            sample_losses = keras.losses.Huber(reduction='none')(targets, q_values)
+            loss = tf.reduce_mean(sample_losses * weights)
+
+        gradients = tape.gradient(loss, self.q_network.trainable_variables)
+        gradients, _ = tf.clip_by_global_norm(gradients, 1.0)
+        self.optimizer.apply_gradients(zip(gradients, self.q_network.trainable_variables))
+
+        td_errors = target_values - tf.gather_nd(q_values, taken)
+        return loss, td_errors
+
     def _prepare_batch_inputs(self, observations):
-        """Prepare batch inputs for the network."""
-        return [
-            np.array([obs['map'].astype(np.float32) for obs in observations]),
-            np.array([obs['traverse'] for obs in observations]),
-            np.array([np.clip(obs['range'], 0, 10) for obs in observations]),
-            np.array([obs['direction'] for obs in observations]),
-            np.array([obs['timeout'].astype(np.float32) for obs in observations])
+        """Prepare batch inputs for the network from batched observation fields."""
+        inputs = [
+            observations['map'].astype(np.float32),
+            observations['traverse'],
+            np.clip(observations['range'], 0, 10),
+            observations['direction'],
+            observations['timeout'].astype(np.float32)
         ]
+        if 'moves' in observations:
+            inputs.append(observations['moves'])
+        return inputs
     
     def on_episode_end(self):
         """Called at the end of each episode."""
@@ -383,6 +398,24 @@ class DQNAgent(SnakeBaseAgent):
             stats['max_score'] = max(self.scores)
         
         return stats
+
+    def _ensure_networks(self):
+        """Build the networks from the observation spec if no observation was seen yet."""
+        if self.q_network is None:
+            self._initialize_networks({
+                key: np.zeros(spec.shape, dtype=spec.dtype)
+                for key, spec in self.env.observation_spec().items()
+            })
+
+    def get_weights(self):
+        """Weights of the online network."""
+        self._ensure_networks()
+        return self.q_network.get_weights()
+
+    def set_weights(self, weights):
+        """Load the online network, the target network is left to train_step."""
+        self._ensure_networks()
+        self.q_network.set_weights(weights)
     
     def save(self, filepath):
         """Save the trained model."""
@@ -406,6 +439,7 @@ class DQNAgent(SnakeBaseAgent):
                 'memory_size': self.memory_size,
                 'batch_size': self.batch_size,
                 'target_update_freq': self.target_update_freq,
+                'prioritized_replay': self.prioritized_replay,
                 'current_map_shape': self.current_map_shape,
                 'episode_count': self.episode_count,
                 'step_count': self.step_count
@@ -448,6 +482,9 @@ class DQNAgent(SnakeBaseAgent):
                     'direction': 0,
                     'timeout': 1000
                 }
+                moves_spec = self.env.observation_spec().get('moves')
+                if moves_spec is not None:
+                    dummy_obs['moves'] = np.zeros(moves_spec.shape, dtype=moves_spec.dtype)
                 self._initialize_networks(dummy_obs)
                 
                 # Load weights
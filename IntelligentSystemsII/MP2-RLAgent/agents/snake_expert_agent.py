@@ -0,0 +1,113 @@
+"""
+Search-based expert agent, for demonstrations to pre-train the learning agents.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+
+from agents.snake_base_agent import SnakeBaseAgent
+from planner import SnakePlanner
+
+
+class ExpertAgent(SnakeBaseAgent):
+    """
+    Plays with a SnakePlanner instead of a network, and learns nothing.
+
+    The planner of each environment follows the game through the environment
+    itself: the game info when an episode starts, then the body, traverse flag
+    and sight of the observation just built. Its episodes, recorded with
+    batched_snake_env.py --dataset or DATASET, pre-fill the DQN replay memory
+    or behaviour-clone the PPO actor (see PREFILL).
+    """
+
+    def __init__(self, env, epsilon=0.0):
+        """
+        Initialize the agent.
+
+        Args:
+            env: SnakeTrainEnv, or BatchedSnakeEnv for one planner per game
+            epsilon: Chance of a random action with the exploration policy, for
+                demonstrations that also show the mistakes
+        """
+        super().__init__(env)
+        self.epsilon = epsilon
+        self.envs = getattr(env, "envs", [env])
+        self.planners = [None] * len(self.envs)
+
+    def _plan(self, index, step_type):
+        if step_type == 2:  # StepType.LAST, the game is over
+            return 0
+        env = self.envs[index]
+        state = env.get_state()
+        planner = self.planners[index]
+        if planner is None or planner.world.map_size != tuple(env.observer.size):
+            planner = self.planners[index] = SnakePlanner(env.observer.size)
+        if step_type == 0:  # StepType.FIRST
+            planner.reset(state.get("map") or [])
+            return 0  # the game info has no body yet
+        return planner.plan(state.get("body", []), env.observer.builder.sight, state.get("traverse", False))
+
+    def get_action(self, time_step, use_exploration_policy=True):
+        action = self._plan(0, int(time_step.step_type))  # the planner follows every step
+        if use_exploration_policy and np.random.random() < self.epsilon:
+            return np.random.randint(0, self.action_size)
+        return action
+
+    def get_actions(self, time_step, use_exploration_policy=True):
+        """Planned action of every game of a batched time step."""
+        actions = np.array(
+            [self._plan(i, int(step_type)) for i, step_type in enumerate(time_step.step_type)],
+            dtype=np.int32,
+        )
+        if use_exploration_policy:
+            explore = np.random.random(len(actions)) < self.epsilon
+            actions[explore] = np.random.randint(0, self.action_size, explore.sum())
+        return actions
+
+    def store_experience(self, state, action, next_state):
+        self.step_count += 1
+        return False  # nothing to learn
+
+    def store_experiences(self, states, actions, next_states):
+        self.step_count += len(actions)
+
+    def prefill(self, dataset, limit=None):
+        return 0  # nothing to learn
+
+    def train_step(self):
+        return None
+
+    def on_episode_end(self):
+        self.episode_count += 1
+
+    def evaluate(self, num_episodes=5):
+        """Average reward of the planned actions over episodes of the environment."""
+        total_reward = 0.0
+        for _ in range(num_episodes):
+            time_step = self.env.reset()
+            while not time_step.is_last():
+                time_step = self.env.step(self.get_action(time_step, False))
+                total_reward += float(np.asarray(time_step.reward))
+        return total_reward / num_episodes
+
+    def get_training_stats(self):
+        decisions = {}
+        for planner in filter(None, self.planners):
+            for kind, count in planner.decisions.items():
+                decisions[kind] = decisions.get(kind, 0) + count
+        return {
+            "episode_count": self.episode_count,
+            "step_count": self.step_count,
+            "decisions": decisions,
+        }
+
+    def get_weights(self):
+        return []
+
+    def set_weights(self, weights):
+        pass
+
+    def save(self, filepath):
+        pass  # no parameters
+
+    def load(self, filepath):
+        pass
@@ -51,14 +51,25 @@ class PPOAgent(SnakeBaseAgent):
         self.train_step_counter = tf.Variable(0)
 
         self.collected_experience = []
+        self.collected_batches = []  # batched trajectories, see store_experiences()
+        self._last_policy_info = ()
 
         self._initialize_agent()
 
     def _create_networks(self, observation_spec, action_spec):
+        map_spec = observation_spec['map']
+        map_shape = map_spec.shape
+        # the full map has one channel of tile codes, other maps have their own channels,
+        # scaled to [0, 1] as some count steps
+        if len(map_shape) == 3:
+            maximum = np.broadcast_to(map_spec.maximum, map_shape)[0, 0].astype(np.float32)
+            map_channels = [tf.keras.layers.Rescaling((1.0 / maximum).tolist())]
+        else:
+            map_channels = [tf.keras.layers.Reshape((*map_shape, 1))]
         preprocessing_layers = {
             'map': tf.keras.Sequential([
                 CastFloat32Layer(),
-                tf.keras.layers.Reshape((*observation_spec['map'].shape, 1)),
+                *map_channels,
                 tf.keras.layers.Conv2D(16, 3, activation='relu', padding='same'),
                 tf.keras.layers.BatchNormalization(),
                 tf.keras.layers.Conv2D(32, 3, activation='relu', padding='same'),
@@ -89,6 +100,12 @@ class PPOAgent(SnakeBaseAgent):
                 tf.keras.layers.Reshape((1,))
             ])
         }
+        # Area and food distance of each move, already in [0, 1]
+        if 'moves' in observation_spec:
+            preprocessing_layers['moves'] = tf.keras.Sequential([
+                CastFloat32Layer(),
+                tf.keras.layers.Flatten()
+            ])
 
         preprocessing_combiner = tf.keras.layers.Concatenate()
 
@@ -155,23 +172,81 @@ class PPOAgent(SnakeBaseAgent):
 
         return action_step.action.numpy() if isinstance(action_step.action, tf.Tensor) else action_step.action
 
+    def get_actions(self, time_step, use_exploration_policy=True):
+        """Actions for a batched time step, with one call to the policy."""
+        policy = self.collect_policy if use_exploration_policy else self.eval_policy
+        action_step = policy.action(tf.nest.map_structure(tf.convert_to_tensor, time_step))
+        # the distribution of the actions, PPO needs it to train on them
+        self._last_policy_info = action_step.info
+        return action_step.action.numpy().astype(np.int32)
+
     def store_experience(self, time_step, action, next_time_step):
         traj = trajectories.from_transition(time_step, policy_step.PolicyStep(action=action), next_time_step)
         self.collected_experience.append(traj)
         self.step_count += 1
+        return True
+
+    def store_experiences(self, time_steps, actions, next_time_steps):
+        """Store one step of every environment, keeping each environment's rollout in order."""
+        def batch(steps):
+            return tf.nest.map_structure(lambda *values: np.stack(values), *steps)
+
+        action_step = policy_step.PolicyStep(
+            action=np.asarray(actions, dtype=np.int32), info=self._last_policy_info
+        )
+        traj = trajectories.from_transition(batch(time_steps), action_step, batch(next_time_steps))
+        self.collected_batches.append(traj)
+        self.step_count += len(actions)
+
+    def prefill(self, dataset, limit=None, epochs=1):
+        """
+        Behaviour-clone the actor on the actions of an offline dataset, e.g. of
+        the expert agent, PPO only training on its own rollouts.
+
+        Args:
+            dataset: ShardDataset to read from, recorded with the observation
+                options of the agent's environment
+            limit: Transitions sampled per epoch, the size of the dataset by default
+            epochs: Passes over the transitions
+
+        Returns:
+            Number of transitions sampled per epoch
+        """
+        dataset.check(self.env)
+        transitions = len(dataset) if limit is None else min(limit, len(dataset))
+        if not transitions:
+            return 0
+        optimizer = tf.keras.optimizers.Adam(learning_rate=self.learning_rate)
+        fields = list(self.tf_env.observation_spec())
+        rng = np.random.default_rng()
+        for update in range(max(1, epochs * transitions // self.batch_size)):
+            batch = dataset.sample(self.batch_size, rng)
+            observations = {key: tf.convert_to_tensor(batch['observations'][key]) for key in fields}
+            with tf.GradientTape() as tape:
+                distribution, _ = self.actor_net(observations, step_type=None, network_state=(), training=True)
+                loss = -tf.reduce_mean(distribution.log_prob(batch['actions']))
+            variables = self.actor_net.trainable_variables
+            optimizer.apply_gradients(zip(tape.gradient(loss, variables), variables))
+            if update % 100 == 0:
+                print(f"Behaviour cloning update {update}, loss: {float(loss):.4f}")
+        return transitions
 
     def train_step(self):
-        if not self.collected_experience:
+        if self.collected_batches:
+            # [environments, steps], one rollout per environment
+            experience = tf.nest.map_structure(lambda *x: tf.stack(x, axis=1), *self.collected_batches)
+        elif self.collected_experience:
+            experience = tf.nest.map_structure(lambda *x: tf.stack(x), *self.collected_experience)
+            experience = tf.nest.map_structure(lambda x: tf.expand_dims(x, axis=1), experience)
+        else:
             return None
 
-        experience = tf.nest.map_structure(lambda *x: tf.stack(x), *self.collected_experience)
-        experience = tf.nest.map_structure(lambda x: tf.expand_dims(x, axis=1), experience)
-        
         loss_info = self.agent.train(experience)
         self.training_losses.append(loss_info.loss.numpy())
 
         # Clear experience after training
         self.collected_experience = []
+        self.collected_batches = []
 
         return loss_info.loss.numpy()
 
@@ -229,6 +304,15 @@ class PPOAgent(SnakeBaseAgent):
             'max_score': max(self.scores) if self.scores else 0.0,
         }
 
+    def get_weights(self):
+        """Weights of the actor network followed by those of the value network."""
+        return self.actor_net.get_weights() + self.value_net.get_weights()
+
+    def set_weights(self, weights):
+        actor_size = len(self.actor_net.weights)
+        self.actor_net.set_weights(weights[:actor_size])
+        self.value_net.set_weights(weights[actor_size:])
+
     def save(self, filepath):
         if self.agent is None:
             return
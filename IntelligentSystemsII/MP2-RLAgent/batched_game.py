@@ -0,0 +1,407 @@
+"""
+Headless batched Snake simulator.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+
+from consts import TIMEOUT, Direction, SuperFood, Tiles
+from game import FOOD_IN_MAP, GAME_SPEED, MAP_SIZE
+
+# Agent actions are sent to the server as ["w", "s", "a", "d"][action]
+ACTION_DIRECTIONS = np.array(
+    [Direction.NORTH, Direction.SOUTH, Direction.WEST, Direction.EAST], dtype=np.int8
+)
+DIRECTION_ACTIONS = np.argsort(ACTION_DIRECTIONS).astype(np.int32)
+
+# Indexed by Direction
+DIRECTION_DX = np.array([0, 1, 0, -1], dtype=np.int32)
+DIRECTION_DY = np.array([-1, 0, 1, 0], dtype=np.int32)
+
+INITIAL_RANGE = 3
+MIN_RANGE = 2
+MAX_RANGE = 6
+SUPER_FOOD_PERIOD = 100
+WALLS = 10
+WALL_LENGTH = 5
+
+
+def disc_offsets(radius):
+    """Return the (dx, dy) offsets of every cell at euclidean distance <= radius."""
+    span = np.arange(-radius, radius + 1)
+    dx, dy = np.meshgrid(span, span, indexing="ij")
+    inside = dx * dx + dy * dy <= radius * radius
+    return dx[inside].astype(np.int32), dy[inside].astype(np.int32)
+
+
+class BatchedGame:
+    """
+    Step N independent single-player games at once, entirely in NumPy.
+
+    Follows the rules of Snake.move, Game.collision and Map.spawn_food, but keeps
+    every game's tiles, body, food and superfood effects in arrays so that no
+    WebSocket round trip or frame pacing is involved. Observations are laid out
+    exactly as SnakeTrainEnv builds them from server frames, so a policy trained
+    here can play against the real server unchanged. info() and player_state()
+    give the messages a player of the same game would receive instead, which is
+    how BatchedSnakeEnv plays with engine="batched". The random draws are not
+    those of game.Game, so the same seed gives other games.
+    """
+
+    def __init__(self, num_envs, size=MAP_SIZE, timeout=TIMEOUT, food_in_map=FOOD_IN_MAP, seed=None):
+        self.num_envs = num_envs
+        self.size = tuple(size)
+        self.timeout = timeout
+        self.food_in_map = food_in_map
+        self._rng = np.random.default_rng(seed)
+
+        width, height = self.size
+        cells = width * height
+
+        self._tiles = np.zeros((num_envs, width, height), dtype=np.int8)
+        # Bodies live in ring buffers of flat cell indices (x * height + y)
+        self._body = np.zeros((num_envs, cells), dtype=np.int32)
+        self._head_ptr = np.zeros(num_envs, dtype=np.int32)
+        self._length = np.zeros(num_envs, dtype=np.int32)
+        self._occupied = np.zeros((num_envs, cells), dtype=bool)
+
+        self._to_grow = np.zeros(num_envs, dtype=np.int32)
+        self._score = np.zeros(num_envs, dtype=np.int32)
+        self._range = np.zeros(num_envs, dtype=np.int32)
+        self._traverse = np.zeros(num_envs, dtype=bool)
+        self._direction = np.zeros(num_envs, dtype=np.int8)
+        self._alive = np.zeros(num_envs, dtype=bool)
+        self._done = np.ones(num_envs, dtype=bool)
+        self._step = np.zeros(num_envs, dtype=np.int32)
+        self._last_action = np.zeros(num_envs, dtype=np.int32)
+
+        self._discs = {radius: disc_offsets(radius) for radius in range(MIN_RANGE, MAX_RANGE + 1)}
+        # The same discs as squares of the sight window, indexed [dx + radius, dy + radius]
+        self._windows = {
+            radius: np.add.outer(np.arange(-radius, radius + 1) ** 2, np.arange(-radius, radius + 1) ** 2) <= radius ** 2
+            for radius in self._discs
+        }
+        self._observation = self._empty_observation()
+
+    def _empty_observation(self):
+        return {
+            'map': np.zeros((self.num_envs, *self.size), dtype=np.uint8),
+            'traverse': np.zeros(self.num_envs, dtype=np.int32),
+            'range': np.ones(self.num_envs, dtype=np.int32),
+            'direction': np.zeros(self.num_envs, dtype=np.int32),
+            'timeout': np.full(self.num_envs, self.timeout, dtype=np.int32),
+            'score': np.zeros(self.num_envs, dtype=np.int32),
+        }
+
+    @property
+    def scores(self):
+        return self._score.copy()
+
+    @property
+    def alive(self):
+        return self._alive.copy()
+
+    @property
+    def done(self):
+        return self._done.copy()
+
+    @property
+    def steps(self):
+        return self._step.copy()
+
+    def bodies(self):
+        """Return each snake's body as a list of (x, y) from head to tail, like the server sends it."""
+        height = self.size[1]
+        bodies = []
+        for n in range(self.num_envs):
+            idx = (self._head_ptr[n] - np.arange(self._length[n])) % self._body.shape[1]
+            cells = self._body[n, idx]
+            bodies.append([(int(c // height), int(c % height)) for c in cells])
+        return bodies
+
+    def reset(self, indices=None):
+        """Start a new game in the given environments (all of them by default)."""
+        indices = np.arange(self.num_envs) if indices is None else np.atleast_1d(indices)
+        width, height = self.size
+
+        self._tiles[indices] = Tiles.PASSAGE
+        self._generate_stones(indices)
+
+        # Snake(x, y) starts with one segment, heading east and one pending growth
+        spawn = self._rng.integers(width, size=indices.size) * height + self._rng.integers(height, size=indices.size)
+        self._occupied[indices] = False
+        self._occupied[indices, spawn] = True
+        self._head_ptr[indices] = 0
+        self._body[indices, 0] = spawn
+
+        self._length[indices] = 1
+        self._to_grow[indices] = 1
+        self._score[indices] = 0
+        self._range[indices] = INITIAL_RANGE
+        self._traverse[indices] = True
+        self._direction[indices] = Direction.EAST
+        self._alive[indices] = True
+        self._done[indices] = False
+        self._step[indices] = 0
+        self._last_action[indices] = 0
+
+        for _ in range(self.food_in_map):
+            self._spawn_food(indices, Tiles.FOOD)
+
+        # The first frame a client gets is Game.info(), which carries the full map
+        self._observation['map'][indices] = self._tiles[indices]
+        self._observation['traverse'][indices] = 0
+        self._observation['range'][indices] = 1
+        self._observation['direction'][indices] = 0
+        self._observation['timeout'][indices] = self.timeout
+        self._observation['score'][indices] = 0
+
+        return self.observation()
+
+    def observation(self):
+        return {key: value.copy() for key, value in self._observation.items()}
+
+    def load(self, index, snapshot):
+        """
+        Continue a single-player game in one environment, to start from a
+        replay or to check the rules against game.Game.
+
+        Args:
+            index: Environment to load the game into
+            snapshot: Game.snapshot() of the game, its first snake being played
+        """
+        height = self.size[1]
+        snake = snapshot["snakes"][0]
+        cells = [x * height + y for x, y in snake["body"]]  # tail first, like Snake._body
+        self._tiles[index] = np.asarray(snapshot["map"]["map"], dtype=np.int8)
+        self._body[index, :len(cells)] = cells
+        self._head_ptr[index] = len(cells) - 1
+        self._length[index] = len(cells)
+        self._occupied[index] = False
+        self._occupied[index, cells] = True
+        self._to_grow[index] = snake["to_grow"]
+        self._score[index] = snake["score"]
+        self._range[index] = snake["range"]
+        self._traverse[index] = snake["traverse"]
+        self._direction[index] = snake["direction"]
+        self._alive[index] = snake["alive"]
+        self._done[index] = not (snapshot["running"] and snake["alive"])
+        self._step[index] = snapshot["step"]
+        self._last_action[index] = DIRECTION_ACTIONS[snake["direction"]]
+        mask = np.zeros(self.num_envs, dtype=bool)
+        mask[index] = self._alive[index]
+        self._update_observation(mask)
+
+    def info(self, index):
+        """The game info of one environment, like Game.info() sends it at the start."""
+        return {
+            "size": self.size,
+            "map": self._tiles[index].tolist(),
+            "fps": GAME_SPEED,
+            "timeout": self.timeout,
+            "level": 1,
+        }
+
+    def player_state(self, index, name="student"):
+        """
+        The state the player of one environment receives after a step, like
+        protocol.player_state() of a Game with compact_sight. The body is
+        head first and the sight is the window around the head.
+        """
+        width, height = self.size
+        ring = self._body.shape[1]
+        cells = self._body[index, (self._head_ptr[index] - np.arange(self._length[index])) % ring]
+        radius = int(self._range[index])
+        head_x, head_y = divmod(int(cells[0]), height)
+        xs = (head_x - radius + np.arange(2 * radius + 1)) % width
+        ys = (head_y - radius + np.arange(2 * radius + 1)) % height
+        window = np.add.outer(xs * height, ys)
+        tiles = self._tiles[index].reshape(-1)[window].astype(np.int64)
+        tiles[self._occupied[index, window]] = Tiles.SNAKE
+        tiles[~self._windows[radius]] = -1
+        return {
+            "players": [name],
+            "step": int(self._step[index]),
+            "timeout": self.timeout,
+            "name": name,
+            "body": np.stack(np.divmod(cells, height), axis=1).tolist(),
+            "sight": {"x": int(xs[0]), "y": int(ys[0]), "tiles": tiles},
+            "score": int(self._score[index]),
+            "range": radius,
+            "traverse": bool(self._traverse[index]),
+        }
+
+    def _generate_stones(self, indices):
+        """Same wall layout rules as Map.__init__, for many maps at once."""
+        width, height = self.size
+        shape = (indices.size, WALLS)
+        x = self._rng.integers(width, size=shape)
+        y = self._rng.integers(height, size=shape)
+        backwards_y = self._rng.integers(2, size=shape).astype(bool)
+        backwards_x = self._rng.integers(2, size=shape).astype(bool)
+
+        # range(y, (y +- 5) % height)[:5] is either empty or the 5 cells from y onwards
+        vertical = np.where(backwards_y, y < WALL_LENGTH, y + WALL_LENGTH < height)
+        horizontal = np.where(backwards_x, x < WALL_LENGTH, x + WALL_LENGTH < width)
+
+        envs = np.broadcast_to(indices[:, None, None], (*shape, WALL_LENGTH))
+        offsets = np.arange(WALL_LENGTH)
+        wall_x = np.broadcast_to(x[..., None], envs.shape)
+        wall_y = np.broadcast_to(y[..., None], envs.shape)
+        self._tiles[envs[vertical], wall_x[vertical], (y[..., None] + offsets)[vertical]] = Tiles.STONE
+        self._tiles[envs[horizontal], (x[..., None] + offsets)[horizontal], wall_y[horizontal]] = Tiles.STONE
+
+    def _spawn_food(self, indices, food_type):
+        """Place one piece of food per environment on a cell without food or stone."""
+        width, height = self.size
+        pending = np.asarray(indices)
+        while pending.size:
+            x = self._rng.integers(width, size=pending.size)
+            y = self._rng.integers(height, size=pending.size)
+            free = self._tiles[pending, x, y] == Tiles.PASSAGE
+            self._tiles[pending[free], x[free], y[free]] = food_type
+            pending = pending[~free]
+
+    def _pop_tail(self, mask):
+        envs = np.flatnonzero(mask)
+        tail_ptr = (self._head_ptr[envs] - self._length[envs] + 1) % self._body.shape[1]
+        self._occupied[envs, self._body[envs, tail_ptr]] = False
+        self._length[envs] -= 1
+
+    def _grow(self, mask, amount):
+        self._to_grow[mask] += amount
+        self._to_grow[mask] = np.maximum(1 - self._length[mask], self._to_grow[mask])
+
+    def step(self, actions):
+        """
+        Advance every running game by one tick.
+
+        Args:
+            actions: Array of N actions (0=w, 1=s, 2=a, 3=d), ignored for finished games
+
+        Returns:
+            (observation, reward, done) where observation is a dict of batched arrays
+            matching SnakeTrainEnv's spec, reward is the score gained this tick and done
+            flags games that ended (call reset() on them before stepping again)
+        """
+        actions = np.asarray(actions, dtype=np.int32)
+        width, height = self.size
+        cells = width * height
+        envs = np.arange(self.num_envs)
+        active = ~self._done
+        previous_score = self._score.copy()
+
+        self._step[active] += 1
+        timed_out = active & (self._step == self.timeout)
+
+        spawn_super = active & (self._step % SUPER_FOOD_PERIOD == 0)
+        if spawn_super.any():
+            self._spawn_food(np.flatnonzero(spawn_super), Tiles.SUPER)
+
+        # Snake.move through Map.calc_pos
+        directions = ACTION_DIRECTIONS[actions]
+        head = self._body[envs, self._head_ptr]
+        new_x = head // height + DIRECTION_DX[directions]
+        new_y = head % height + DIRECTION_DY[directions]
+        new_x = np.where(self._traverse, new_x % width, new_x)
+        new_y = np.where(self._traverse, new_y % height, new_y)
+        off_map = (new_x < 0) | (new_x >= width) | (new_y < 0) | (new_y >= height)
+        new_cell = np.clip(new_x, 0, width - 1) * height + np.clip(new_y, 0, height - 1)
+        on_stone = self._tiles.reshape(self.num_envs, cells)[envs, new_cell] == Tiles.STONE
+        blocked = off_map | (~self._traverse & on_stone)
+        crashed = active & (blocked | self._occupied[envs, new_cell])
+        self._alive[crashed] = False
+
+        moved = active & ~crashed
+        self._head_ptr[moved] = (self._head_ptr[moved] + 1) % cells
+        self._body[moved, self._head_ptr[moved]] = new_cell[moved]
+        self._occupied[moved, new_cell[moved]] = True
+        self._length[moved] += 1
+
+        growing = moved & (self._to_grow > 0)
+        shrinking = moved & (self._to_grow < 0) & (self._length > 3)
+        self._to_grow[growing] -= 1
+        self._to_grow[shrinking] += 1
+        self._pop_tail(moved & ~growing)
+        self._pop_tail(shrinking)
+        self._direction[moved] = directions[moved]
+        self._last_action[moved] = actions[moved]
+
+        # Game.collision
+        head = self._body[envs, self._head_ptr]
+        head_tile = self._tiles.reshape(self.num_envs, cells)[envs, head]
+        self._alive[moved & ~self._traverse & (head_tile == Tiles.STONE)] = False
+
+        ate_food = moved & (head_tile == Tiles.FOOD)
+        ate_super = moved & (head_tile == Tiles.SUPER)
+        eaten = ate_food | ate_super
+        self._tiles.reshape(self.num_envs, cells)[eaten, head[eaten]] = Tiles.PASSAGE
+
+        self._score[ate_food] += 1
+        self._grow(ate_food, 1)
+        if ate_food.any():
+            self._spawn_food(np.flatnonzero(ate_food), Tiles.FOOD)
+
+        if ate_super.any():
+            self._apply_super_food(ate_super)
+
+        done = active & (~self._alive | timed_out)
+        self._done |= done
+        self._update_observation(active & self._alive)
+
+        reward = np.where(active, self._score - previous_score, 0).astype(np.float32)
+        return self.observation(), reward, done
+
+    def _apply_super_food(self, mask):
+        kinds = np.zeros(self.num_envs, dtype=np.int8)
+        kinds[mask] = self._rng.choice(
+            [SuperFood.POINTS, SuperFood.LENGTH, SuperFood.RANGE, SuperFood.TRAVERSE], size=mask.sum()
+        )
+
+        points = mask & (kinds == SuperFood.POINTS)
+        self._score[points] += self._rng.integers(-5, 11, size=points.sum())
+
+        length = mask & (kinds == SuperFood.LENGTH)
+        self._grow(length, self._rng.integers(-2, 3, size=length.sum()))
+
+        sight = mask & (kinds == SuperFood.RANGE)
+        self._range[sight] = np.clip(self._range[sight] + self._rng.integers(-2, 3, size=sight.sum()), MIN_RANGE, MAX_RANGE)
+
+        traverse = mask & (kinds == SuperFood.TRAVERSE)
+        self._traverse[traverse] = ~self._traverse[traverse]
+
+    def _update_observation(self, mask):
+        """Rebuild the observation of the given environments the way SnakeTrainEnv does."""
+        width, height = self.size
+        cells = width * height
+        obs_map = self._observation['map']
+        obs_map[mask] = Tiles.PASSAGE
+
+        envs = np.flatnonzero(mask)
+        head = self._body[envs, self._head_ptr[envs]]
+        for radius, (dx, dy) in self._discs.items():
+            group = self._range[envs] == radius
+            if not group.any():
+                continue
+            g_envs = envs[group]
+            xs = (head[group, None] // height + dx) % width
+            ys = (head[group, None] % height + dy) % height
+            cell = xs * height + ys
+            tiles = self._tiles.reshape(self.num_envs, cells)[g_envs[:, None], cell].astype(np.uint8)
+            tiles[self._occupied[g_envs[:, None], cell]] = Tiles.SNAKE
+            # Sight is written as map[y, x], and only where x fits the second axis,
+            # just like SnakeTrainEnv._update_state does with the server's sight dict
+            visible = xs < height
+            rows = np.broadcast_to(g_envs[:, None], xs.shape)
+            obs_map[rows[visible], ys[visible], xs[visible]] = tiles[visible]
+
+        # The body overrides the sight at map[x, y]: head = 1, rest = 4
+        local = obs_map[envs]
+        local[self._occupied[envs].reshape(local.shape)] = Tiles.SNAKE
+        local[np.arange(envs.size), head // height, head % height] = 1
+        obs_map[envs] = local
+
+        self._observation['traverse'][mask] = self._traverse[mask]
+        self._observation['range'][mask] = self._range[mask]
+        self._observation['score'][mask] = self._score[mask]
+        self._observation['timeout'][mask] = np.maximum(0, self.timeout - self._step[mask])
+        self._observation['direction'][mask] = self._last_action[mask]
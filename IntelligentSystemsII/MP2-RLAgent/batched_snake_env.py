@@ -0,0 +1,418 @@
+"""
+Batched TF-Agents environment over K Snake games, played on the server or in-process.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import asyncio
+import json
+import logging
+import random
+import time
+
+import numpy as np
+import tensorflow as tf
+import websockets
+from tf_agents.environments import py_environment
+
+from agents.snake_dqn_agent import DQNAgent
+from agents.snake_expert_agent import ExpertAgent
+from agents.snake_ppo_agent import PPOAgent
+from batched_game import BatchedGame
+from dataset_builder import KEYS, DatasetWriter, ShardDataset
+from game import Game
+from protocol import PROTOCOL_BINARY, decode_message, player_state
+from rewards import RewardStats, parse_weights
+from snake_train_env import SnakeTrainEnv
+
+AGENTS = {
+    "dqn": DQNAgent,
+    "ppo": PPOAgent,
+    "expert": ExpertAgent,
+}
+
+# Batched steps between two train_step() calls: DQN learns from its replay
+# memory every step, PPO trains on a rollout of this many steps per game
+TRAIN_EVERY = {
+    "dqn": 1,
+    "ppo": 128,
+    "expert": 1,
+}
+
+# In-process engines: one game.Game per game, or one BatchedGame for all of them
+ENGINES = ("game", "batched")
+
+GAME_OVER = {"highscores": []}
+CLOSE_TIMEOUT = 5.0  # seconds to wait for the server to close a game left before its end
+
+logger = logging.getLogger("BatchedSnakeEnv")
+
+
+class LocalGame:
+    """One single-player game simulated in this process with game.Game."""
+
+    def __init__(self, name="student", seed=None, **game_args):
+        """
+        Initialize the game.
+
+        Args:
+            name: Name of the player
+            seed: Seed of the games, each episode draws a new map from it
+            game_args: Extra Game() arguments, such as timeout or size
+        """
+        self.name = name
+        self.game_args = game_args
+        self._rng = random.Random(seed)
+        self._game = None
+
+    async def reset(self):
+        """Start a new game and return its info, like the first server message."""
+        self._game = Game(rng=self._rng, compact_sight=True, **self.game_args)
+        self._game.start([self.name])
+        return self._game.info()
+
+    async def step(self, key):
+        """Play a key and return the next message the player would receive."""
+        game = self._game
+        if not game.running:
+            return GAME_OVER
+        game.keypress(self.name, key)
+        state = game.update()
+        if not game.snakes[self.name].alive:
+            return GAME_OVER
+        return player_state(state, self.name)
+
+    async def close(self):
+        self._game = None
+
+
+class RemoteGame:
+    """One player connection to server.py, kept across episodes with the next_game command."""
+
+    def __init__(self, server_address="localhost:8000", name="student"):
+        self.url = f"ws://{server_address}/player"
+        self.name = name
+        self._websocket = None
+        self._finished = False  # the game over of the last game arrived
+
+    async def reset(self):
+        """Join a new game and return its info."""
+        if self._finished and self._websocket is not None and not self._websocket.closed:
+            await self._websocket.send(json.dumps({"cmd": "next_game"}))
+        else:
+            if self._websocket is not None:
+                # a game left before its end keeps our name until the server closes it
+                try:
+                    await asyncio.wait_for(self._websocket.wait_closed(), CLOSE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+                await self.close()
+            self._websocket = await websockets.connect(self.url)
+            await self._websocket.send(json.dumps(
+                {"cmd": "join", "name": self.name, "protocol": PROTOCOL_BINARY, "session": True}
+            ))
+        self._finished = False
+        while True:
+            message = decode_message(await self._websocket.recv())
+            if "size" in message:  # skip what is left of a game that ended as we joined
+                return message
+
+    async def step(self, key):
+        """Send a key and return the next state, or the highscores once the game is over."""
+        try:
+            await self._websocket.send(json.dumps({"cmd": "key", "key": key}))
+            state = decode_message(await self._websocket.recv())
+            if "body" not in state and "highscores" not in state:
+                # our snake died, the highscores message follows
+                state = decode_message(await self._websocket.recv())
+            self._finished = "highscores" in state
+            return state
+        except websockets.exceptions.ConnectionClosed:
+            return GAME_OVER
+
+    async def close(self):
+        if self._websocket is not None:
+            await self._websocket.close()
+            self._websocket = None
+
+
+class BatchedSnakeEnv(py_environment.PyEnvironment):
+    """
+    K SnakeTrainEnv stepped together as one batched TF-Agents environment.
+
+    Observations, rewards and step types have a leading batch dimension of
+    size K, and step() takes one action per game, so a single forward pass of
+    the policy picks the actions of every game. A game whose episode ended is
+    reset on the next step(), its action being ignored, as TF-Agents expects
+    from batched environments.
+
+    The games run either over K concurrent connections to the server (start it
+    with --players 1, at least K rooms so that no game waits for another one,
+    and --turbo to not wait for the frame rate) or in this process, with no
+    server at all. In-process games are either one game.Game each or, with
+    engine="batched", a single BatchedGame stepping all of them in NumPy. Any
+    other games with the same reset, step and close can be given instead, such
+    as the self-play games of league.LeagueGame.
+    """
+
+    def __init__(self, num_envs, server_address=None, name="student", seed=None, crop_size=None,
+                 memory=False, frames=1, reward_weights=None, reachability=False, games=None, engine="game"):
+        """
+        Initialize the environment.
+
+        Args:
+            num_envs: Number of games played at once
+            server_address: "host:port" of server.py, None to simulate the games here
+            name: Player name, numbered for each game
+            seed: Seed of the in-process games
+            crop_size: Egocentric crop of the observations, see SnakeTrainEnv
+            memory: Whether the observations remember earlier steps, see SnakeTrainEnv
+            frames: Number of maps stacked in the observations, see SnakeTrainEnv
+            reward_weights: Weights of the reward terms, see SnakeTrainEnv
+            reachability: Whether the observations give the area and food distance of each move,
+                see SnakeTrainEnv
+            games: The num_envs games to play instead of LocalGame or RemoteGame
+            engine: "game" or "batched", how the in-process games are simulated, see ENGINES
+        """
+        super().__init__(handle_auto_reset=False)
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, the engines are {ENGINES}")
+        self.engine = None
+        self.names = [f"{name}{i}" for i in range(num_envs)]
+        if engine == "batched":
+            if server_address is not None or games is not None:
+                raise ValueError("The batched engine only simulates in-process games")
+            self.engine = BatchedGame(num_envs, seed=seed)
+            self.games = []
+        elif games is not None:
+            self.games = list(games)
+        elif server_address is None:
+            self.games = [
+                LocalGame(f"{name}{i}", None if seed is None else seed + i)
+                for i in range(num_envs)
+            ]
+        else:
+            self.games = [RemoteGame(server_address, f"{name}{i}") for i in range(num_envs)]
+        self.envs = [
+            SnakeTrainEnv(
+                crop_size=crop_size, memory=memory, frames=frames, reward_weights=reward_weights,
+                reachability=reachability,
+            )
+            for _ in range(num_envs)
+        ]
+        self._loop = asyncio.new_event_loop()
+        self._time_steps = [None] * num_envs
+        self._last_ended = 0
+
+    @property
+    def batched(self):
+        return True
+
+    @property
+    def batch_size(self):
+        return len(self.envs)
+
+    @property
+    def frames(self):
+        return self.envs[0].frames
+
+    @property
+    def observer(self):
+        """Observer of the first game, for the observation options they all share."""
+        return self.envs[0].observer
+
+    def reward_stats(self, reset=True):
+        """Statistics of the reward terms over every game, see rewards.RewardStats."""
+        stats = RewardStats(self.envs[0].rewards.stats.terms)
+        for env in self.envs:
+            stats.merge(env.rewards.stats)
+            if reset:
+                env.rewards.stats.reset()
+        return stats
+
+    @property
+    def time_steps(self):
+        """The last time step of each game, unbatched."""
+        return list(self._time_steps)
+
+    def observation_spec(self):
+        return self.envs[0].observation_spec()
+
+    def action_spec(self):
+        return self.envs[0].action_spec()
+
+    def _keep(self, index, time_step):
+        self._time_steps[index] = time_step
+        if time_step.is_last():
+            self._last_ended = index
+
+    def _batch(self):
+        return tf.nest.map_structure(lambda *values: np.stack(values), *self._time_steps)
+
+    def _run(self, coroutines):
+        async def gather():
+            return await asyncio.gather(*coroutines)
+
+        return self._loop.run_until_complete(gather())
+
+    def _reset(self):
+        if self.engine is not None:
+            self.engine.reset()
+            infos = [self.engine.info(i) for i in range(self.batch_size)]
+        else:
+            infos = self._run([game.reset() for game in self.games])
+        for i, (env, info) in enumerate(zip(self.envs, infos)):
+            self._keep(i, env.call_reset(info))
+        return self._batch()
+
+    async def _step_game(self, index, action):
+        game, env = self.games[index], self.envs[index]
+        if self._time_steps[index].is_last():
+            self._keep(index, env.call_reset(await game.reset()))
+        else:
+            message = await game.step(KEYS[action])
+            self._keep(index, env.call_step(message, action))
+
+    def _step_engine(self, actions):
+        """Step every game of the BatchedGame at once, resetting those whose episode ended."""
+        engine = self.engine
+        ended = np.array([time_step.is_last() for time_step in self._time_steps])
+        # a game that timed out sent its last state, the game over follows on the next step
+        over = engine.done
+        engine.step(actions)  # the finished games ignore their action
+        alive = engine.alive
+        if ended.any():
+            engine.reset(np.flatnonzero(ended))
+        for i, env in enumerate(self.envs):
+            if ended[i]:
+                self._keep(i, env.call_reset(engine.info(i)))
+            elif over[i] or not alive[i]:
+                self._keep(i, env.call_step(GAME_OVER, int(actions[i])))
+            else:
+                self._keep(i, env.call_step(engine.player_state(i, self.names[i]), int(actions[i])))
+
+    def _step(self, action):
+        actions = np.asarray(action, dtype=np.int32).reshape(self.batch_size)
+        if self.engine is not None:
+            self._step_engine(actions)
+        else:
+            self._run([self._step_game(i, int(a)) for i, a in enumerate(actions)])
+        return self._batch()
+
+    def get_state(self, index=None):
+        """Game state of one environment, by default the last one whose episode ended."""
+        return self.envs[self._last_ended if index is None else index].get_state()
+
+    def close(self):
+        self._run([game.close() for game in self.games])
+        self._loop.close()
+
+
+def train(agent, env, total_steps, train_every, log_every=50, dataset=None, on_step=None):
+    """
+    Collect experience from a BatchedSnakeEnv and train the agent on it.
+
+    Args:
+        agent: Agent taking its actions with get_actions()
+        env: BatchedSnakeEnv
+        total_steps: Number of game steps to play, over all the games
+        train_every: Batched steps between two train_step() calls
+        log_every: Episodes between two progress lines
+        dataset: DatasetWriter recording the episodes played, each written
+            once it ends as the games interleave
+        on_step: Called with the game steps played so far after every batched step
+
+    Returns:
+        The final score of every episode played
+    """
+    scores = []
+    returns = np.zeros(env.batch_size, dtype=np.float32)
+    start = time.time()
+
+    time_step = env.reset()
+    episodes = [(first, []) for first in env.time_steps]  # first time step and (action, time step) of each game
+    for step in range(1, total_steps // env.batch_size + 1):
+        actions = agent.get_actions(time_step)
+        previous = env.time_steps
+        time_step = env.step(actions)
+        agent.store_experiences(previous, actions, env.time_steps)
+        if dataset is not None:
+            for i, (before, after) in enumerate(zip(previous, env.time_steps)):
+                if before.is_last():
+                    episodes[i] = (after, [])
+                    continue
+                episodes[i][1].append((actions[i], after))
+                if after.is_last():
+                    dataset.begin_episode(episodes[i][0])
+                    for action, next_time_step in episodes[i][1]:
+                        dataset.add(action, next_time_step)
+
+        # games that were just reset have no reward to count
+        reset = np.array([previous_step.is_last() for previous_step in previous])
+        returns += np.where(reset, 0.0, time_step.reward)
+        for i in np.flatnonzero(time_step.step_type == 2):  # StepType.LAST
+            scores.append(int(time_step.observation["score"][i]))
+            agent.on_episode_end()
+            if len(scores) % log_every == 0:
+                logger.info(
+                    "%s episodes, %s steps in %.0fs, avg score (last %s): %.2f, return %.2f",
+                    len(scores), step * env.batch_size, time.time() - start,
+                    log_every, np.mean(scores[-log_every:]), returns[i],
+                )
+                logger.info("Reward terms: %s", env.reward_stats().format())
+            returns[i] = 0.0
+
+        if step % train_every == 0:
+            loss = agent.train_step()
+            if loss is not None and step % (50 * train_every) == 0:
+                logger.info("Step %s, training loss: %.4f", step * env.batch_size, loss)
+        if on_step is not None:
+            on_step(step * env.batch_size)
+
+    return scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train an agent on K games at once")
+    parser.add_argument("--agent", choices=AGENTS, default="dqn")
+    parser.add_argument("--envs", type=int, default=8, help="Games played at once")
+    parser.add_argument("--steps", type=int, default=100_000, help="Game steps, over all games")
+    parser.add_argument("--train-every", type=int, help="Batched steps between updates")
+    parser.add_argument("--server", help="host:port of server.py, games run in-process if not set")
+    parser.add_argument("--engine", choices=ENGINES, default="game", help="Simulation of the in-process games")
+    parser.add_argument("--name", default="student")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--crop", type=int, help="Side of the egocentric observation crop, odd")
+    parser.add_argument("--memory", action="store_true", help="Remember what earlier steps saw")
+    parser.add_argument("--frames", type=int, default=1, help="Last maps stacked in the observations")
+    parser.add_argument("--reward-weights", type=parse_weights, help='Weights of the reward terms, e.g. "danger=0,distance=0.5"')
+    parser.add_argument("--reachability", action="store_true", help="Add the area and food distance of each move")
+    parser.add_argument("--epsilon", type=float, help="Starting chance of a random action")
+    parser.add_argument("--prefill", help="Dataset to pre-fill the DQN replay or behaviour-clone the PPO actor")
+    parser.add_argument("--dataset", help="Dataset directory recording the episodes played")
+    parser.add_argument("--output", help="Where to save the policy")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    env = BatchedSnakeEnv(args.envs, args.server, args.name, args.seed, args.crop, args.memory, args.frames,
+                          args.reward_weights, args.reachability, engine=args.engine)
+    agent = AGENTS[args.agent](env)
+    if args.epsilon is not None:
+        agent.epsilon = args.epsilon
+    if args.prefill:
+        logger.info("Prefilled %s transitions from %s", agent.prefill(ShardDataset(args.prefill)), args.prefill)
+    dataset = DatasetWriter(args.dataset, options=env.observer.options) if args.dataset else None
+    try:
+        scores = train(agent, env, args.steps, args.train_every or TRAIN_EVERY[args.agent], dataset=dataset)
+    finally:
+        env.close()
+        if dataset is not None:
+            dataset.close()
+
+    if scores:
+        logger.info("%s episodes, avg score %.2f, max %s", len(scores), np.mean(scores), max(scores))
+    output = args.output or f"policy/{args.agent}_agent_batched"
+    agent.save(output)
+    logger.info("Policy saved: %s", output)
@@ -0,0 +1,74 @@
+"""
+Micro-benchmark of DQNAgent.train_step, run eagerly and compiled with tf.function.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import contextlib
+import io
+import time
+
+import numpy as np
+import tensorflow as tf
+from tf_agents.trajectories import time_step as ts
+
+from agents.snake_dqn_agent import DQNAgent
+from snake_train_env import SnakeTrainEnv
+
+
+def random_observation(rng, map_shape):
+    return {
+        'map': rng.integers(0, 5, size=map_shape, dtype=np.uint8),
+        'traverse': np.int32(rng.integers(0, 2)),
+        'range': np.int32(rng.integers(2, 7)),
+        'direction': np.int32(rng.integers(0, 4)),
+        'timeout': np.int32(rng.integers(0, 3000)),
+        'score': np.int32(rng.integers(0, 50)),
+    }
+
+
+def fill_memory(agent, transitions, map_shape, seed=0):
+    """Store random episodes of 100 steps until the memory has `transitions`."""
+    rng = np.random.default_rng(seed)
+    time_step = ts.restart(random_observation(rng, map_shape))
+    for i in range(transitions):
+        observation = random_observation(rng, map_shape)
+        reward = np.float32(rng.normal())
+        if i % 100 == 99:
+            next_time_step = ts.termination(observation, reward)
+        else:
+            next_time_step = ts.transition(observation, reward, discount=0.99)
+        agent.store_experience(time_step, int(rng.integers(0, 4)), next_time_step)
+        time_step = next_time_step if not next_time_step.is_last() else ts.restart(observation)
+
+
+def updates_per_second(agent, updates):
+    start = time.perf_counter()
+    for _ in range(updates):
+        agent.train_step()
+    return updates / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--updates", type=int, default=50, help="Timed updates per mode")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--prioritized", action="store_true", help="Use prioritized replay")
+    args = parser.parse_args()
+
+    env = SnakeTrainEnv()
+    map_shape = env.observation_spec()['map'].shape
+    agent = DQNAgent(env, batch_size=args.batch_size, prioritized_replay=args.prioritized)
+    agent.target_update_freq = 10 ** 9  # keep target syncs out of the timings
+
+    with contextlib.redirect_stdout(io.StringIO()):  # network summary
+        fill_memory(agent, agent.warmup_steps + 10 * args.batch_size, map_shape)
+
+    results = {}
+    for mode, eager in (("eager", True), ("tf.function", False)):
+        tf.config.run_functions_eagerly(eager)
+        agent.train_step()  # trace (or warm up) before timing
+        results[mode] = updates_per_second(agent, args.updates)
+        print(f"{mode:>12}: {results[mode]:8.1f} updates/s")
+    tf.config.run_functions_eagerly(False)
+
+    print(f"     speedup: {results['tf.function'] / results['eager']:8.1f}x")
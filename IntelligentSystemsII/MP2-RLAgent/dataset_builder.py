@@ -0,0 +1,374 @@
+"""
+Offline datasets of SnakeTrainEnv transitions, stored as memory-mappable .npy shards.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+
+import numpy as np
+from tf_agents.trajectories import time_step as ts
+
+from consts import Direction
+from protocol import player_state
+from replay import ReplayReader
+from snake_train_env import SnakeTrainEnv
+
+# Layout of a dataset directory:
+#
+#   meta.json             observation options and fields, dtypes and the length of every shard
+#   shard-00000/map.npy   one file per observation field, one row per time step
+#   shard-00000/action.npy, reward.npy, done.npy
+#
+# Each time step of an episode is stored once. Row i holds an observation and the
+# action taken there, the reward received and whether the episode ended after it,
+# so the transition goes from row i to row i + 1. The last row of an episode has
+# action -1 and starts no transition. Transitions never cross shards: an episode
+# that does not fit ends the shard and goes on from a copy of its last row.
+
+SHARD_SIZE = 100_000
+NO_ACTION = -1
+KEYS = ["w", "s", "a", "d"]  # action index to key, as student.py sends them
+DIRECTION_ACTION = {
+    Direction.NORTH: 0,
+    Direction.SOUTH: 1,
+    Direction.WEST: 2,
+    Direction.EAST: 3,
+}
+
+OBSERVATION_DTYPES = {
+    "map": np.uint8,  # tiles are 0 to 4
+    "traverse": np.int32,
+    "range": np.int32,
+    "direction": np.int32,
+    "timeout": np.int32,
+    "score": np.int32,
+}
+# Fields recorded when the observations have them, see SnakeTrainEnv
+OPTIONAL_DTYPES = {
+    "moves": np.float32,
+}
+
+logger = logging.getLogger("DatasetBuilder")
+
+
+class DatasetWriter:
+    """Appends episodes from SnakeTrainEnv to a dataset directory."""
+
+    def __init__(self, directory, shard_size=SHARD_SIZE, options=None):
+        """
+        Initialize the writer.
+
+        Args:
+            directory: Dataset directory, created if needed. Existing shards are kept
+            shard_size: Maximum number of rows in a shard
+            options: Observation options of the environment, see Observer.options
+        """
+        self.directory = directory
+        self.shard_size = shard_size
+        os.makedirs(directory, exist_ok=True)
+
+        self._meta = self._load_meta(directory)
+        recorded = self._meta.setdefault("observation", options)
+        if options is not None and recorded != options:
+            raise ValueError(f"{directory} holds observations with options {recorded}, not {options}")
+        self._rows = []  # observation rows of the shard being filled
+        self._actions = []
+        self._rewards = []
+        self._dones = []
+        self._in_episode = False
+
+    @staticmethod
+    def _load_meta(directory):
+        path = os.path.join(directory, "meta.json")
+        if os.path.isfile(path):
+            with open(path) as f:
+                return json.load(f)
+        return {
+            "fields": {key: np.dtype(dtype).name for key, dtype in OBSERVATION_DTYPES.items()},
+            "shards": [],
+        }
+
+    def _append_observation(self, observation):
+        if not self._rows and not self._meta["shards"]:
+            # the optional fields of the first observation are those of the whole dataset
+            for key, dtype in OPTIONAL_DTYPES.items():
+                if key in observation:
+                    self._meta["fields"][key] = np.dtype(dtype).name
+        self._rows.append(
+            {
+                key: np.array(observation[key], dtype=dtype)
+                for key, dtype in self._meta["fields"].items()
+            }
+        )
+        self._actions.append(NO_ACTION)
+        self._rewards.append(0.0)
+        self._dones.append(False)
+
+    def begin_episode(self, time_step):
+        """Start an episode from the time step returned by call_reset()."""
+        if len(self._rows) >= self.shard_size:
+            self.flush()
+        self._append_observation(time_step.observation)
+        self._in_episode = True
+
+    def add(self, action, next_time_step):
+        """Record the action taken on the last observation and the time step it led to."""
+        if not self._in_episode:
+            raise RuntimeError("add() called before begin_episode()")
+
+        if len(self._rows) >= self.shard_size:
+            # keep whole transitions in a shard: the last observation ends this
+            # shard and starts the next one
+            last = self._rows[-1]
+            self.flush()
+            self._rows.append(last)
+            self._actions.append(NO_ACTION)
+            self._rewards.append(0.0)
+            self._dones.append(False)
+
+        self._actions[-1] = int(action)
+        self._rewards[-1] = float(next_time_step.reward)
+        self._dones[-1] = bool(next_time_step.is_last())
+        self._append_observation(next_time_step.observation)
+        if next_time_step.is_last():
+            self._in_episode = False
+
+    def flush(self):
+        """Write the rows gathered so far as a new shard."""
+        if len(self._rows) < 2:
+            return
+        name = f"shard-{len(self._meta['shards']):05d}"
+        path = os.path.join(self.directory, name)
+        os.makedirs(path, exist_ok=True)
+
+        for key in self._meta["fields"]:
+            np.save(os.path.join(path, f"{key}.npy"), np.stack([row[key] for row in self._rows]))
+        np.save(os.path.join(path, "action.npy"), np.array(self._actions, dtype=np.int32))
+        np.save(os.path.join(path, "reward.npy"), np.array(self._rewards, dtype=np.float32))
+        np.save(os.path.join(path, "done.npy"), np.array(self._dones, dtype=bool))
+
+        self._meta["shards"].append({"name": name, "rows": len(self._rows)})
+        with open(os.path.join(self.directory, "meta.json"), "w") as f:
+            json.dump(self._meta, f, indent=2)
+        logger.info("Wrote %s (%s rows)", name, len(self._rows))
+
+        self._rows, self._actions, self._rewards, self._dones = [], [], [], []
+
+    def close(self):
+        self.flush()
+
+
+class ShardDataset:
+    """Read-only view of a dataset directory, memory-mapped by default."""
+
+    def __init__(self, directory, mmap=True):
+        """
+        Open a dataset.
+
+        Args:
+            directory: Directory written by DatasetWriter
+            mmap: Map the shards instead of loading them in memory
+        """
+        with open(os.path.join(directory, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.fields = list(self.meta["fields"])
+        self.options = self.meta.get("observation")  # None for datasets written without them
+
+        mode = "r" if mmap else None
+        self.shards = []
+        for shard in self.meta["shards"]:
+            path = os.path.join(directory, shard["name"])
+            columns = {
+                key: np.load(os.path.join(path, f"{key}.npy"), mmap_mode=mode)
+                for key in self.fields + ["action", "reward", "done"]
+            }
+            columns["transitions"] = np.flatnonzero(np.asarray(columns["action"]) != NO_ACTION)
+            self.shards.append(columns)
+
+        self._offsets = np.cumsum([0] + [len(shard["transitions"]) for shard in self.shards])
+
+    def __len__(self):
+        """Number of transitions."""
+        return int(self._offsets[-1])
+
+    def check(self, env):
+        """
+        Raise ValueError unless the observations are those the environment builds.
+
+        Args:
+            env: SnakeTrainEnv or BatchedSnakeEnv of the agent
+        """
+        if self.options is not None and self.options != env.observer.options:
+            raise ValueError(
+                f"Dataset observations have options {self.options}, the environment {env.observer.options}"
+            )
+        for key, spec in env.observation_spec().items():
+            if key not in self.fields:
+                raise ValueError(f"Dataset observations have no {key!r} field")
+            for shard in self.shards:
+                if shard[key].shape[1:] != spec.shape:
+                    raise ValueError(
+                        f"Dataset {key!r} has shape {shard[key].shape[1:]}, the environment {spec.shape}"
+                    )
+
+    def _gather(self, shard, rows):
+        return {key: np.asarray(shard[key][rows]) for key in self.fields}
+
+    def sample(self, batch_size, rng=None):
+        """
+        Sample transitions uniformly.
+
+        Returns:
+            Dictionary with observations, actions, rewards, next_observations and dones,
+            each observation being a dictionary of batched fields
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        picks = np.sort(rng.integers(0, len(self), size=batch_size))
+        shard_ids = np.searchsorted(self._offsets, picks, side="right") - 1
+
+        parts = []
+        for shard_id in np.unique(shard_ids):
+            shard = self.shards[shard_id]
+            rows = shard["transitions"][picks[shard_ids == shard_id] - self._offsets[shard_id]]
+            parts.append(
+                (
+                    self._gather(shard, rows),
+                    np.asarray(shard["action"][rows]),
+                    np.asarray(shard["reward"][rows]),
+                    self._gather(shard, rows + 1),
+                    np.asarray(shard["done"][rows]),
+                )
+            )
+
+        observations, actions, rewards, next_observations, dones = zip(*parts)
+        return {
+            "observations": {
+                key: np.concatenate([obs[key] for obs in observations]) for key in self.fields
+            },
+            "actions": np.concatenate(actions),
+            "rewards": np.concatenate(rewards),
+            "next_observations": {
+                key: np.concatenate([obs[key] for obs in next_observations])
+                for key in self.fields
+            },
+            "dones": np.concatenate(dones),
+        }
+
+    def time_steps(self, limit=None, discount=0.99):
+        """
+        Yield (time_step, action, next_time_step) in the form agents store them.
+
+        Args:
+            limit: Maximum number of transitions, the most recent ones are kept
+            discount: Discount of the non terminal time steps, as in SnakeTrainEnv
+        """
+        skip = max(0, len(self) - limit) if limit is not None else 0
+        for shard in self.shards:
+            if skip >= len(shard["transitions"]):
+                skip -= len(shard["transitions"])
+                continue
+            action = np.asarray(shard["action"])
+            reward = np.asarray(shard["reward"])
+            done = np.asarray(shard["done"])
+
+            next_time_step = None
+            for row in shard["transitions"][skip:]:
+                if next_time_step is not None and row > 0 and action[row - 1] != NO_ACTION:
+                    # same object as the last next time step, so buffers can see the chain
+                    time_step = next_time_step
+                elif row == 0 or action[row - 1] == NO_ACTION:
+                    time_step = ts.restart(self._row(shard, row))
+                else:
+                    time_step = ts.transition(self._row(shard, row), reward[row - 1], discount=discount)
+
+                next_observation = self._row(shard, row + 1)
+                if done[row]:
+                    next_time_step = ts.termination(next_observation, reward[row])
+                else:
+                    next_time_step = ts.transition(next_observation, reward[row], discount=discount)
+                yield time_step, int(action[row]), next_time_step
+            skip = 0
+
+    def _row(self, shard, row):
+        return {key: np.asarray(shard[key][row]) for key in self.fields}
+
+
+def replay_action(snake):
+    """Action index that moved a snake in the last step of a replay."""
+    if snake.lastkey in KEYS:
+        return KEYS.index(snake.lastkey)
+    return DIRECTION_ACTION[snake.direction]  # no valid key, it kept its direction
+
+
+def build_from_replay(path, writer, players=None, crop_size=None, memory=False, frames=1, reachability=False):
+    """
+    Feed a replay through SnakeTrainEnv, one episode per player.
+
+    The environment sees what a live player would: the game info on reset, its
+    own state each step and the highscores message when its snake dies or the
+    game ends.
+
+    Args:
+        path: Replay file written by server.py --record
+        writer: DatasetWriter receiving the episodes
+        players: Names of the players to convert, all of them by default
+        crop_size, memory, frames, reachability: Observation options, see SnakeTrainEnv.
+            They must be those of the agents the dataset is for
+
+    Returns:
+        Number of transitions written
+    """
+    reader = ReplayReader(path)
+    transitions = 0
+
+    for name in players or reader.header["players"]:
+        env = SnakeTrainEnv(crop_size=crop_size, memory=memory, frames=frames, reachability=reachability)
+        time_step = env.call_reset(reader.game(0).info())
+        writer.begin_episode(time_step)
+
+        action = 0
+        for game, state in reader.frames():
+            snake = game.snakes[name]
+            action = replay_action(snake)
+            if not snake.alive:
+                break
+            time_step = env.call_step(player_state(state, name), action)
+            writer.add(action, time_step)
+            transitions += 1
+
+        time_step = env.call_step({"highscores": []}, action)
+        writer.add(action, time_step)
+        transitions += 1
+
+    return transitions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert replays into a dataset of transitions")
+    parser.add_argument("output", help="Dataset directory")
+    parser.add_argument("replays", nargs="+", help="Replay files or directories of replays")
+    parser.add_argument("--shard-size", type=int, default=SHARD_SIZE)
+    parser.add_argument("--crop", type=int, help="Side of the egocentric observation crop, odd")
+    parser.add_argument("--memory", action="store_true", help="Remember what earlier steps saw")
+    parser.add_argument("--frames", type=int, default=1, help="Last maps stacked in the observations")
+    parser.add_argument("--reachability", action="store_true", help="Add the area and food distance of each move")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    paths = []
+    for path in args.replays:
+        paths += sorted(glob.glob(os.path.join(path, "*.replay"))) if os.path.isdir(path) else [path]
+
+    options = {"crop_size": args.crop, "memory": args.memory, "frames": args.frames, "reachability": args.reachability}
+    writer = DatasetWriter(args.output, args.shard_size, options)
+    total = 0
+    for path in paths:
+        total += build_from_replay(path, writer, **options)
+        logger.info("%s: %s transitions so far", path, total)
+    writer.close()
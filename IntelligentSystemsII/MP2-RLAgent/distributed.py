@@ -0,0 +1,384 @@
+"""
+Actor/learner training: actor processes play with a recent copy of the policy, one learner trains.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import logging
+import multiprocessing as mp
+import queue
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+import tensorflow as tf
+from tf_agents.trajectories import time_step as ts
+
+from batched_snake_env import AGENTS, ENGINES, BatchedSnakeEnv
+from rewards import parse_weights
+from snake_train_env import SnakeTrainEnv
+
+# The layout:
+#
+#   actor 0..N-1   BatchedSnakeEnv (server connections or in-process games) and
+#                  a copy of the agent that only acts. Every game's steps go to
+#                  the learner in segments, and the newest weights are loaded
+#                  between batched steps when the learner published some.
+#   learner        The main process. Stores the segments in the agent's memory,
+#                  calls train_step() and publishes the weights every few updates.
+#
+# Segments travel through a bounded multiprocessing queue, so actors slow down
+# when the learner falls behind. Weights travel through one shared memory block
+# guarded by a lock and stamped with a version number.
+
+SEGMENT_LENGTH = 100  # steps of one game sent at once
+QUEUE_SIZE = 256  # segments waiting for the learner before actors block
+SYNC_EVERY = 50  # learner updates between two weight publications
+PUT_TIMEOUT = 1.0  # seconds between two checks of the stop flag while the queue is full
+# Types of the observation fields in the segments, the other fields are int32
+SEGMENT_DTYPES = {"map": np.uint8, "moves": np.float32}
+
+logger = logging.getLogger("Distributed")
+
+
+class SharedWeights:
+    """A list of arrays in shared memory, written by the learner and read by the actors."""
+
+    def __init__(self, weights, name=None, lock=None, version=None):
+        """
+        Create the block for arrays shaped like `weights`, or attach to it.
+
+        Args:
+            weights: Arrays giving the shapes and types (their values are not copied)
+            name: Name of an existing block, None to create a new one
+            lock: Lock of an existing block
+            version: Version counter of an existing block
+        """
+        self.specs = [(np.shape(array), np.asarray(array).dtype.str) for array in weights]
+        self._sizes = [int(np.prod(shape)) * np.dtype(dtype).itemsize for shape, dtype in self.specs]
+        self._owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self._owner, size=max(1, sum(self._sizes)))
+        self.lock = lock if lock is not None else mp.get_context("spawn").Lock()
+        self.version = version if version is not None else mp.get_context("spawn").Value("q", 0, lock=False)
+
+    def handle(self):
+        """What an actor needs to attach, see attach()."""
+        return self.memory.name, self.specs, self.lock, self.version
+
+    @classmethod
+    def attach(cls, name, specs, lock, version):
+        weights = [np.zeros(shape, dtype=dtype) for shape, dtype in specs]
+        return cls(weights, name, lock, version)
+
+    def _views(self):
+        views, offset = [], 0
+        for (shape, dtype), size in zip(self.specs, self._sizes):
+            views.append(np.ndarray(shape, dtype=dtype, buffer=self.memory.buf, offset=offset))
+            offset += size
+        return views
+
+    def publish(self, weights):
+        with self.lock:
+            for view, array in zip(self._views(), weights):
+                view[...] = array
+            self.version.value += 1
+
+    def fetch(self, seen_version):
+        """Copy of the weights if a version newer than `seen_version` was published, else None."""
+        if self.version.value == seen_version:
+            return None, seen_version
+        with self.lock:
+            return [view.copy() for view in self._views()], self.version.value
+
+    def close(self):
+        self.memory.close()
+        if self._owner:
+            self.memory.unlink()
+
+
+def actor_epsilon(actor_id, num_actors, base=0.4, alpha=7.0):
+    """Fixed exploration rate of an actor, from `base` down to `base ** (1 + alpha)`."""
+    if num_actors == 1:
+        return base
+    return base ** (1 + alpha * actor_id / (num_actors - 1))
+
+
+class SegmentBuilder:
+    """Cuts the steps of one game into segments for the learner."""
+
+    def __init__(self, actor_id, game_id):
+        self.source = (actor_id, game_id)
+        self._observations = []
+        self._actions = []
+        self._rewards = []
+        self._dones = []
+        self._first = True
+
+    def start(self, time_step):
+        self._observations = [time_step.observation]
+        self._first = True
+
+    def add(self, action, next_time_step):
+        self._actions.append(int(action))
+        self._rewards.append(float(next_time_step.reward))
+        self._dones.append(bool(next_time_step.is_last()))
+        self._observations.append(next_time_step.observation)
+
+    def __len__(self):
+        return len(self._actions)
+
+    def pop(self):
+        """The steps gathered so far, the next segment going on from the last observation."""
+        observations = self._observations
+        segment = {
+            "source": self.source,
+            "first": self._first,
+            "observations": {
+                key: np.stack([observation[key] for observation in observations]).astype(
+                    SEGMENT_DTYPES.get(key, np.int32)
+                )
+                for key in observations[0]
+            },
+            "actions": np.array(self._actions, dtype=np.int32),
+            "rewards": np.array(self._rewards, dtype=np.float32),
+            "dones": np.array(self._dones, dtype=bool),
+        }
+        self._observations = [observations[-1]]
+        self._actions, self._rewards, self._dones = [], [], []
+        self._first = False
+        return segment
+
+
+def segment_time_steps(segment, discount=0.99):
+    """
+    Yield (time_step, action, next_time_step) from a segment, as agents store them.
+
+    Consecutive transitions share the time step object, so a ReplayBuffer stores
+    each observation of the segment once.
+    """
+    observations = segment["observations"]
+
+    def row(i):
+        return {key: values[i] for key, values in observations.items()}
+
+    if segment["first"]:
+        time_step = ts.restart(row(0))
+    else:
+        time_step = ts.transition(row(0), 0.0, discount=discount)
+    for i, (action, reward, done) in enumerate(zip(segment["actions"], segment["rewards"], segment["dones"])):
+        if done:
+            next_time_step = ts.termination(row(i + 1), reward)
+        else:
+            next_time_step = ts.transition(row(i + 1), reward, discount=discount)
+        yield time_step, int(action), next_time_step
+        time_step = next_time_step
+
+
+def actor_process(actor_id, num_actors, config, weights_handle, segments, stop):
+    """
+    Play games with the latest published weights and send their steps to the learner.
+
+    Args:
+        actor_id: Index of this actor
+        num_actors: Number of actors, to spread their exploration rates
+        config: Dictionary with agent, envs, server, engine, name, seed, crop, memory, frames,
+            reward_weights and reachability
+        weights_handle: SharedWeights.handle() of the learner
+        segments: Queue to the learner
+        stop: Event set by the learner when training is over
+    """
+    # many actors share the cores, one thread each
+    tf.config.threading.set_intra_op_parallelism_threads(1)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    seed = None if config["seed"] is None else config["seed"] + 1000 * actor_id
+    env = BatchedSnakeEnv(
+        config["envs"], config["server"], f"{config['name']}{actor_id}-", seed,
+        config["crop"], config["memory"], config["frames"], config["reward_weights"], config["reachability"],
+        engine=config["engine"],
+    )
+    agent = AGENTS[config["agent"]](env)
+    if hasattr(agent, "epsilon"):
+        agent.epsilon = actor_epsilon(actor_id, num_actors)
+
+    shared = SharedWeights.attach(*weights_handle)
+    version = -1
+    builders = [SegmentBuilder(actor_id, i) for i in range(env.batch_size)]
+
+    def send(segment):
+        while not stop.is_set():
+            try:
+                segments.put(segment, timeout=PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    try:
+        time_step = env.reset()
+        for builder, game_step in zip(builders, env.time_steps):
+            builder.start(game_step)
+
+        while not stop.is_set():
+            weights, version = shared.fetch(version)
+            if weights is not None:
+                agent.set_weights(weights)
+
+            actions = agent.get_actions(time_step)
+            previous = env.time_steps
+            time_step = env.step(actions)
+
+            for builder, before, action, after in zip(builders, previous, actions, env.time_steps):
+                if before.is_last():  # this game was reset
+                    builder.start(after)
+                    continue
+                builder.add(action, after)
+                if after.is_last() or len(builder) >= SEGMENT_LENGTH:
+                    segment = builder.pop()
+                    if after.is_last():
+                        segment["score"] = int(after.observation["score"])
+                    send(segment)
+    finally:
+        env.close()
+        shared.close()
+        segments.cancel_join_thread()  # do not wait for a learner that stopped reading
+
+
+class Learner:
+    """Trains an agent from the segments of the actors and publishes its weights."""
+
+    def __init__(self, agent, num_actors, config, sync_every=SYNC_EVERY):
+        """
+        Start the actors.
+
+        Args:
+            agent: Agent to train
+            num_actors: Number of actor processes
+            config: Dictionary with agent, envs, server, name, seed, crop, memory, frames, reward_weights
+                and reachability, for the actors
+            sync_every: Updates between two weight publications
+        """
+        self.agent = agent
+        self.sync_every = sync_every
+        self.shared = SharedWeights(agent.get_weights())
+        self.shared.publish(agent.get_weights())
+
+        context = mp.get_context("spawn")  # TensorFlow does not survive a fork
+        self.segments = context.Queue(QUEUE_SIZE)
+        self.stop = context.Event()
+        self.actors = [
+            context.Process(
+                target=actor_process,
+                args=(i, num_actors, config, self.shared.handle(), self.segments, self.stop),
+                daemon=True,
+            )
+            for i in range(num_actors)
+        ]
+        for actor in self.actors:
+            actor.start()
+
+        self.steps = 0
+        self.updates = 0
+        self.scores = []
+
+    def store(self, segment):
+        for time_step, action, next_time_step in segment_time_steps(segment):
+            self.agent.store_experience(time_step, action, next_time_step)
+        self.steps += len(segment["actions"])
+        if "score" in segment:
+            self.scores.append(segment["score"])
+            self.agent.on_episode_end()
+
+    def drain(self, block=False):
+        """Store every segment waiting in the queue, waiting for one if block is set."""
+        stored = 0
+        while True:
+            try:
+                segment = self.segments.get(block=block and stored == 0, timeout=PUT_TIMEOUT)
+            except queue.Empty:
+                return stored
+            self.store(segment)
+            stored += 1
+
+    def train(self, total_steps, log_every=30.0):
+        """Train until the actors played `total_steps` steps."""
+        start = last_log = time.time()
+        while self.steps < total_steps:
+            if not self.drain(block=self.updates == 0) and not any(a.is_alive() for a in self.actors):
+                raise RuntimeError("Every actor stopped")
+
+            if self.agent.train_step() is not None:
+                self.updates += 1
+                if self.updates % self.sync_every == 0:
+                    self.shared.publish(self.agent.get_weights())
+
+            if time.time() - last_log >= log_every:
+                last_log = time.time()
+                elapsed = last_log - start
+                logger.info(
+                    "%s steps (%.0f/s), %s updates (%.1f/s), %s episodes, avg score (last 50): %.2f",
+                    self.steps, self.steps / elapsed, self.updates, self.updates / elapsed,
+                    len(self.scores), np.mean(self.scores[-50:]) if self.scores else 0.0,
+                )
+
+    def close(self):
+        self.stop.set()
+        for actor in self.actors:
+            while actor.is_alive():
+                self.drain()  # an actor blocked on a full queue needs room to exit
+                actor.join(timeout=PUT_TIMEOUT)
+        self.shared.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train with actor processes and one learner")
+    # off-policy agents only: PPO must train on the rollouts of the policy it updates
+    parser.add_argument("--agent", choices=("dqn",), default="dqn")
+    parser.add_argument("--actors", type=int, default=max(1, mp.cpu_count() - 1))
+    parser.add_argument("--envs", type=int, default=4, help="Games played at once by each actor")
+    parser.add_argument("--steps", type=int, default=1_000_000, help="Game steps, over all actors")
+    parser.add_argument("--sync-every", type=int, default=SYNC_EVERY, help="Updates between weight syncs")
+    parser.add_argument("--server", help="host:port of server.py, games run in-process if not set")
+    parser.add_argument("--engine", choices=ENGINES, default="game", help="Simulation of the in-process games")
+    parser.add_argument("--name", default="student")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--crop", type=int, help="Side of the egocentric observation crop, odd")
+    parser.add_argument("--memory", action="store_true", help="Remember what earlier steps saw")
+    parser.add_argument("--frames", type=int, default=1, help="Last maps stacked in the observations")
+    parser.add_argument("--reward-weights", type=parse_weights, help='Weights of the reward terms, e.g. "danger=0,distance=0.5"')
+    parser.add_argument("--reachability", action="store_true", help="Add the area and food distance of each move")
+    parser.add_argument("--output", help="Where to save the policy")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    agent = AGENTS[args.agent](
+        SnakeTrainEnv(crop_size=args.crop, memory=args.memory, frames=args.frames, reachability=args.reachability)
+    )
+    config = {
+        "agent": args.agent,
+        "envs": args.envs,
+        "server": args.server,
+        "engine": args.engine,
+        "name": args.name,
+        "seed": args.seed,
+        "crop": args.crop,
+        "memory": args.memory,
+        "frames": args.frames,
+        "reward_weights": args.reward_weights,
+        "reachability": args.reachability,
+    }
+    learner = Learner(agent, args.actors, config, args.sync_every)
+    try:
+        learner.train(args.steps)
+    finally:
+        learner.close()
+
+    if learner.scores:
+        logger.info(
+            "%s episodes, avg score %.2f, max %s",
+            len(learner.scores), np.mean(learner.scores), max(learner.scores),
+        )
+    output = args.output or f"policy/{args.agent}_agent_distributed"
+    agent.save(output)
+    logger.info("Policy saved: %s", output)
@@ -2,6 +2,7 @@ import asyncio
 import logging
 import random
 from collections import deque
+from datetime import datetime, timedelta
 
 from consts import KILL_SNAKE_POINTS, TIMEOUT, Direction, HISTORY_LEN, Tiles, SuperFood
 from mapa import Map
@@ -18,6 +19,7 @@ class Snake:
     def __init__(self, player_name, x=1, y=1):
         self._name = player_name
         self._body = [(x, y)]
+        self._cells = {(x, y)}  # same cells as _body, for O(1) lookups
         self._spawn_pos = (x, y)
         self._direction: Direction = Direction.EAST
         self._history = deque(maxlen=HISTORY_LEN)
@@ -28,17 +30,25 @@ class Snake:
         self.to_grow = 1
         self.range = 3
 
-    def sight(self, mapa, snakes):
-        in_range = mapa.get_zone(self.head, self.range)
-
-        for snake in snakes:  # mark all snakes in the map
-            if not snake.alive:
-                continue  # ignore dead snakes
-            for x, y in snake.body:
-                if x in in_range and y in in_range[x]:
-                    in_range[x][y] = Tiles.SNAKE
-
-        return in_range
+    def sight(self, mapa, snakes, tiles=None):
+        """
+        Tiles in range of the head, the alive snakes marked as Tiles.SNAKE.
+
+        Args:
+            mapa: Map of the game
+            snakes: Every snake of the game, dead ones being ignored
+            tiles: Map.tiles of the step, drawn from snakes if not given
+        """
+        if tiles is None:
+            tiles = mapa.tiles(snakes)
+        return mapa.get_zone(self.head, self.range, tiles)
+
+    def sight_window(self, mapa, snakes, tiles=None):
+        """Same as sight() but in the compact window form of Map.get_zone_window."""
+        if tiles is None:
+            tiles = mapa.tiles(snakes)
+        x0, y0, window = mapa.get_zone_window(self.head, self.range, tiles)
+        return {"x": x0, "y": y0, "tiles": window}
 
     def grow(self, amount=1):
         self.to_grow += amount
@@ -101,7 +111,7 @@ class Snake:
 
         new_pos = mapa.calc_pos(self.head, direction, traverse=self._traverse)
 
-        if new_pos == self.head or new_pos in self._body:
+        if new_pos == self.head or new_pos in self._cells:
             # if we can't move to the new position, we crashed against a wall
             # or we are crashing against ourselves
             logger.debug(
@@ -114,20 +124,52 @@ class Snake:
             return
 
         self._body.append(new_pos)
+        self._cells.add(new_pos)
         if self.to_grow > 0:  # if we are growing
             self.to_grow -= 1
         elif self.to_grow < 0 and len(self._body) > 3:  # if we are shrinking
             self.to_grow += 1
-            self._body.pop(0)
-            self._body.pop(0)
+            self._cells.discard(self._body.pop(0))
+            self._cells.discard(self._body.pop(0))
         else:  # if we are simply moving
-            self._body.pop(0)
+            self._cells.discard(self._body.pop(0))
 
         self._direction = direction
         self._history.append(new_pos)
 
     def collision(self, pos):
-        return pos in self._body
+        return pos in self._cells
+
+    def snapshot(self):
+        """Everything needed to rebuild this snake, as plain JSON types."""
+        return {
+            "name": self._name,
+            "body": self._body,
+            "spawn": self._spawn_pos,
+            "direction": int(self._direction),
+            "history": list(self._history),
+            "score": self._score,
+            "traverse": self._traverse,
+            "alive": self._alive,
+            "lastkey": self.lastkey,
+            "to_grow": self.to_grow,
+            "range": self.range,
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        snake = cls(snapshot["name"], *snapshot["spawn"])
+        snake._body = [tuple(pos) for pos in snapshot["body"]]
+        snake._cells = set(snake._body)
+        snake._direction = Direction(snapshot["direction"])
+        snake._history.extend(tuple(pos) for pos in snapshot["history"])
+        snake._score = snapshot["score"]
+        snake._traverse = snapshot["traverse"]
+        snake._alive = snapshot["alive"]
+        snake.lastkey = snapshot["lastkey"]
+        snake.to_grow = snapshot["to_grow"]
+        snake.range = snapshot["range"]
+        return snake
 
     def _calc_dir(self, old_pos, new_pos):
         if old_pos[0] < new_pos[0]:
@@ -146,6 +188,21 @@ class Snake:
         return None
 
 
+class StepClock:
+    """Clock driven by the game step instead of the wall clock.
+
+    Every step advances it by exactly 1/game_speed seconds, so a seeded game
+    reports the same timestamps in turbo mode and in real time.
+    """
+
+    def __init__(self, game_speed, start=None):
+        self._game_speed = game_speed
+        self._start = start if start is not None else datetime.now()
+
+    def time(self, step):
+        return self._start + timedelta(seconds=step / self._game_speed)
+
+
 def key2direction(key):
     if key == "w":
         return Direction.NORTH
@@ -159,16 +216,42 @@ def key2direction(key):
 
 
 class Game:
-    def __init__(self, level=1, timeout=TIMEOUT, size=MAP_SIZE, game_speed=GAME_SPEED):
+    def __init__(
+        self,
+        level=1,
+        timeout=TIMEOUT,
+        size=MAP_SIZE,
+        game_speed=GAME_SPEED,
+        turbo=False,
+        step_deadline=None,
+        clock_start=None,
+        compact_sight=False,
+        rng=None,
+        recorder=None,
+    ):
         logger.info(f"Game(level={level})")
         self.initial_level = level
         self._game_speed = game_speed
+        # In turbo mode a step runs as soon as every live snake sent its key,
+        # or when the deadline expires for players that are too slow
+        self._turbo = turbo
+        self._step_deadline = step_deadline if step_deadline else 1.0 / game_speed
+        self._pending_keys = set()
+        self._keys_ready = asyncio.Event()
+        self.clock = StepClock(game_speed, clock_start)
+        # a seeded game is given its clock start and stamps its steps with the clock
+        self._step_clock = turbo or clock_start is not None
+        self._compact_sight = compact_sight
+        # Every random draw of the game goes through its own generator, so a
+        # game can be saved and re-simulated (see replay.py)
+        self._rng = rng if rng is not None else random
+        self._recorder = recorder
         self._running = False
         self._timeout = timeout
         self._step = 0
         self._state = {}
         self._snakes = {}
-        self.map = Map(size=size)
+        self.map = Map(size=size, rng=self._rng)
 
     @property
     def snakes(self):
@@ -186,6 +269,16 @@ class Game:
     def total_steps(self):
         return self._total_steps
 
+    @property
+    def turbo(self):
+        return self._turbo
+
+    def now(self):
+        """Timestamp of the current step, deterministic in turbo mode or with a clock start."""
+        if self._step_clock:
+            return self.clock.time(self._step)
+        return datetime.now()
+
     def start(self, players_names):
         logger.debug("Reset world")
         self._running = True
@@ -195,6 +288,35 @@ class Game:
         }
         for _ in range(FOOD_IN_MAP):
             self.map.spawn_food()
+        if self._recorder:
+            self._recorder.start(self)
+
+    def snapshot(self):
+        """Full game state, including the random generator, as plain JSON types."""
+        version, internal, gauss_next = self._rng.getstate()
+        return {
+            "step": self._step,
+            "running": self._running,
+            "timeout": self._timeout,
+            "level": self.map.level,
+            "rng": [version, list(internal), gauss_next],
+            "map": self.map.snapshot(),
+            "snakes": [snake.snapshot() for snake in self._snakes.values()],
+        }
+
+    def restore(self, snapshot):
+        """Continue the game from a snapshot() taken in this or another process."""
+        version, internal, gauss_next = snapshot["rng"]
+        self._rng.setstate((version, tuple(internal), gauss_next))
+        self._step = snapshot["step"]
+        self._running = snapshot["running"]
+        self._timeout = snapshot["timeout"]
+        self.map = Map.from_snapshot(
+            snapshot["map"], level=snapshot["level"], size=self.map.size, rng=self._rng
+        )
+        self._snakes = {
+            data["name"]: Snake.from_snapshot(data) for data in snapshot["snakes"]
+        }
 
     def stop(self):
         logger.info("GAME OVER")
@@ -207,6 +329,23 @@ class Game:
     def keypress(self, player_name, key):
         self._snakes[player_name].lastkey = key
 
+        if self._turbo:
+            self._pending_keys.add(player_name)
+            if all(
+                name in self._pending_keys
+                for name, snake in self._snakes.items()
+                if snake.alive
+            ):
+                self._keys_ready.set()
+
+    async def _wait_for_keys(self):
+        try:
+            await asyncio.wait_for(self._keys_ready.wait(), self._step_deadline)
+        except asyncio.TimeoutError:
+            logger.debug("[step=%s] Step deadline expired, using last keys", self._step)
+        self._keys_ready.clear()
+        self._pending_keys.clear()
+
     def update_snake(self, name):
         try:
             snake = self._snakes[name]
@@ -273,7 +412,7 @@ class Game:
                     snake1.grow()
                     self.map.spawn_food()
                 elif what_i_ate == Tiles.SUPER:
-                    kind = random.choice(
+                    kind = self._rng.choice(
                         [
                             SuperFood.POINTS,
                             SuperFood.LENGTH,
@@ -284,15 +423,15 @@ class Game:
                     logger.debug("Snake <%s> ate <%s> at position (%s)", name1, kind.name, snake1.head)
 
                     if kind == SuperFood.POINTS:
-                        points = random.randint(-5, 10)
+                        points = self._rng.randint(-5, 10)
                         snake1.score += points 
                         logger.debug("Snake ate superfood and scored: %s", points)
                     elif kind == SuperFood.LENGTH:
-                        extra = random.randint(-2, 2)
+                        extra = self._rng.randint(-2, 2)
                         snake1.grow(extra)
                         logger.debug("Snake ate superfood and grew: %s", extra)
                     elif kind == SuperFood.RANGE:
-                        snake1.range += random.randint(-2, 2)
+                        snake1.range += self._rng.randint(-2, 2)
                         snake1.range = min(max(snake1.range, 2), 6) # range between 2 and 6
                         logger.debug("Snake ate superfood and range changed to: %s", snake1.range)
                     elif kind == SuperFood.TRAVERSE:
@@ -300,12 +439,22 @@ class Game:
                         logger.debug("Snake ate superfood and traverse is: %s", snake1._traverse)
 
     async def next_frame(self):
-        await asyncio.sleep(1.0 / self._game_speed)
+        if self._turbo and self._running:
+            await self._wait_for_keys()
+        else:
+            await asyncio.sleep(1.0 / self._game_speed)
 
         if not self._running:
             logger.info("Waiting for player 1")
             return
 
+        return self.update()
+
+    def update(self):
+        """Advance the game by one step and return the new state."""
+        if self._recorder:
+            self._recorder.tick(self)
+
         self._step += 1
         if self._step == self._timeout:
             self.stop()
@@ -323,6 +472,7 @@ class Game:
 
         self.collision()
 
+        tiles = self.map.tiles(self._snakes.values())  # the sights of every snake
         self._state = {
             "food": self.map.food,
             "players": [snake for snake in self._snakes],
@@ -332,7 +482,11 @@ class Game:
                 {
                     "name": name,
                     "body": snake.body[::-1],
-                    "sight": snake.sight(self.map, self._snakes.values()),
+                    "sight": (
+                        snake.sight_window(self.map, self._snakes.values(), tiles)
+                        if self._compact_sight
+                        else snake.sight(self.map, self._snakes.values(), tiles)
+                    ),
                     "score": snake.score,
                     "range": snake.range,
                     "traverse": snake._traverse,
@@ -345,6 +499,9 @@ class Game:
         if all([not snake.alive for snake in self._snakes.values()]):
             self.stop()
 
+        if self._recorder and not self._running:
+            self._recorder.finish(self)
+
         return self._state
 
     def info(self):
@@ -0,0 +1,377 @@
+"""
+League of frozen policies for self-play: Elo ratings, opponent sampling and evaluation matches.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import json
+import logging
+import multiprocessing as mp
+import os
+import random
+import time
+
+from game import Game
+from policy_runtime import KEYS, NumpyPolicy
+from protocol import player_state
+
+# The league is a directory of checkpoints, policies exported with
+# policy_export.py (see self_play.py), and league.json:
+#
+#   ratings      Elo rating of every checkpoint and of the learner
+#   results      games the learner played against each checkpoint and the
+#                points it took (1 a win, 0.5 a tie), for the opponent sampling
+#   evaluations  evaluation games played by each checkpoint
+#
+# A game is scored when it ends for the learner, or for an evaluation match
+# when every snake died or the game timed out: in every pair of players, the
+# higher score wins. Frozen policies run with NumPy alone, so the evaluation
+# workers and the opponents never load TensorFlow.
+
+LEARNER = "learner"  # the policy being trained, rated like the checkpoints
+INITIAL_RATING = 1000.0
+ELO_K = 32.0  # rating change of a game against one opponent, at most
+PRIORITY_POWER = 2.0  # opponents are drawn with weight (1 - learner's win rate) ** PRIORITY_POWER
+MIN_PRIORITY = 0.01  # so that no checkpoint is never drawn again
+GAME_OVER = {"highscores": []}
+
+logger = logging.getLogger("League")
+
+
+def expected_score(rating, other):
+    """Points a player of `rating` is expected to take against one of rating `other`."""
+    return 1.0 / (1.0 + 10.0 ** ((other - rating) / 400.0))
+
+
+class League:
+    """Checkpoints of a league directory, their ratings and the learner's results against them."""
+
+    def __init__(self, directory):
+        """
+        Open a league, created empty if the directory has none.
+
+        Args:
+            directory: Directory of the checkpoints and league.json
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, "league.json")
+        state = {}
+        if os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+        self.checkpoints = state.get("checkpoints", [])  # names, oldest first
+        self.ratings = {LEARNER: INITIAL_RATING, **state.get("ratings", {})}
+        self.results = state.get("results", {})  # checkpoint -> [games, points of the learner]
+        self.evaluations = state.get("evaluations", {})  # checkpoint -> evaluation games
+        self._policies = {}
+
+    def path(self, name):
+        return os.path.join(self.directory, f"{name}.npz")
+
+    def policy(self, name):
+        """NumpyPolicy of a checkpoint, loaded once."""
+        if name not in self._policies:
+            self._policies[name] = NumpyPolicy(self.path(name))
+        return self._policies[name]
+
+    def add(self, name):
+        """Add the checkpoint written to path(name), starting from the learner's rating."""
+        self.checkpoints.append(name)
+        self.ratings[name] = self.ratings[LEARNER]
+        self.results[name] = [0, 0.0]
+        self.evaluations[name] = 0
+
+    def win_rate(self, name):
+        """Share of the points the learner took against a checkpoint, one tie assumed."""
+        games, points = self.results[name]
+        return (points + 0.5) / (games + 1)
+
+    def sample(self, count, rng=random):
+        """
+        Opponents of the learner for one game, drawn with the checkpoints that
+        beat it most often weighted up.
+        """
+        if not self.checkpoints:
+            raise ValueError(f"League {self.directory} has no checkpoint")
+        weights = [max((1.0 - self.win_rate(name)) ** PRIORITY_POWER, MIN_PRIORITY) for name in self.checkpoints]
+        return rng.choices(self.checkpoints, weights, k=count)
+
+    def pairings(self, count, players=2, rng=random):
+        """
+        Checkpoints of `count` evaluation matches: the least evaluated checkpoint
+        against those rated closest to it, whose results tell the most.
+        """
+        matches = []
+        scheduled = dict(self.evaluations)
+        for _ in range(count if len(self.checkpoints) >= players else 0):
+            first = min(self.checkpoints, key=lambda name: (scheduled[name], rng.random()))
+            others = sorted(
+                (name for name in self.checkpoints if name != first),
+                key=lambda name: (abs(self.ratings[name] - self.ratings[first]), rng.random()),
+            )[:players - 1]
+            matches.append([first, *others])
+            for name in matches[-1]:
+                scheduled[name] += 1
+        return matches
+
+    def record(self, scores, evaluation=False):
+        """
+        Rate one game.
+
+        Args:
+            scores: Final score of each player, by checkpoint name or LEARNER
+            evaluation: Whether it was an evaluation match, counted per checkpoint
+        """
+        names = list(scores)
+        if len(names) < 2:
+            return
+        # every pair is one game, the changes computed from the ratings before it
+        changes = dict.fromkeys(names, 0.0)
+        k = ELO_K / (len(names) - 1)
+        for i, name in enumerate(names):
+            for other in names[i + 1:]:
+                points = 0.5 if scores[name] == scores[other] else float(scores[name] > scores[other])
+                change = k * (points - expected_score(self.ratings[name], self.ratings[other]))
+                changes[name] += change
+                changes[other] -= change
+                if name == LEARNER or other == LEARNER:
+                    checkpoint = other if name == LEARNER else name
+                    learner_points = points if name == LEARNER else 1.0 - points
+                    self.results[checkpoint][0] += 1
+                    self.results[checkpoint][1] += learner_points
+        for name, change in changes.items():
+            self.ratings[name] += change
+            if evaluation:
+                self.evaluations[name] += 1
+
+    def save(self):
+        path = os.path.join(self.directory, "league.json")
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(
+                {
+                    "checkpoints": self.checkpoints,
+                    "ratings": self.ratings,
+                    "results": self.results,
+                    "evaluations": self.evaluations,
+                },
+                f,
+                indent=2,
+            )
+        os.replace(f"{path}.tmp", path)  # never a half written league
+
+    def table(self):
+        """One line per player, best rated first."""
+        lines = []
+        for name in sorted(self.ratings, key=self.ratings.get, reverse=True):
+            line = f"{name:>20} {self.ratings[name]:7.1f}"
+            if name in self.results:
+                games = self.results[name][0]
+                line += f"  learner won {100 * self.win_rate(name):3.0f}% of {games}, {self.evaluations[name]} evaluations"
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class Opponents:
+    """Snakes of a game played by frozen policies, each with its own observer."""
+
+    def __init__(self, game, info, players):
+        """
+        Args:
+            game: Started Game
+            info: Its game info
+            players: {snake name: NumpyPolicy}
+        """
+        self.game = game
+        self.policies = players
+        self.observers = {name: policy.observer(info) for name, policy in players.items()}
+        self.observations = {name: observer.reset(info) for name, observer in self.observers.items()}
+        self.actions = dict.fromkeys(players, 0)
+
+    def alive(self):
+        return [name for name in self.policies if self.game.snakes[name].alive]
+
+    def press(self):
+        """Send the key of every live snake."""
+        for name in self.alive():
+            self.actions[name] = self.policies[name].action(self.observations[name])
+            self.game.keypress(name, KEYS[self.actions[name]])
+
+    def observe(self, state):
+        """Observations of the step the game just played."""
+        for name in self.alive():
+            self.observations[name] = self.observers[name].step(player_state(state, name), self.actions[name])
+
+
+class LeagueGame:
+    """
+    One game of the learner against checkpoints drawn from a league, with the
+    reset, step and close of batched_snake_env.LocalGame. The opponents play in
+    this process, and each game is rated when the learner's episode ends.
+    """
+
+    def __init__(self, league, name="student", seed=None, opponents=1, **game_args):
+        """
+        Initialize the game.
+
+        Args:
+            league: League to draw the opponents from and record the results in
+            name: Name of the learner's snake
+            seed: Seed of the games and of the opponent draws
+            opponents: Number of opponents in each game
+            game_args: Extra Game() arguments, such as timeout or size
+        """
+        self.league = league
+        self.name = name
+        self.opponents = opponents
+        self.game_args = game_args
+        self._rng = random.Random(seed)
+        self._game = None
+        self._players = None
+        self._checkpoints = {}  # snake name -> checkpoint
+        self.games = 0
+
+    async def reset(self):
+        """Start a game against new opponents and return its info."""
+        drawn = self.league.sample(self.opponents, self._rng)
+        self._checkpoints = {f"{checkpoint}#{i}": checkpoint for i, checkpoint in enumerate(drawn)}
+        self._game = Game(rng=self._rng, compact_sight=True, **self.game_args)
+        self._game.start([self.name, *self._checkpoints])
+        info = self._game.info()
+        self._players = Opponents(
+            self._game, info, {name: self.league.policy(checkpoint) for name, checkpoint in self._checkpoints.items()}
+        )
+        return info
+
+    async def step(self, key):
+        """Play a key and the opponents' keys, and return the next message the learner would receive."""
+        game = self._game
+        if game is None:
+            return GAME_OVER
+        if game.running:
+            self._players.press()
+            game.keypress(self.name, key)
+            state = game.update()
+            if game.snakes[self.name].alive:
+                self._players.observe(state)
+                return player_state(state, self.name)
+        self._finish()
+        return GAME_OVER
+
+    def _finish(self):
+        game, self._game = self._game, None
+        score = game.snakes[self.name].score
+        # one game against each opponent, so a checkpoint drawn twice is rated twice
+        for name, checkpoint in self._checkpoints.items():
+            self.league.record({LEARNER: score, checkpoint: game.snakes[name].score})
+        self.games += 1
+
+    async def close(self):
+        self._game = None
+
+
+_policies = {}  # checkpoints loaded by a match worker
+
+
+def play_match(paths, seed=None, timeout=None):
+    """
+    Play one game between exported policies to its end, in a worker process.
+
+    Args:
+        paths: Bundle of each snake
+        seed: Seed of the game
+        timeout: Steps of the game, that of Game by default
+
+    Returns:
+        Final score of each snake, in the order of paths
+    """
+    for path in paths:
+        if path not in _policies:
+            _policies[path] = NumpyPolicy(path)
+    game = Game(rng=random.Random(seed), compact_sight=True, **({"timeout": timeout} if timeout else {}))
+    names = [f"p{i}" for i in range(len(paths))]
+    game.start(names)
+    players = Opponents(game, game.info(), {name: _policies[path] for name, path in zip(names, paths)})
+    while game.running:
+        players.press()
+        state = game.update()
+        players.observe(state)
+    return [game.snakes[name].score for name in names]
+
+
+class MatchScheduler:
+    """Plays evaluation matches between the checkpoints of a league in worker processes."""
+
+    def __init__(self, league, workers=2, players=2, timeout=None):
+        """
+        Start the workers.
+
+        Args:
+            league: League whose checkpoints play and whose ratings are updated
+            workers: Number of worker processes
+            players: Snakes in each match
+            timeout: Steps of each match, that of Game by default
+        """
+        self.league = league
+        self.players = players
+        self.timeout = timeout
+        self._pool = mp.get_context("spawn").Pool(workers)
+        self._pending = []  # (checkpoints, AsyncResult)
+        self._rng = random.Random()
+
+    def schedule(self, count):
+        """Queue `count` matches, chosen by League.pairings()."""
+        for names in self.league.pairings(count, self.players, self._rng):
+            paths = [self.league.path(name) for name in names]
+            result = self._pool.apply_async(play_match, (paths, self._rng.getrandbits(32), self.timeout))
+            self._pending.append((names, result))
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    def collect(self, wait=False):
+        """Rate the matches that ended, all of them if wait is set, and return how many."""
+        done = 0
+        for names, result in list(self._pending):
+            if not (wait or result.ready()):
+                continue
+            self._pending.remove((names, result))
+            try:
+                scores = result.get()
+            except Exception as e:  # a broken checkpoint should not stop the training
+                logger.error("Match %s failed: %s", names, e)
+                continue
+            # a checkpoint playing itself is not rated
+            if len(set(names)) == len(names):
+                self.league.record(dict(zip(names, scores)), evaluation=True)
+            done += 1
+        return done
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rate the checkpoints of a league with evaluation matches")
+    parser.add_argument("league", help="League directory, see self_play.py")
+    parser.add_argument("--matches", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=max(1, mp.cpu_count() - 1))
+    parser.add_argument("--players", type=int, default=2, help="Snakes in each match")
+    parser.add_argument("--timeout", type=int, help="Steps of each match")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    league = League(args.league)
+    scheduler = MatchScheduler(league, args.workers, args.players, args.timeout)
+    start = time.time()
+    try:
+        scheduler.schedule(args.matches)
+        played = scheduler.collect(wait=True)
+    finally:
+        scheduler.close()
+    league.save()
+    logger.info("%s matches in %.0fs\n%s", played, time.time() - start, league.table())
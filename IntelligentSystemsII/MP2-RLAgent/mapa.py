@@ -2,21 +2,59 @@ import logging
 import random
 import math
 
+import numpy as np
+
 from consts import Direction, Tiles, VITAL_SPACE, NEST_SIZE
 
 logger = logging.getLogger("Map")
 logger.setLevel(logging.DEBUG)
 
+# Cells seen from the centre at each sight range, as (dx, dy) offsets
+_ZONE_OFFSETS: dict[int, list[tuple[int, int]]] = {}
+# Same disc as a (2 * size + 1) square of booleans, indexed [dx + size][dy + size]
+_ZONE_MASKS: dict[int, list[list[bool]]] = {}
+# Same offsets and disc as arrays, to index the tile grids of Map.tiles
+_ZONE_ARRAYS: dict[int, tuple[np.ndarray, np.ndarray, np.ndarray]] = {}
+
+
+def zone_offsets(size: int) -> list[tuple[int, int]]:
+    """Offsets of the cells within euclidean distance `size`, computed once per size."""
+    if size not in _ZONE_OFFSETS:
+        _ZONE_OFFSETS[size] = [
+            (i, j)
+            for i in range(-size, size + 1)
+            for j in range(-size, size + 1)
+            if math.dist((0, 0), (i, j)) <= size
+        ]
+        _ZONE_MASKS[size] = [
+            [math.dist((0, 0), (i, j)) <= size for j in range(-size, size + 1)]
+            for i in range(-size, size + 1)
+        ]
+        offsets = np.array(_ZONE_OFFSETS[size], dtype=np.int64).reshape(-1, 2)
+        _ZONE_ARRAYS[size] = (offsets[:, 0], offsets[:, 1], np.array(_ZONE_MASKS[size]))
+    return _ZONE_OFFSETS[size]
+
+
+def zone_mask(size: int) -> list[list[bool]]:
+    zone_offsets(size)
+    return _ZONE_MASKS[size]
+
+
+for _size in range(2, 7):  # every range a snake can have
+    zone_offsets(_size)
+
 class Map:
     def __init__(
         self,
         level=1,
         size=(VITAL_SPACE + 10, VITAL_SPACE + 10),
         mapa=None,
+        rng=None,
     ):
         assert size[0] > VITAL_SPACE + 9
         assert size[1] > VITAL_SPACE + 9
 
+        self._rng = rng if rng is not None else random
         self._level = level
         self._size = size
         self._stones = []
@@ -29,17 +67,17 @@ class Map:
 
             # add stones
             for _ in range(10):
-                x, y = random.randint(0, self.hor_tiles - 1), random.randint(
+                x, y = self._rng.randint(0, self.hor_tiles - 1), self._rng.randint(
                     0, self.ver_tiles - 1
                 )
                 wall_length = 5
                 for yy in range(
-                    y, (y + random.choice([-wall_length, wall_length])) % self.ver_tiles
+                    y, (y + self._rng.choice([-wall_length, wall_length])) % self.ver_tiles
                 )[:wall_length]:
                     self.map[x][yy] = Tiles.STONE
                     self._stones.append((x, yy))
                 for xx in range(
-                    x, (x + random.choice([-wall_length, wall_length])) % self.hor_tiles
+                    x, (x + self._rng.choice([-wall_length, wall_length])) % self.hor_tiles
                 )[:wall_length]:
                     self.map[xx][y] = Tiles.STONE
                     self._stones.append((xx, y))
@@ -47,27 +85,30 @@ class Map:
         else:
             logger.info("Loading MAP")
             self.map = mapa
+        self.grid = np.array(self.map, dtype=np.int8)  # self.map as an array, kept in step with it
 
     @property
     def food(self):
         return [(x, y, self.map[x][y].name) for x, y in self._food]
 
     def spawn_snake(self):
-        x = random.randint(0, self.hor_tiles - 1)
-        y = random.randint(0, self.ver_tiles - 1)
+        x = self._rng.randint(0, self.hor_tiles - 1)
+        y = self._rng.randint(0, self.ver_tiles - 1)
         while any((x, y) in nest for nest in self._snake_nests):
-            x = random.randint(0, self.hor_tiles - 1)
-            y = random.randint(0, self.ver_tiles - 1)
-        self._snake_nests.append([(a, b) for a in range(x - NEST_SIZE, x + NEST_SIZE) for b in range(y - NEST_SIZE, y + NEST_SIZE)])
+            x = self._rng.randint(0, self.hor_tiles - 1)
+            y = self._rng.randint(0, self.ver_tiles - 1)
+        self._snake_nests.append({(a, b) for a in range(x - NEST_SIZE, x + NEST_SIZE) for b in range(y - NEST_SIZE, y + NEST_SIZE)})
         return x, y
 
     def spawn_food(self, food_type=Tiles.FOOD):
-        x = random.randint(0, self.hor_tiles - 1)
-        y = random.randint(0, self.ver_tiles - 1)
-        while (x, y) in self._food or (x, y) in self._stones:
-            x = random.randint(0, self.hor_tiles - 1)
-            y = random.randint(0, self.ver_tiles - 1)
+        x = self._rng.randint(0, self.hor_tiles - 1)
+        y = self._rng.randint(0, self.ver_tiles - 1)
+        # food and stones are already on the tiles, no need to scan their lists
+        while self.map[x][y] in (Tiles.FOOD, Tiles.SUPER, Tiles.STONE):
+            x = self._rng.randint(0, self.hor_tiles - 1)
+            y = self._rng.randint(0, self.ver_tiles - 1)
         self.map[x][y] = food_type
+        self.grid[x, y] = food_type
         self._food.append((x, y))
         logger.debug("Food spawned at %s", self._food[-1])
 
@@ -75,6 +116,7 @@ class Map:
         x, y = pos
         old = self.map[x][y]
         self.map[x][y] = Tiles.PASSAGE
+        self.grid[x, y] = Tiles.PASSAGE
         self._food.remove((x, y))
         return old
 
@@ -91,6 +133,30 @@ class Map:
 
     def __setstate__(self, state):
         self.map = state
+        self.grid = np.array(self.map, dtype=np.int8)
+
+    def snapshot(self):
+        """Everything needed to rebuild this map, as plain JSON types."""
+        return {
+            "map": [[int(tile) for tile in column] for column in self.map],
+            "stones": self._stones,
+            "food": self._food,
+            "nests": [sorted(nest) for nest in self._snake_nests],
+        }
+
+    @classmethod
+    def from_snapshot(cls, snapshot, level=1, size=None, rng=None):
+        size = size or (len(snapshot["map"]), len(snapshot["map"][0]))
+        mapa = cls(
+            level=level,
+            size=tuple(size),
+            mapa=[[Tiles(tile) for tile in column] for column in snapshot["map"]],
+            rng=rng,
+        )
+        mapa._stones = [tuple(stone) for stone in snapshot["stones"]]
+        mapa._food = [tuple(food) for food in snapshot["food"]]
+        mapa._snake_nests = [{tuple(cell) for cell in nest} for nest in snapshot["nests"]]
+        return mapa
 
     @property
     def size(self):
@@ -108,20 +174,51 @@ class Map:
         x, y = pos
         return self.map[x][y]
 
-    def get_zone(self, pos: tuple[int, int], size: int):
-        zone: dict[int, dict[int, Tiles]] = {}
+    def tiles(self, snakes=()):
+        """The tiles as an array indexed [x, y], the bodies of the alive snakes drawn as Tiles.SNAKE.
+
+        Drawn once per step and shared by the sights of every snake.
+        """
+        grid = self.grid.copy()
+        for snake in snakes:
+            if snake.alive:
+                xs, ys = np.array(snake.body, dtype=np.int64).reshape(-1, 2).T
+                grid[xs, ys] = Tiles.SNAKE
+        return grid
+
+    def get_zone(self, pos: tuple[int, int], size: int, tiles=None):
+        """Tiles within distance size of pos, as {x: {y: tile}}, from `tiles` (see
+        Map.tiles) if given, otherwise from the map alone."""
+        zone: dict[int, dict[int, int]] = {}
         x, y = pos
-        for i in range(x - size, x + size + 1):
-            for j in range(y - size, y + size + 1):
-                if math.dist((x, y), (i, j)) <= size:
-                    ii = i % self.hor_tiles
-                    jj = j % self.ver_tiles
-                    if ii not in zone:
-                        zone[ii] = {}
-                    zone[ii][jj] = self.map[ii][jj]
+        zone_offsets(size)
+        dx, dy, _ = _ZONE_ARRAYS[size]
+        xs = (x + dx) % self.hor_tiles
+        ys = (y + dy) % self.ver_tiles
+        grid = self.grid if tiles is None else tiles
+        for ii, jj, tile in zip(xs.tolist(), ys.tolist(), grid[xs, ys].tolist()):
+            if ii not in zone:
+                zone[ii] = {}
+            zone[ii][jj] = tile
 
         return zone
 
+    def get_zone_window(self, pos: tuple[int, int], size: int, tiles=None):
+        """Compact form of get_zone: the (2 * size + 1) square around pos.
+
+        Returns the wrapped top-left corner and the tiles column by column,
+        like self.map, with -1 on the cells outside the sight disc.
+        """
+        x, y = pos
+        x0 = (x - size) % self.hor_tiles
+        y0 = (y - size) % self.ver_tiles
+        zone_offsets(size)
+        visible = _ZONE_ARRAYS[size][2]
+        grid = self.grid if tiles is None else tiles
+        square = np.arange(-size, size + 1)
+        window = np.take(np.take(grid, x + square, axis=0, mode="wrap"), y + square, axis=1, mode="wrap")
+        return x0, y0, np.where(visible, window, -1).tolist()
+
     def is_blocked(self, pos, traverse):
         x, y = pos
         if not traverse and (
@@ -0,0 +1,735 @@
+"""
+Vectorized conversion of the server's player state into SnakeTrainEnv observations.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+
+from consts import Tiles
+
+HEAD = 1  # the map marks the head with 1 and the rest of the body with Tiles.SNAKE
+MAX_TILE = Tiles.SNAKE
+MAX_AGE = 255  # steps since a cell was seen, capped to fit the uint8 maps
+
+# Channels of the egocentric encoding, AGE only with a BeliefMap
+STONE, FOOD, SUPER, BODY, OTHERS, UNKNOWN, AGE = range(7)
+CHANNELS = 6
+TILE_CHANNELS = {Tiles.STONE: STONE, Tiles.FOOD: FOOD, Tiles.SUPER: SUPER, Tiles.SNAKE: OTHERS}
+
+# (dx, dy) of the actions 0=up, 1=down, 2=left, 3=right, as the server moves the snake
+MOVES = ((0, -1), (0, 1), (-1, 0), (1, 0))
+# Per move: share of the map reachable after it, 1 / (1 + length of the path to the nearest food through it)
+MOVE_FEATURES = 2
+REBUILD_CHANGES = 16  # cells changing in one step above which the areas are labelled again
+
+
+def sight_cells(sight, width, height):
+    """
+    Cells of a sight as (xs, ys, tiles) arrays, in game coordinates.
+
+    Args:
+        sight: Either the {x: {y: tile}} dict (keys are strings after JSON) or the
+            compact {"x", "y", "tiles"} window, where unseen tiles are -1
+        width, height: Map size, to wrap the window around the edges
+    """
+    if not sight:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+
+    if "tiles" in sight:
+        tiles = np.asarray(sight["tiles"], dtype=np.int64)
+        i, j = np.nonzero(tiles >= 0)
+        return (sight["x"] + i) % width, (sight["y"] + j) % height, tiles[i, j]
+
+    cells = np.array(
+        [(int(x), int(y), tile) for x, column in sight.items() for y, tile in column.items()],
+        dtype=np.int64,
+    ).reshape(-1, 3)
+    return cells[:, 0], cells[:, 1], cells[:, 2]
+
+
+class ObservationBuilder:
+    """
+    Builds the observation map of each step in one reusable uint8 buffer.
+
+    The map has the game's shape, (width, height) = (48, 24) by default. The
+    body is written at map[x, y], while the sight is written at map[y, x] and
+    only where x < height, the layout SnakeTrainEnv has always given its
+    policies (BatchedGame reproduces it too). The food position and the danger
+    mask are taken from the map as it is built, for the rewards.
+    """
+
+    def __init__(self, shape):
+        """
+        Initialize the builder.
+
+        Args:
+            shape: Shape of the map, the game's (width, height)
+        """
+        self.shape = tuple(shape)
+        self._grid = np.zeros(self.shape, dtype=np.uint8)
+        self.food = None  # [x, y] of the first food of the map, as a row-major scan finds it
+        self.food_cells = np.zeros((0, 2), dtype=np.int64)  # [row, column] of every food
+        self.danger = np.zeros(self.shape, dtype=bool)  # body cells
+        self.sight = sight_cells(None, *self.shape)  # (xs, ys, tiles) of the last build
+
+    def _index(self, grid):
+        food = np.flatnonzero(grid == Tiles.FOOD)
+        self.food_cells = np.stack(np.divmod(food, self.shape[1]), axis=1)
+        if food.size:
+            row, column = divmod(int(food[0]), self.shape[1])
+            self.food = [column, row]
+        else:
+            self.food = None
+        self.danger = grid == Tiles.SNAKE
+
+    def from_map(self, game_map):
+        """Map of the game info sent at reset, returned as a new array."""
+        grid = np.zeros(self.shape, dtype=np.uint8)
+        game_map = np.asarray(game_map, dtype=np.uint8)
+        if game_map.ndim == 2:
+            rows = min(game_map.shape[0], self.shape[0])
+            columns = min(game_map.shape[1], self.shape[1])
+            grid[:rows, :columns] = game_map[:rows, :columns]
+        self._index(grid)
+        return grid
+
+    def build(self, sight, body):
+        """
+        Map of one step, returned as a new array (observations are kept by the agents).
+
+        Args:
+            sight: Sight of the player state, in either form
+            body: Body of the snake, head first, as [x, y] cells
+        """
+        rows, columns = self.shape
+        grid = self._grid
+        grid.fill(Tiles.PASSAGE)
+
+        xs, ys, tiles = self.sight = sight_cells(sight, rows, columns)
+        seen = (xs >= 0) & (xs < columns) & (ys >= 0) & (ys < rows)
+        grid[ys[seen], xs[seen]] = np.clip(tiles[seen], 0, MAX_TILE)
+        self._write_body(grid, body)
+
+        self._index(grid)
+        return grid.copy()
+
+    def build_memory(self, belief, body):
+        """
+        Map of one step from a BeliefMap, shape (*shape, 2): the remembered tiles in
+        the layout of build(), then how many steps ago each cell was seen.
+
+        Does not change the food position and danger mask, which stay those of
+        the current sight.
+        """
+        rows, columns = self.shape
+        width, height = belief.map_size
+        nx, ny = min(width, columns), min(height, rows)
+        grid = np.zeros((*self.shape, 2), dtype=np.uint8)
+        grid[..., 1] = MAX_AGE
+        grid[:ny, :nx, 0] = belief.tiles[:nx, :ny].T
+        grid[:ny, :nx, 1] = belief.ages(np.s_[:nx, :ny]).T
+        self._write_body(grid[..., 0], body)
+        return grid
+
+    def _write_body(self, grid, body):
+        if not len(body):
+            return
+        rows, columns = self.shape
+        cells = np.asarray(body, dtype=np.int64).reshape(-1, 2)
+        values = np.full(len(cells), Tiles.SNAKE, dtype=np.uint8)
+        values[0] = HEAD
+        inside = (cells[:, 0] >= 0) & (cells[:, 0] < rows) & (cells[:, 1] >= 0) & (cells[:, 1] < columns)
+        grid[cells[inside, 0], cells[inside, 1]] = values[inside]
+
+
+class BeliefMap:
+    """
+    Everything seen so far in an episode, in game coordinates, and when.
+
+    update() only writes the cells of the sight, so a step costs O(sight)
+    whatever the size of the map. Ages are worked out when read, from the step
+    each cell was last seen. Stones of the game info map are known from the
+    start, cells never seen have the age MAX_AGE.
+    """
+
+    def __init__(self, map_size):
+        """
+        Initialize the belief.
+
+        Args:
+            map_size: Size of the game, (width, height)
+        """
+        self.map_size = tuple(map_size)
+        self.reset()
+
+    def reset(self, game_map=None):
+        """Forget everything but the stones of the map sent in the game info."""
+        self.tiles = np.zeros(self.map_size, dtype=np.uint8)
+        self.seen_at = np.full(self.map_size, -1, dtype=np.int64)
+        self.step = 0
+        game_map = np.asarray(game_map if game_map is not None else [])
+        if game_map.ndim == 2:
+            rows = min(game_map.shape[0], self.map_size[0])
+            columns = min(game_map.shape[1], self.map_size[1])
+            stones = game_map[:rows, :columns] == Tiles.STONE
+            self.tiles[:rows, :columns][stones] = Tiles.STONE
+            self.seen_at[:rows, :columns][stones] = 0
+
+    def update(self, xs, ys, tiles):
+        """Remember the cells of one step's sight, given as sight_cells() returns them."""
+        self.step += 1
+        width, height = self.map_size
+        inside = (xs >= 0) & (xs < width) & (ys >= 0) & (ys < height)
+        xs, ys = xs[inside], ys[inside]
+        self.tiles[xs, ys] = np.clip(tiles[inside], 0, MAX_TILE)
+        self.seen_at[xs, ys] = self.step
+
+    def known(self, index=np.s_[:]):
+        return self.seen_at[index] >= 0
+
+    def ages(self, index=np.s_[:]):
+        """Steps since the cells at `index` were seen, MAX_AGE at most, as uint8."""
+        seen_at = self.seen_at[index]
+        ages = np.minimum(self.step - seen_at, MAX_AGE)
+        ages[seen_at < 0] = MAX_AGE
+        return ages.astype(np.uint8)
+
+
+class EgocentricEncoder:
+    """
+    One-hot crop of the world centred on the head, shape (size, size, channels).
+
+    Axis 0 goes along x and axis 1 along y, the head being at the centre and
+    the crop wrapping around the map edges like the sight does. The channels
+    are stones (from the sight and the static map of the game info), food,
+    superfood, our own body, other snakes, and cells outside the sight. With a
+    BeliefMap the tiles are the remembered ones, unknown cells are those never
+    seen, and an AGE channel tells how many steps ago each cell was seen.
+    """
+
+    def __init__(self, size, map_size, memory=False):
+        """
+        Initialize the encoder.
+
+        Args:
+            size: Side of the crop, odd so the head is in the middle
+            map_size: Size of the game, (width, height)
+            memory: Whether encode() is given a BeliefMap, adding the AGE channel
+        """
+        if size % 2 == 0:
+            raise ValueError(f"The crop size must be odd, got {size}")
+        self.size = size
+        self.map_size = tuple(map_size)
+        self.channels = CHANNELS + 1 if memory else CHANNELS
+        self.stones = np.zeros(self.map_size, dtype=bool)
+        self._offsets = np.arange(size) - size // 2
+
+    def set_map(self, game_map):
+        """Remember the stones of the map sent in the game info."""
+        self.stones = np.zeros(self.map_size, dtype=bool)
+        game_map = np.asarray(game_map)
+        if game_map.ndim == 2:
+            rows = min(game_map.shape[0], self.map_size[0])
+            columns = min(game_map.shape[1], self.map_size[1])
+            self.stones[:rows, :columns] = game_map[:rows, :columns] == Tiles.STONE
+
+    def empty(self):
+        """Encoding with nothing known, before the first step."""
+        crop = np.zeros((self.size, self.size, self.channels), dtype=np.uint8)
+        crop[..., UNKNOWN] = 1
+        if self.channels > CHANNELS:
+            crop[..., AGE] = MAX_AGE
+        return crop
+
+    def _crop_cells(self, xs, ys, head):
+        """Crop coordinates of world cells and which of them fall inside the crop."""
+        width, height = self.map_size
+        radius = self.size // 2
+        dx = (xs - head[0] + width // 2) % width - width // 2
+        dy = (ys - head[1] + height // 2) % height - height // 2
+        inside = (np.abs(dx) <= radius) & (np.abs(dy) <= radius)
+        return dx[inside] + radius, dy[inside] + radius, inside
+
+    def encode(self, sight, body, belief=None):
+        """
+        Encode one step.
+
+        Args:
+            sight: (xs, ys, tiles) arrays of the visible cells, see sight_cells()
+            body: Body of the snake, head first, as [x, y] cells
+            belief: BeliefMap already updated with this sight, if the encoder has memory
+        """
+        if not len(body):
+            return self.empty()
+        width, height = self.map_size
+        cells = np.asarray(body, dtype=np.int64).reshape(-1, 2)
+        head = cells[0]
+        crop = np.zeros((self.size, self.size, self.channels), dtype=np.uint8)
+        window = np.ix_((head[0] + self._offsets) % width, (head[1] + self._offsets) % height)
+
+        if belief is not None:
+            tiles = belief.tiles[window]
+            for tile, channel in TILE_CHANNELS.items():
+                crop[..., channel] = tiles == tile
+            crop[..., UNKNOWN] = ~belief.known(window)
+            crop[..., AGE] = belief.ages(window)
+        else:
+            crop[..., STONE] = self.stones[window]
+
+            xs, ys, tiles = sight
+            cx, cy, inside = self._crop_cells(xs, ys, head)
+            tiles = tiles[inside]
+            seen = np.zeros((self.size, self.size), dtype=bool)
+            seen[cx, cy] = True
+            crop[..., UNKNOWN] = ~seen
+            for tile, channel in TILE_CHANNELS.items():
+                match = tiles == tile
+                crop[cx[match], cy[match], channel] = 1
+
+        # the sight shows our own body as a snake too
+        bx, by, _ = self._crop_cells(cells[:, 0], cells[:, 1], head)
+        crop[bx, by, OTHERS] = 0
+        crop[bx, by, BODY] = 1
+        return crop
+
+
+class FrameStack:
+    """
+    The last k maps of an episode, stacked along the channel axis, oldest first.
+
+    The frames live in one preallocated ring: a step writes its map over the
+    oldest frame and nothing is shifted. A map of shape (rows, columns) or
+    (rows, columns, channels) gives stacks of shape (rows, columns, k * channels),
+    frame f taking channels f * channels to (f + 1) * channels. Before k steps
+    were seen the first map of the episode fills the older frames.
+    """
+
+    def __init__(self, frames, frame_shape, dtype=np.uint8):
+        """
+        Initialize the stack.
+
+        Args:
+            frames: Number of frames k
+            frame_shape: Shape of one map
+            dtype: Type of the maps
+        """
+        self.frames = frames
+        self.frame_shape = tuple(frame_shape)
+        rows, columns = self.frame_shape[:2]
+        channels = self.frame_shape[2] if len(self.frame_shape) == 3 else 1
+        self.shape = (rows, columns, frames * channels)
+        self._ring = np.zeros((rows, columns, frames, channels), dtype=dtype)
+        self._newest = frames - 1
+        self._order = np.arange(frames)
+
+    def _frame(self, game_map):
+        return np.asarray(game_map).reshape(*self.shape[:2], -1)
+
+    def reset(self, game_map):
+        """Start an episode with its first map in every frame."""
+        self._ring[:] = self._frame(game_map)[:, :, None, :]
+        self._newest = self.frames - 1
+        return self.stacked()
+
+    def push(self, game_map):
+        """Add the map of a step over the oldest frame."""
+        self._newest = (self._newest + 1) % self.frames
+        self._ring[:, :, self._newest] = self._frame(game_map)
+        return self.stacked()
+
+    def stacked(self):
+        """The stack as a new array, observations being kept by the agents."""
+        oldest_first = (self._order + self._newest + 1) % self.frames
+        return self._ring[:, :, oldest_first].reshape(self.shape)
+
+
+class Reachability:
+    """
+    For each move, the free area it leads into and the path distance from it to
+    the nearest food, by flood fill over the cells not taken by a snake (nor by a
+    stone without traverse), wrapping around the edges with traverse.
+
+    The connected free areas are kept labelled between steps. A cell the tail
+    frees joins or merges the areas next to it, and a cell the head takes only
+    shrinks its area, unless its free neighbours are not linked around it, when
+    that area is flooded again in case it was split. The food distances come
+    from a flood from the food cells, stopped once every move is reached.
+    Food is remembered where it was seen until a sight shows the cell without it.
+    """
+
+    def __init__(self, map_size):
+        """
+        Args:
+            map_size: Size of the game, (width, height)
+        """
+        self.map_size = width, height = tuple(map_size)
+        self.cells = width * height
+        # cells are x * height + y, the index `cells` stands for anything off the map
+        x, y = np.divmod(np.arange(self.cells), height)
+        self._neighbours = {}
+        self._rings = {}
+        for traverse in (False, True):
+            def cell(dx, dy):
+                nx, ny = x + dx, y + dy
+                if traverse:
+                    return (nx % width) * height + ny % height
+                inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+                return np.where(inside, nx * height + ny, self.cells)
+
+            self._neighbours[traverse] = np.append(
+                np.stack([cell(dx, dy) for dx, dy in MOVES], axis=1), [[self.cells] * 4], axis=0
+            )
+            # the 8 cells around each cell, in order: N, NE, E, SE, S, SW, W, NW
+            ring = ((0, -1), (1, -1), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1))
+            self._rings[traverse] = np.stack([cell(dx, dy) for dx, dy in ring], axis=1)
+
+        self.stones = np.zeros(self.cells + 1, dtype=bool)
+        self.food = np.zeros(self.cells + 1, dtype=bool)
+        self.snakes = np.zeros(self.cells + 1, dtype=bool)  # bodies of every snake
+        self.labels = np.full(self.cells + 1, -1, dtype=np.int64)  # area of each free cell, -1 if taken
+        self.sizes = []  # cells of each area
+        self.traverse = None
+        self.rebuilds = 0  # full labellings, for profiling
+        self._slots = np.zeros(self.cells + 1, dtype=np.int64)  # scratch of flood()
+
+    def reset(self, game_map):
+        """Forget the last game, starting from the stones and food of the game info map."""
+        width, height = self.map_size
+        tiles = np.zeros(self.map_size, dtype=np.int64)
+        game_map = np.asarray(game_map, dtype=np.int64)
+        if game_map.ndim == 2:
+            nx, ny = min(game_map.shape[0], width), min(game_map.shape[1], height)
+            tiles[:nx, :ny] = game_map[:nx, :ny]
+        self.stones[:-1] = tiles.ravel() == Tiles.STONE
+        self.food[:-1] = tiles.ravel() == Tiles.FOOD
+        self.snakes[:] = False
+        self.traverse = None  # labelled on the first update
+
+    def update(self, body, sight, traverse):
+        """
+        Follow one step of the game.
+
+        Args:
+            body: Our body, head first, as [x, y] cells
+            sight: (xs, ys, tiles) of the sight, see sight_cells
+            traverse: Whether the snake crosses stones and the map edges
+        """
+        height = self.map_size[1]
+        xs, ys, tiles = sight
+        seen = xs * height + ys
+        self.food[seen] = tiles == Tiles.FOOD
+
+        snakes = np.zeros(self.cells + 1, dtype=bool)
+        snakes[seen[tiles == Tiles.SNAKE]] = True
+        if len(body):
+            cells = np.asarray(body, dtype=np.int64).reshape(-1, 2) % self.map_size
+            snakes[cells[:, 0] * height + cells[:, 1]] = True
+        taken = np.flatnonzero(snakes & ~self.snakes)
+        freed = np.flatnonzero(self.snakes & ~snakes)
+        self.snakes = snakes
+
+        traverse = bool(traverse)
+        if traverse != self.traverse or len(taken) + len(freed) > REBUILD_CHANGES:
+            self.traverse = traverse
+            self._label()
+            return
+        walls = self.stones if not traverse else np.zeros_like(self.stones)
+        for cell in freed:
+            if not walls[cell]:
+                self._free(cell)
+        for cell in taken:
+            if self.labels[cell] >= 0:
+                self._take(cell)
+
+    def features(self, head):
+        """
+        (4, MOVE_FEATURES) float32 features of the moves from `head`, zeros for the
+        moves into a taken cell.
+        """
+        features = np.zeros((len(MOVES), MOVE_FEATURES), dtype=np.float32)
+        if head is None or self.traverse is None:
+            return features
+        targets = self.targets(head)
+        areas = self.labels[targets]
+        free = areas >= 0
+        if not free.any():
+            return features
+        features[free, 0] = np.array(self.sizes)[areas[free]] / self.cells
+
+        # only the areas with food have a distance to it
+        food = np.flatnonzero(self.food & (self.labels >= 0))
+        fed = free & np.isin(areas, self.labels[food])
+        if fed.any():
+            distances = self.flood(food, targets[fed])[targets[fed]]
+            features[fed, 1] = 1.0 / (2.0 + distances)  # one more step to the move's cell
+        return features
+
+    def cell(self, x, y):
+        """Index of the cell [x, y] in the arrays, wrapping around the map."""
+        width, height = self.map_size
+        return (x % width) * height + y % height
+
+    def targets(self, head):
+        """Cells of the 4 moves from `head`, the index `cells` for those off the map."""
+        return self._neighbours[self.traverse][self.cell(*head[:2])]
+
+    def neighbours(self, cells):
+        """Cells of the 4 moves from cells given as indices, see targets()."""
+        return self._neighbours[self.traverse][cells]
+
+    def _free_mask(self):
+        taken = self.snakes if self.traverse else self.snakes | self.stones
+        free = ~taken
+        free[-1] = False
+        return free
+
+    def flood(self, sources, targets=None, free=None, any_target=False):
+        """
+        Steps from the sources to each free cell, -1 where not reached.
+
+        Args:
+            sources: Cells to start from, see targets() for the cell indices
+            targets: Cells after which the flood stops once all are reached
+            free: Mask of the free cells, those not taken now by default
+            any_target: Stop once any of the targets is reached instead
+        """
+        neighbours = self._neighbours[self.traverse]
+        free = self.labels >= 0 if free is None else free
+        distance = np.full(self.cells + 1, -1, dtype=np.int64)
+        distance[sources] = 0
+        frontier = np.asarray(sources, dtype=np.int64)
+        steps = 0
+        while frontier.size:
+            if targets is not None:
+                reached = distance[targets] >= 0
+                if reached.any() if any_target else reached.all():
+                    break
+            steps += 1
+            reached = neighbours[frontier].ravel()
+            reached = reached[free[reached] & (distance[reached] < 0)]
+            # each cell once, as the first of its copies (faster than np.unique)
+            order = np.arange(len(reached))
+            self._slots[reached] = order
+            frontier = reached[self._slots[reached] == order]
+            distance[frontier] = steps
+        return distance
+
+    def _label(self):
+        """Label every free area from scratch."""
+        self.rebuilds += 1
+        free = self._free_mask()
+        self.labels[:] = -1
+        self.labels[free] = len(MOVES)  # any label, for the floods to see the cells as free
+        self.sizes = []
+        unlabelled = free.copy()
+        while unlabelled.any():
+            start = int(np.argmax(unlabelled))
+            area = np.flatnonzero(self.flood([start]) >= 0)
+            self._assign(area)
+            unlabelled[area] = False
+
+    def _assign(self, area):
+        self.labels[area] = len(self.sizes)
+        self.sizes.append(len(area))
+
+    def _free(self, cell):
+        areas = np.unique(self.labels[self._neighbours[self.traverse][cell]])
+        areas = areas[areas >= 0]
+        if not areas.size:
+            self.labels[cell] = len(self.sizes)
+            self.sizes.append(1)
+            return
+        largest = max(areas, key=lambda area: self.sizes[area])
+        for area in areas:
+            if area != largest:
+                self.labels[self.labels == area] = largest
+                self.sizes[largest] += self.sizes[area]
+                self.sizes[area] = 0
+        self.labels[cell] = largest
+        self.sizes[largest] += 1
+
+    def _take(self, cell):
+        area = self.labels[cell]
+        self.labels[cell] = -1
+        self.sizes[area] -= 1
+        if self._splits(cell):
+            # flood from each side of the cell, the last side keeps what is left
+            sides = [n for n in self._neighbours[self.traverse][cell] if self.labels[n] == area]
+            for side in sides[:-1]:
+                if self.labels[side] != area:
+                    continue  # reached from an earlier side
+                distance = self.flood([side], [sides[-1]])
+                if distance[sides[-1]] >= 0:
+                    continue  # still one area
+                flooded = np.flatnonzero(distance >= 0)
+                self._assign(flooded)
+                self.sizes[area] -= len(flooded)
+
+    def _splits(self, cell):
+        """Whether the free neighbours of a taken cell are not all linked through the cells around it."""
+        ring = self.labels[self._rings[self.traverse][cell]] >= 0
+        sides = ring[0::2]
+        links = ring[0::2] & ring[1::2] & np.roll(ring[0::2], -1)
+        return sides.sum() - links.sum() > 1
+
+
+class Observer:
+    """
+    Observation of each step, as SnakeTrainEnv gives it, with NumPy only.
+
+    Puts together the ObservationBuilder and the options of the environment
+    (egocentric crop, memory and frame stack), so that inference clients can
+    build the observations of a policy without TensorFlow.
+    """
+
+    def __init__(self, size, timeout, crop_size=None, memory=False, frames=1, reachability=False):
+        """
+        Initialize the observer.
+
+        Args:
+            size: Size of the game, (width, height)
+            timeout: Timeout of the game, when the game info does not give it
+            crop_size: None for the whole map as tile codes, or the (odd) side of an
+                egocentric crop around the head, see EgocentricEncoder
+            memory: Keep what was seen in earlier steps, see BeliefMap
+            frames: Number of the last maps stacked, see FrameStack
+            reachability: Add the "moves" field, see Reachability
+        """
+        self.size = tuple(size)
+        self.timeout = timeout
+        self.crop_size = crop_size
+        self.memory = memory
+        self.frames = frames
+        self.reachability = Reachability(self.size) if reachability else None
+        # the food position and danger mask of the builder are those of the last map
+        self.builder = ObservationBuilder(self.size)
+        self.encoder = EgocentricEncoder(crop_size, self.size, memory) if crop_size else None
+        self.belief = BeliefMap(self.size) if memory else None
+        self.stack = FrameStack(frames, self.frame_shape) if frames > 1 else None
+
+    @property
+    def frame_shape(self):
+        if self.encoder is not None:
+            return (self.crop_size, self.crop_size, self.encoder.channels)
+        if self.belief is not None:
+            return (*self.size, 2)  # tiles and ages
+        return self.size
+
+    @property
+    def map_shape(self):
+        return self.stack.shape if self.stack is not None else self.frame_shape
+
+    @property
+    def options(self):
+        """The observation options, as SnakeTrainEnv takes them."""
+        return {
+            "crop_size": self.crop_size,
+            "memory": bool(self.memory),
+            "frames": self.frames,
+            "reachability": self.reachability is not None,
+        }
+
+    @property
+    def map_maximum(self):
+        """Largest value of the map, per channel for the maps that have channels."""
+        if self.encoder is not None:
+            maximum = np.ones(self.encoder.channels, dtype=np.uint8)  # one-hot
+            maximum[CHANNELS:] = MAX_AGE
+        elif self.belief is not None:
+            maximum = np.array([MAX_TILE, MAX_AGE], dtype=np.uint8)
+        else:
+            return MAX_TILE
+        return np.tile(maximum, self.frames)
+
+    def empty(self):
+        """Observation with nothing known, when there is no game."""
+        return {
+            "map": np.zeros(self.map_shape, dtype=np.uint8),
+            "traverse": np.int32(0),
+            "range": np.int32(1),
+            "direction": np.int32(0),
+            "timeout": np.int32(self.timeout),
+            "score": np.int32(0),
+            **self._moves(None),
+        }
+
+    def tiles(self, game_map):
+        """
+        Tile codes of the newest frame of an observation map, one row per y,
+        for printing. The crop has the head at its centre, and cells outside
+        the sight are -1.
+        """
+        game_map = np.asarray(game_map)
+        if self.stack is not None:
+            channels = self.frame_shape[2] if len(self.frame_shape) == 3 else 1
+            game_map = game_map[..., -channels:].reshape(self.frame_shape)
+        if self.encoder is None:
+            return game_map[..., 0] if self.belief is not None else game_map
+        tiles = np.zeros(game_map.shape[:2], dtype=np.int16)
+        for tile, channel in TILE_CHANNELS.items():
+            tiles[game_map[..., channel] == 1] = tile
+        tiles[game_map[..., BODY] == 1] = Tiles.SNAKE
+        if game_map[..., BODY].any():
+            tiles[self.crop_size // 2, self.crop_size // 2] = HEAD
+        tiles[game_map[..., UNKNOWN] == 1] = -1
+        return tiles.T
+
+    def _moves(self, head):
+        if self.reachability is None:
+            return {}
+        return {"moves": self.reachability.features(head)}
+
+    def reset(self, info):
+        """Observation of the game info sent when a game starts, the map being cut to the size."""
+        game_map = self.builder.from_map(info.get("map") or [])
+        if self.belief is not None:
+            self.belief.reset(info.get("map") or [])
+            if self.encoder is None:
+                game_map = self.builder.build_memory(self.belief, [])
+        if self.encoder is not None:
+            self.encoder.set_map(info.get("map") or [])
+            game_map = self.encoder.empty()  # the head is not known yet
+        if self.stack is not None:
+            game_map = self.stack.reset(game_map)
+        if self.reachability is not None:
+            self.reachability.reset(info.get("map") or [])
+        return {
+            "map": game_map,
+            "traverse": np.int32(info.get("traverse", 0)),
+            "range": np.int32(info.get("range", 1)),
+            "direction": np.int32(0),
+            "timeout": np.int32(info.get("timeout", self.timeout)),
+            "score": np.int32(info.get("score", 0)),
+            **self._moves(None),  # the head is not known yet
+        }
+
+    def step(self, state, action):
+        """
+        Observation of one step, a new dict each step as the agents keep them.
+
+        Args:
+            state: Player state sent by the server
+            action: Action that led to it, None if not known
+        """
+        body = state.get("body", [])
+        game_map = self.builder.build(state.get("sight", {}), body)
+        if self.belief is not None:
+            self.belief.update(*self.builder.sight)
+        if self.encoder is not None:
+            game_map = self.encoder.encode(self.builder.sight, body, self.belief)
+        elif self.belief is not None:
+            game_map = self.builder.build_memory(self.belief, body)
+        if self.stack is not None:
+            game_map = self.stack.push(game_map)
+        if self.reachability is not None:
+            self.reachability.update(body, self.builder.sight, state.get("traverse", False))
+        return {
+            "map": game_map,
+            "traverse": np.int32(state.get("traverse", 0)),
+            "range": np.int32(state.get("range", 1)),
+            "direction": np.int32(action if action is not None else 0),  # the action taken
+            # remaining timeout
+            "timeout": np.int32(max(0, state.get("timeout", self.timeout) - state.get("step", 0))),
+            "score": np.int32(state.get("score", 0)),
+            **self._moves(body[0] if len(body) else None),
+        }
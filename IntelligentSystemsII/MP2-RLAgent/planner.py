@@ -0,0 +1,131 @@
+"""
+Search-based Snake player, the expert of agents.snake_expert_agent.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+
+from observations import Reachability
+
+EXPLORE_AGE = 100  # steps after which a cell seen before is worth seeing again
+
+
+class SnakePlanner:
+    """
+    Picks moves by search over what the snake has seen, with NumPy floods.
+
+    Each step, in order:
+        1. the first move of a shortest path to the nearest food, if a copy of
+           the snake sent along that path could still reach its tail after eating;
+        2. otherwise, the same towards the nearest cell not seen for EXPLORE_AGE
+           steps, as food is only known once seen;
+        3. otherwise the move following the tail by the longest way, so the
+           snake waits for its body to free a way;
+        4. otherwise the move into the largest free area.
+    Paths are shortest paths from a flood of the targets, all steps costing the
+    same. The map, remembered food and the free areas are those of a
+    Reachability, updated incrementally every step.
+    """
+
+    def __init__(self, map_size):
+        """
+        Args:
+            map_size: Size of the game, (width, height)
+        """
+        self.world = Reachability(map_size)
+        self.seen_at = np.zeros(self.world.cells + 1, dtype=np.int64)
+        self.step = 0
+        self.decisions = {"food": 0, "explore": 0, "tail": 0, "area": 0, "stuck": 0}  # how each move was chosen
+
+    def reset(self, game_map):
+        """Start a game, from the map of its game info."""
+        self.world.reset(game_map)
+        self.seen_at[:] = -EXPLORE_AGE
+        self.step = 0
+
+    def plan(self, body, sight, traverse):
+        """
+        Action of one step.
+
+        Args:
+            body: Our body, head first, as [x, y] cells
+            sight: (xs, ys, tiles) of the sight, see observations.sight_cells
+            traverse: Whether the snake crosses stones and the map edges
+
+        Returns:
+            Action, 0=up, 1=down, 2=left, 3=right
+        """
+        world = self.world
+        world.update(body, sight, traverse)
+        self.step += 1
+        xs, ys, _ = sight
+        self.seen_at[world.cell(xs, ys)] = self.step
+        if not len(body):
+            self.decisions["stuck"] += 1
+            return 0
+        cells = np.array([world.cell(*part[:2]) for part in body], dtype=np.int64)
+        targets = world.targets(body[0])
+        moves = np.flatnonzero(world.labels[targets] >= 0)
+        if not moves.size:
+            self.decisions["stuck"] += 1
+            return 0
+
+        food = np.flatnonzero(world.food & (world.labels >= 0))
+        move = self._towards(food, cells, targets, moves, eats=True)
+        if move is not None:
+            self.decisions["food"] += 1
+            return int(move)
+
+        unseen = np.flatnonzero((self.seen_at[:-1] <= self.step - EXPLORE_AGE) & (world.labels[:-1] >= 0))
+        move = self._towards(unseen, cells, targets, moves, eats=False)
+        if move is not None:
+            self.decisions["explore"] += 1
+            return int(move)
+
+        # the tail frees its cell as the snake moves, so it is a source like any free cell
+        tail = world.flood(cells[-1:])[targets[moves]]
+        if (tail > 0).any():
+            self.decisions["tail"] += 1
+            return int(moves[np.argmax(tail)])
+
+        self.decisions["area"] += 1
+        sizes = np.array(world.sizes)[world.labels[targets[moves]]]
+        return int(moves[np.argmax(sizes)])
+
+    def _towards(self, goals, cells, targets, moves, eats):
+        """First move of the shortest safe path to the nearest goal cell, None if there is none."""
+        world = self.world
+        if not goals.size:
+            return None
+        distance = world.flood(goals, targets[moves])
+        reached = distance[targets[moves]] >= 0
+        if not reached.any():
+            return None
+        best = np.flatnonzero(reached)[np.argmin(distance[targets[moves]][reached])]
+
+        path = self._descend(distance, targets[moves[best]])
+        if self._can_reach_tail(cells, path, eats):
+            return moves[best]
+        return None
+
+    def _descend(self, distance, cell):
+        """Cells from `cell` down the distances to the goals, `cell` first and a goal last."""
+        path = [cell]
+        while distance[cell] > 0:
+            following = self.world.neighbours(cell)
+            cell = following[np.flatnonzero(distance[following] == distance[cell] - 1)[0]]
+            path.append(cell)
+        return path
+
+    def _can_reach_tail(self, cells, path, eats):
+        """Whether the snake, after following `path` and maybe eating at its end, has a way to its tail."""
+        # body after the path: the path reversed, then what is left of the old body
+        length = len(cells) + int(eats)
+        virtual = np.concatenate([path[::-1], cells])[:length]
+        free = self.world.labels >= 0
+        free[cells] = True
+        free[virtual] = False
+        free[-1] = False
+        around_tail = self.world.neighbours(virtual[-1])
+        distance = self.world.flood(virtual[:1], around_tail, free, any_target=True)
+        return bool((distance[around_tail] > 0).any())
+
@@ -0,0 +1,232 @@
+"""
+Export of trained DQN and PPO policies to NumPy bundles, see policy_runtime.py.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import json
+import logging
+from collections import defaultdict
+
+import numpy as np
+import tensorflow as tf
+
+from agents.snake_dqn_agent import DQNAgent
+from agents.snake_ppo_agent import (
+    CastFloat32Layer, Clip0To10Layer, PPOAgent, Scale100Layer, Scale1000Layer,
+)
+from snake_train_env import SnakeTrainEnv
+
+AGENTS = {
+    "dqn": DQNAgent,
+    "ppo": PPOAgent,
+}
+
+# Scaling layers of the PPO preprocessing
+SCALES = {Scale1000Layer: 1.0 / 1000.0, Scale100Layer: 1.0 / 100.0}
+
+logger = logging.getLogger("PolicyExport")
+
+
+class Bundle:
+    """Weights and op descriptions of an exported network."""
+
+    def __init__(self):
+        self.arrays = {}
+
+    def add(self, array):
+        """Keep an array as float32 and return its name in the bundle."""
+        name = f"w{len(self.arrays)}"
+        self.arrays[name] = np.asarray(array, dtype=np.float32)
+        return name
+
+    def layer(self, layer):
+        """Ops of a Keras layer at inference, an empty list for those doing nothing then."""
+        if isinstance(layer, tf.keras.Sequential):
+            return [op for inner in layer.layers for op in self.layer(inner)]
+        if isinstance(layer, (tf.keras.layers.InputLayer, tf.keras.layers.Dropout)):
+            return []
+        if isinstance(layer, CastFloat32Layer):
+            return [{"op": "cast"}]
+        if isinstance(layer, Clip0To10Layer):
+            return [{"op": "cast"}, {"op": "clip", "minimum": 0.0, "maximum": 10.0}]
+        if type(layer) in SCALES:
+            return [{"op": "cast"}, self._affine(SCALES[type(layer)], 0.0)]
+
+        config = layer.get_config()
+        if isinstance(layer, tf.keras.layers.Rescaling):
+            return [{"op": "cast"}, self._affine(config["scale"], config["offset"])]
+        if isinstance(layer, tf.keras.layers.Reshape):
+            return [{"op": "reshape", "shape": list(config["target_shape"])}]
+        if isinstance(layer, tf.keras.layers.Flatten):
+            return [{"op": "flatten"}]
+        if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D):
+            return [{"op": "global_average_pool"}]
+        if isinstance(layer, tf.keras.layers.Embedding):
+            return [{"op": "embedding", "table": self.add(layer.embeddings.numpy())}]
+        if isinstance(layer, tf.keras.layers.BatchNormalization):
+            # moving statistics folded into one scale and shift per channel
+            scale = 1.0 / np.sqrt(layer.moving_variance.numpy() + layer.epsilon)
+            if layer.gamma is not None:
+                scale = scale * layer.gamma.numpy()
+            shift = -layer.moving_mean.numpy() * scale
+            if layer.beta is not None:
+                shift = shift + layer.beta.numpy()
+            return [self._affine(scale, shift)]
+        if isinstance(layer, tf.keras.layers.Dense):
+            return [{
+                "op": "dense",
+                "kernel": self.add(layer.kernel.numpy()),
+                "bias": self.add(layer.bias.numpy() if layer.use_bias else np.zeros(layer.units)),
+                "activation": self._activation(config),
+            }]
+        if isinstance(layer, tf.keras.layers.Conv2D):
+            if tuple(config["strides"]) != (1, 1) or tuple(config["dilation_rate"]) != (1, 1):
+                raise ValueError(f"Only convolutions of stride and dilation 1 can be exported, not {layer.name}")
+            return [{
+                "op": "conv2d",
+                "kernel": self.add(layer.kernel.numpy()),
+                "bias": self.add(layer.bias.numpy() if layer.use_bias else np.zeros(config["filters"])),
+                "padding": config["padding"],
+                "activation": self._activation(config),
+            }]
+        if isinstance(layer, tf.keras.layers.MaxPooling2D):
+            if tuple(config["strides"]) != tuple(config["pool_size"]):
+                raise ValueError(f"Only poolings with the pool size as strides can be exported, not {layer.name}")
+            return [{"op": "max_pool", "pool_size": list(config["pool_size"]), "padding": config["padding"]}]
+        raise ValueError(f"Layer {layer.name} ({type(layer).__name__}) cannot be exported")
+
+    def layers(self, layers):
+        return [op for layer in layers for op in self.layer(layer)]
+
+    def _affine(self, scale, shift):
+        return {"op": "affine", "scale": self.add(scale), "shift": self.add(shift)}
+
+    @staticmethod
+    def _activation(config):
+        activation = config["activation"]
+        if isinstance(activation, dict):  # serialized activation function
+            activation = activation.get("config", {}).get("name", activation.get("class_name"))
+        if activation not in ("relu", "linear", "tanh", "sigmoid"):
+            raise ValueError(f"Activation {activation} cannot be exported")
+        return activation
+
+
+def functional_branches(model):
+    """
+    Split a functional model made of one branch per input joined by a Concatenate.
+
+    Returns:
+        Names of the inputs in the order they are concatenated, the names of
+        the layers of each branch and those of the head, in order
+    """
+    config = model.get_config()
+    kinds = {layer["name"]: layer["class_name"] for layer in config["layers"]}
+    sources = {
+        layer["name"]: [inbound[0] for node in layer["inbound_nodes"] for inbound in node]
+        for layer in config["layers"]
+    }
+    consumers = defaultdict(list)
+    for name, inbound in sources.items():
+        for source in inbound:
+            consumers[source].append(name)
+
+    def chain(name, until_concatenate=True):
+        """Layers following `name`, up to and with the Concatenate if until_concatenate."""
+        layers = []
+        while consumers[name]:
+            if len(consumers[name]) > 1:
+                raise ValueError(f"Layer {name} feeds more than one layer")
+            name = consumers[name][0]
+            layers.append(name)
+            if until_concatenate and kinds[name] == "Concatenate":
+                break
+        return layers
+
+    branches = {}
+    ends = {}
+    for name, _, _ in config["input_layers"]:
+        branch = chain(name)
+        if not branch or kinds[branch[-1]] != "Concatenate":
+            raise ValueError(f"Input {name} does not lead to a Concatenate")
+        branches[name] = branch[:-1]
+        ends[branch[-2] if len(branch) > 1 else name] = name
+        concatenate = branch[-1]
+    inputs = [ends[source] for source in sources[concatenate]]
+    return inputs, branches, chain(concatenate, until_concatenate=False)
+
+
+def export_dqn(agent, bundle):
+    """Branches and head of the Q network of a DQNAgent."""
+    model = agent.q_network
+    if model is None:
+        raise ValueError("The agent has no network, load a trained one first")
+    inputs, branches, head = functional_branches(model)
+    # the inputs are named after the observation fields, as in <field>_input
+    fields = [name[:-len("_input")] for name in inputs]
+    ops = {field: bundle.layers(model.get_layer(n) for n in branches[name]) for field, name in zip(fields, inputs)}
+    # what DQNAgent._prepare_batch_inputs does before the network
+    ops["map"] = [{"op": "cast"}] + ops["map"]
+    ops["range"] = [{"op": "clip", "minimum": 0, "maximum": 10}] + ops["range"]
+    return fields, ops, bundle.layers(model.get_layer(n) for n in head)
+
+
+def export_ppo(agent, bundle):
+    """Branches and head of the actor network of a PPOAgent, its logits picking the action."""
+    encoder = agent.actor_net._encoder
+    preprocessing = encoder._preprocessing_nest
+    fields = sorted(preprocessing)  # the order tf.nest flattens the observation in
+    projection = tf.nest.flatten(agent.actor_net._projection_networks)[0]
+    return (
+        fields,
+        {field: bundle.layer(preprocessing[field]) for field in fields},
+        bundle.layers(encoder._postprocessing_layers) + bundle.layer(projection._projection_layer),
+    )
+
+
+EXPORTERS = {
+    "dqn": export_dqn,
+    "ppo": export_ppo,
+}
+
+
+def export_policy(agent, agent_type, env, path):
+    """
+    Write the greedy policy of a trained agent to a .npz bundle.
+
+    Args:
+        agent: Trained agent
+        agent_type: Key of AGENTS
+        env: SnakeTrainEnv of the agent, for its observation options
+        path: Where to write the bundle
+    """
+    bundle = Bundle()
+    inputs, branches, head = EXPORTERS[agent_type](agent, bundle)
+    config = {
+        "agent": agent_type,
+        "observation": env.observer.options,
+        "inputs": inputs,
+        "branches": branches,
+        "head": head,
+    }
+    np.savez(path, config=np.array(json.dumps(config)), **bundle.arrays)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a trained policy for policy_runtime.py")
+    parser.add_argument("agent", choices=AGENTS)
+    parser.add_argument("policy", help="Path the agent was saved to, e.g. policy/dqn_agent_final")
+    parser.add_argument("output", nargs="?", help="Bundle to write, the policy path with .npz by default")
+    parser.add_argument("--crop", type=int, help="Side of the egocentric observation crop, odd")
+    parser.add_argument("--memory", action="store_true", help="Remember what earlier steps saw")
+    parser.add_argument("--frames", type=int, default=1, help="Last maps stacked in the observations")
+    parser.add_argument("--reachability", action="store_true", help="Add the area and food distance of each move")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    env = SnakeTrainEnv(crop_size=args.crop, memory=args.memory, frames=args.frames, reachability=args.reachability)
+    agent = AGENTS[args.agent](env)
+    agent.load(args.policy)
+    output = args.output or f"{args.policy}.npz"
+    export_policy(agent, args.agent, env, output)
+    logger.info("Policy exported: %s", output)
@@ -0,0 +1,214 @@
+"""
+Pure NumPy inference of policies exported with policy_export.py.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import asyncio
+import getpass
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import websockets
+
+from observations import Observer
+from protocol import PROTOCOL_BINARY
+from snake_game import SnakeGame
+
+KEYS = ["w", "s", "a", "d"]  # key of each action
+
+logger = logging.getLogger("PolicyRuntime")
+
+
+def _activation(x, name):
+    if name == "relu":
+        return np.maximum(x, 0.0)
+    if name == "tanh":
+        return np.tanh(x)
+    if name == "sigmoid":
+        return 1.0 / (1.0 + np.exp(-x))
+    return x  # linear
+
+
+def _pad(x, kernel_size, padding, value=0.0):
+    """Pad the rows and columns of a (batch, rows, columns, channels) array as Keras does."""
+    if padding != "same":
+        return x
+    pads = [(0, 0)]
+    for kernel in kernel_size:
+        total = max(kernel - 1, 0)
+        pads.append((total // 2, total - total // 2))
+    pads.append((0, 0))
+    return np.pad(x, pads, constant_values=value)
+
+
+def conv2d(x, weights, op):
+    """Stride 1 convolution as one matrix product over the patches."""
+    kernel = weights[op["kernel"]]
+    rows, columns, channels, filters = kernel.shape
+    x = _pad(x, (rows, columns), op["padding"])
+    height = x.shape[1] - rows + 1
+    width = x.shape[2] - columns + 1
+    patches = np.concatenate(
+        [x[:, i:i + height, j:j + width, :] for i in range(rows) for j in range(columns)], axis=-1
+    )
+    y = patches @ kernel.reshape(rows * columns * channels, filters) + weights[op["bias"]]
+    return _activation(y, op["activation"])
+
+
+def max_pool(x, weights, op):
+    """Max pooling with the pool size as strides."""
+    rows, columns = op["pool_size"]
+    if op["padding"] == "same":
+        # as in TensorFlow, the padding is split with the odd cell after
+        pads = [(0, 0)]
+        for size, pool in zip(x.shape[1:3], (rows, columns)):
+            total = -size % pool
+            pads.append((total // 2, total - total // 2))
+        x = np.pad(x, pads + [(0, 0)], constant_values=-np.inf)
+    height, width = x.shape[1] // rows, x.shape[2] // columns
+    x = x[:, :height * rows, :width * columns]
+    return x.reshape(x.shape[0], height, rows, width, columns, x.shape[3]).max(axis=(2, 4))
+
+
+def dense(x, weights, op):
+    return _activation(x @ weights[op["kernel"]] + weights[op["bias"]], op["activation"])
+
+
+def affine(x, weights, op):
+    return x * weights[op["scale"]] + weights[op["shift"]]
+
+
+def embedding(x, weights, op):
+    return weights[op["table"]][np.asarray(x).astype(np.int64)]
+
+
+OPS = {
+    "conv2d": conv2d,
+    "max_pool": max_pool,
+    "dense": dense,
+    "affine": affine,
+    "embedding": embedding,
+    "cast": lambda x, weights, op: np.asarray(x, dtype=np.float32),
+    "clip": lambda x, weights, op: np.clip(x, op["minimum"], op["maximum"]),
+    "reshape": lambda x, weights, op: x.reshape(len(x), *op["shape"]),
+    "flatten": lambda x, weights, op: x.reshape(len(x), -1),
+    "global_average_pool": lambda x, weights, op: x.mean(axis=(1, 2)),
+}
+
+
+class NumpyPolicy:
+    """
+    A policy exported with policy_export.py, run with NumPy alone.
+
+    The bundle is one .npz file holding the weights and a JSON description of
+    the network: one chain of ops per observation field, concatenated in the
+    order of "inputs", then the chain of the head, whose outputs are the Q
+    values (DQN) or the action logits (PPO). The greedy action is the largest.
+    """
+
+    def __init__(self, path):
+        """
+        Load a bundle.
+
+        Args:
+            path: .npz file written by policy_export.py
+        """
+        with np.load(path, allow_pickle=False) as bundle:
+            self.config = json.loads(str(bundle["config"]))
+            self.weights = {key: bundle[key] for key in bundle.files if key != "config"}
+        self.agent = self.config["agent"]
+        self.observation = self.config["observation"]  # crop_size, memory, frames and reachability of SnakeTrainEnv
+
+    def observer(self, info):
+        """Observer building the observations of the policy for a game, from its info."""
+        return Observer(info.get("size", (48, 24)), info.get("timeout", 3000), **self.observation)
+
+    def _run(self, x, ops):
+        for op in ops:
+            x = OPS[op["op"]](x, self.weights, op)
+        return x
+
+    def outputs(self, observations):
+        """Q values or logits of a batch, observations being a dict of batched fields."""
+        features = [
+            self._run(np.asarray(observations[key]), self.config["branches"][key])
+            for key in self.config["inputs"]
+        ]
+        features = [feature.reshape(len(feature), -1).astype(np.float32) for feature in features]
+        return self._run(np.concatenate(features, axis=1), self.config["head"])
+
+    def actions(self, observations):
+        return np.argmax(self.outputs(observations), axis=1).astype(np.int32)
+
+    def action(self, observation):
+        """Greedy action of one observation."""
+        batch = {key: np.asarray(value)[None] for key, value in observation.items()}
+        return int(self.actions(batch)[0])
+
+
+async def play(server_address="localhost:8000", agent_name="student", path="policy/dqn_agent_final.npz",
+               policy=None):
+    """
+    Play one game with an exported policy.
+
+    Args:
+        server_address: "host:port" of server.py
+        agent_name: Name of the player
+        path: Bundle written by policy_export.py
+        policy: NumpyPolicy already loaded, instead of path
+
+    Returns:
+        The final score
+    """
+    policy = policy or NumpyPolicy(path)
+    async with websockets.connect(f"ws://{server_address}/player") as websocket:
+        game = SnakeGame(logger)
+        await game.start_listener(websocket)
+        await websocket.send(json.dumps({"cmd": "join", "name": agent_name, "protocol": PROTOCOL_BINARY}))
+        if not await game.wait_for_first_state():
+            logger.error("Failed to receive initial state.")
+            return 0
+
+        info = game.get_first_state()
+        observer = policy.observer(info)
+        observation = observer.reset(info)
+        steps, score, thinking = 0, 0, 0.0
+        start = time.time()
+        while True:
+            tick = time.perf_counter()
+            action = policy.action(observation)
+            thinking += time.perf_counter() - tick
+            await websocket.send(json.dumps({"cmd": "key", "key": KEYS[action]}))
+
+            state = await game.get_state()
+            score = state.get("score", score)
+            if state.get("highscores") is not None:
+                break
+            observation = observer.step(state, action)
+            steps += 1
+
+        await game.stop_listener()
+        logger.info(
+            "Game over, score %s in %s steps and %.1fs, %.0f us per action",
+            score, steps, time.time() - start, 1e6 * thinking / max(1, steps),
+        )
+        return score
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Play with a policy exported by policy_export.py")
+    parser.add_argument("policy", help=".npz bundle")
+    parser.add_argument("--games", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    SERVER = os.environ.get("SERVER", "localhost")
+    PORT = os.environ.get("PORT", "8000")
+    NAME = os.environ.get("NAME", getpass.getuser())
+
+    loaded = NumpyPolicy(args.policy)
+    for _ in range(args.games):
+        asyncio.run(play(f"{SERVER}:{PORT}", NAME, policy=loaded))
@@ -0,0 +1,328 @@
+"""Wire formats for the frames the server sends to players and viewers.
+
+Players pick a format with the "protocol" field of their join command:
+
+    {"cmd": "join", "name": "student", "protocol": 2}
+
+Version 1 (the default) is the plain JSON state. Version 2 sends each game
+frame as a packed binary message: a fixed header, the body as a head position
+followed by 2-bit steps, and the tiles of the sight disc packed two per byte.
+The game info and highscores messages stay JSON in both versions.
+"""
+import json
+import struct
+from datetime import datetime
+from itertools import chain
+
+import numpy as np
+
+from mapa import zone_offsets
+
+PROTOCOL_JSON = 1
+PROTOCOL_BINARY = 2
+PROTOCOLS = (PROTOCOL_JSON, PROTOCOL_BINARY)
+
+MAGIC = b"SN"
+
+# magic, version, flags, step, timeout, score, range, width, height,
+# body length, head x, head y, timestamp
+_HEADER = struct.Struct("<2sBBIIiBHHIHHd")
+
+FLAG_ALIVE = 1
+FLAG_TRAVERSE = 2
+
+# (dx, dy) from one body segment to the next, towards the tail
+_STEPS = np.array([(0, -1), (1, 0), (0, 1), (-1, 0)], dtype=np.int64)
+# code of each step, indexed 3 * (dx + 1) + dy + 1, -1 for cells that do not touch
+_STEP_CODES = np.full(9, -1, dtype=np.int64)
+_STEP_CODES[3 * (_STEPS[:, 0] + 1) + _STEPS[:, 1] + 1] = np.arange(len(_STEPS))
+_STEP_WEIGHTS = np.array([1, 4, 16, 64], dtype=np.int64)  # 4 steps in a byte, lowest bits first
+_TILE_WEIGHTS = np.array([1, 16], dtype=np.int64)  # 2 tiles in a byte
+_PADDING = np.zeros(3, dtype=np.int64)
+# What each byte unpacks to: its 4 steps as (dx, dy), and its 2 tiles
+_BYTE_STEPS = _STEPS[(np.arange(256)[:, None] >> np.array([0, 2, 4, 6])) & 3]
+_BYTE_TILES = (np.arange(256)[:, None] >> np.array([0, 4])) & 0xF
+
+# Per sight range, the cells of its disc in zone_offsets() order as flat
+# indices into the (2 * range + 1) square window of Map.get_zone_window, in
+# pairs, the second of the last pair pointing past the window when there is
+# an odd number of cells
+_ZONES = {}
+
+
+def _zone(size):
+    if size not in _ZONES:
+        side = 2 * size + 1
+        offsets = np.array(zone_offsets(size), dtype=np.int64).reshape(-1, 2)
+        cells = (offsets[:, 0] + size) * side + offsets[:, 1] + size
+        pairs = np.append(cells, side * side)[:len(cells) + len(cells) % 2].reshape(-1, 2)
+        _ZONES[size] = cells, pairs
+    return _ZONES[size]
+
+
+def _pack_body(body, width, height):
+    cells = np.fromiter(chain.from_iterable(body), dtype=np.int64, count=2 * len(body)).reshape(-1, 2)
+    # 0, 1 or 2 for differences of -1, 0 or 1, across the map edge too
+    delta = (cells[1:] - cells[:-1] + 1) % (width, height)
+    codes = _STEP_CODES.take(delta @ (3, 1), mode="clip")
+    if len(codes) and codes.min() < 0:
+        raise ValueError("Body segments that do not touch")
+    codes = np.concatenate((codes, _PADDING[:-len(codes) % 4]))
+    return (codes.reshape(-1, 4) @ _STEP_WEIGHTS).astype(np.uint8).tobytes()
+
+
+def _unpack_body(data, offset, length, head, width, height):
+    size = (length + 2) // 4
+    steps = _BYTE_STEPS[np.frombuffer(data, dtype=np.uint8, count=size, offset=offset)].reshape(-1, 2)
+    body = np.cumsum(np.concatenate(([head], steps[:length - 1])), axis=0)
+    body %= (width, height)
+    return body, offset + size
+
+
+def _sight_tiles(sight, head, size, width, height):
+    """Tiles of the sight disc in zone_offsets() order, in pairs, from either sight form."""
+    cells, pairs = _zone(size)
+    if "tiles" in sight:
+        tiles = sight["tiles"]
+        side = 2 * size + 1
+        if isinstance(tiles, np.ndarray):
+            window = np.append(tiles, 0)
+        else:
+            window = np.fromiter(chain(chain.from_iterable(tiles), (0,)), dtype=np.int64, count=side * side + 1)
+        return window[pairs]
+    hx, hy = head
+    tiles = (sight[(hx + dx) % width][(hy + dy) % height] for dx, dy in zone_offsets(size))
+    return np.fromiter(chain(tiles, _PADDING[:len(cells) % 2]), dtype=np.int64, count=pairs.size).reshape(-1, 2)
+
+
+def _pack_tiles(pairs):
+    return (pairs @ _TILE_WEIGHTS).astype(np.uint8).tobytes()
+
+
+def _pack_names(names):
+    data = bytearray([len(names)])
+    for name in names:
+        encoded = name.encode()
+        data.append(len(encoded))
+        data.extend(encoded)
+    return bytes(data)
+
+
+def encode_state(state, size):
+    """Pack the state the server sends to one player.
+
+    Args:
+        state: Player state as built by the server (step, timeout, players, ts and,
+            while the snake is alive, name, body, sight, score, range, traverse)
+        size: Map size as (width, height)
+
+    Returns:
+        bytes to send as a binary WebSocket message
+    """
+    width, height = size
+    alive = "body" in state
+    flags = FLAG_ALIVE if alive else 0
+    if state.get("traverse"):
+        flags |= FLAG_TRAVERSE
+
+    body = state.get("body", [])
+    head = body[0] if len(body) else (0, 0)
+    sight_range = state.get("range", 0) if alive else 0
+    ts = datetime.fromisoformat(state["ts"]).timestamp() if "ts" in state else 0.0
+
+    header = _HEADER.pack(
+        MAGIC,
+        PROTOCOL_BINARY,
+        flags,
+        state["step"],
+        state["timeout"],
+        state.get("score", 0),
+        sight_range,
+        width,
+        height,
+        len(body),
+        head[0],
+        head[1],
+        ts,
+    )
+
+    players = state.get("players", [])
+    own = players.index(state["name"]) if alive and state["name"] in players else 255
+    parts = [header, _pack_names(players), bytes([own])]
+    if alive:
+        parts.append(_pack_body(body, width, height))
+        parts.append(
+            _pack_tiles(_sight_tiles(state["sight"], head, sight_range, width, height))
+        )
+    return b"".join(parts)
+
+
+def decode_state(data):
+    """Unpack a binary frame into the same dict a JSON frame would give.
+
+    The body comes back as a (length, 2) array of [x, y], head first, and the
+    sight in the compact window form of Map.get_zone_window, its tiles an array.
+    """
+    (
+        magic,
+        version,
+        flags,
+        step,
+        timeout,
+        score,
+        sight_range,
+        width,
+        height,
+        body_length,
+        head_x,
+        head_y,
+        ts,
+    ) = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != PROTOCOL_BINARY:
+        raise ValueError(f"Not a protocol {PROTOCOL_BINARY} frame")
+
+    offset = _HEADER.size
+    players = []
+    for _ in range(data[offset]):
+        length = data[offset + 1]
+        players.append(data[offset + 2 : offset + 2 + length].decode())
+        offset += 1 + length
+    own = data[offset + 1]
+    offset += 2
+
+    state = {
+        "players": players,
+        "step": step,
+        "timeout": timeout,
+        "ts": datetime.fromtimestamp(ts).isoformat(),
+    }
+    if not flags & FLAG_ALIVE:
+        return state
+
+    body, offset = _unpack_body(data, offset, body_length, (head_x, head_y), width, height)
+
+    cells, _ = _zone(sight_range)
+    packed = np.frombuffer(data, dtype=np.uint8, count=(len(cells) + 1) // 2, offset=offset)
+    side = 2 * sight_range + 1
+    tiles = np.full(side * side, -1, dtype=np.int64)
+    tiles[cells] = _BYTE_TILES[packed].reshape(-1)[:len(cells)]
+
+    state.update(
+        {
+            "name": players[own] if own < len(players) else "",
+            "body": body,
+            "sight": {
+                "x": (head_x - sight_range) % width,
+                "y": (head_y - sight_range) % height,
+                "tiles": tiles.reshape(side, side),
+            },
+            "score": score,
+            "range": sight_range,
+            "traverse": bool(flags & FLAG_TRAVERSE),
+        }
+    )
+    return state
+
+
+def player_state(state, name):
+    """The message the server sends to one player, built from the full game state."""
+    message = {key: state[key] for key in ("players", "step", "timeout")}
+    for snake in state["snakes"]:
+        if snake["name"] == name:
+            message.update(snake)
+    return message
+
+
+def decode_message(message):
+    """Decode any message from the server, binary or JSON."""
+    if isinstance(message, bytes):
+        return decode_state(message)
+    return json.loads(message)
+
+
+# Viewers that join with {"cmd": "join", "delta": true} get one keyframe (the
+# usual full state without the snakes' sight, which viewers never draw) and
+# then only what changed each step.
+_SNAKE_FIELDS = ("score", "range", "traverse")
+
+
+def viewer_keyframe(state):
+    """Full viewer state, without the per-snake sight."""
+    return {
+        **state,
+        "snakes": [
+            {key: value for key, value in snake.items() if key != "sight"}
+            for snake in state["snakes"]
+        ],
+    }
+
+
+def diff_viewer_state(previous, current):
+    """What changed between two viewer keyframes.
+
+    Snakes are described by the cells added at the head and the number of
+    cells dropped from the tail, food by the items spawned and eaten.
+    """
+    old_food = {tuple(food) for food in previous["food"]}
+    new_food = {tuple(food) for food in current["food"]}
+    old_snakes = {snake["name"]: snake for snake in previous["snakes"]}
+
+    snakes = {}
+    for snake in current["snakes"]:
+        old = old_snakes.get(snake["name"])
+        if old is None:
+            snakes[snake["name"]] = {"snake": snake}
+            continue
+
+        changes = {key: snake[key] for key in _SNAKE_FIELDS if snake[key] != old[key]}
+        body, old_body = snake["body"], old["body"]
+        try:
+            added = body.index(old_body[0])
+        except ValueError:
+            changes["body"] = body
+        else:
+            if added:
+                changes["head"] = body[:added]
+            removed = len(old_body) + added - len(body)
+            if removed:
+                changes["tail"] = removed
+        if changes:
+            snakes[snake["name"]] = changes
+
+    return {
+        "step": current["step"],
+        "food_added": [food for food in current["food"] if tuple(food) not in old_food],
+        "food_eaten": [food for food in previous["food"] if tuple(food) not in new_food],
+        "snakes": snakes,
+        "dead": [name for name in old_snakes if name not in {s["name"] for s in current["snakes"]}],
+    }
+
+
+def apply_viewer_delta(state, delta):
+    """Rebuild the next viewer state from the previous one and a delta."""
+    eaten = {tuple(food) for food in delta["food_eaten"]}
+    food = [item for item in state["food"] if tuple(item) not in eaten]
+    food.extend(delta["food_added"])
+
+    snakes = []
+    for snake in state["snakes"]:
+        if snake["name"] in delta["dead"]:
+            continue
+        changes = delta["snakes"].get(snake["name"], {})
+        snake = {**snake, **{key: changes[key] for key in _SNAKE_FIELDS if key in changes}}
+        if "body" in changes:
+            snake["body"] = changes["body"]
+        else:
+            body = snake["body"]
+            body = body[: len(body) - changes.get("tail", 0)]
+            snake["body"] = changes.get("head", []) + body
+        snakes.append(snake)
+
+    known = {snake["name"] for snake in snakes}
+    snakes.extend(
+        changes["snake"]
+        for name, changes in delta["snakes"].items()
+        if "snake" in changes and name not in known
+    )
+
+    return {**state, "step": delta["step"], "food": food, "snakes": snakes}
@@ -0,0 +1,248 @@
+"""Record games to an append-only log and re-simulate them without a server.
+
+A replay is a JSON-lines file:
+
+    {"header": {...}}                        game settings and player names
+    {"snapshot": {...}}                      full Game.snapshot(), at step 0 and every N steps
+    [step, {"player": "d"}]                  keys that changed before that step
+    {"end": {"step": 3000, "scores": {...}}} written when the game is over
+
+The whole game is the step 0 snapshot (map, snakes and the state of the game's
+random generator) plus the keys, as Game.update() is deterministic given both.
+The periodic snapshots make seeking cheap: the byte offset of each one is kept
+in a "<replay>.idx" sidecar, so a reader restores the nearest snapshot and only
+re-simulates the steps after it.
+
+    python3 replay.py games/room0-1.replay            # re-simulate and check the scores
+    python3 replay.py games/room0-1.replay --step 1500  # seek
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import time
+
+from game import GAME_SPEED, Game
+
+REPLAY_VERSION = 1
+SNAPSHOT_EVERY = 100
+
+
+def index_path(path):
+    return path + ".idx"
+
+
+class ReplayRecorder:
+    """Writes the replay of one game, given to Game(recorder=...)."""
+
+    def __init__(self, path, snapshot_every=SNAPSHOT_EVERY, **metadata):
+        """Initialize ReplayRecorder.
+
+        Args:
+            path: Replay file to create
+            snapshot_every: Steps between two snapshots
+            metadata: Extra header fields, such as the seed or the room
+        """
+        self.path = path
+        self.snapshot_every = snapshot_every
+        self.metadata = metadata
+        self._file = None
+        self._index = None
+        self._keys = {}
+
+    def _write(self, record):
+        self._file.write(json.dumps(record, separators=(",", ":")).encode() + b"\n")
+
+    def _snapshot(self, game):
+        self._index.write(f"{game._step} {self._file.tell()}\n")
+        self._write({"snapshot": game.snapshot()})
+
+    def start(self, game):
+        """Write the header and the first snapshot of a game that just started."""
+        self._file = open(self.path, "wb")
+        self._index = open(index_path(self.path), "w")
+        self._write(
+            {
+                "header": {
+                    "version": REPLAY_VERSION,
+                    "size": game.map.size,
+                    "fps": game._game_speed,
+                    "compact_sight": game._compact_sight,
+                    "players": list(game.snakes),
+                    "snapshot_every": self.snapshot_every,
+                    **self.metadata,
+                }
+            }
+        )
+        self._snapshot(game)
+        self._keys = {name: snake.lastkey for name, snake in game.snakes.items()}
+
+    def tick(self, game):
+        """Record the keys the next step will use, called before each Game.update()."""
+        if self._file is None:
+            return
+        if game._step and game._step % self.snapshot_every == 0:
+            self._snapshot(game)
+
+        changed = {}
+        for name, snake in game.snakes.items():
+            if snake.alive and self._keys.get(name) != snake.lastkey:
+                changed[name] = self._keys[name] = snake.lastkey
+        if changed:
+            self._write([game._step + 1, changed])
+
+    def finish(self, game):
+        """Write the final result and close the files."""
+        if self._file is None:
+            return
+        self._write(
+            {
+                "end": {
+                    "step": game._step,
+                    "scores": {name: snake.score for name, snake in game.snakes.items()},
+                }
+            }
+        )
+        self.close()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            self._file = self._index = None
+
+
+class ReplayReader:
+    """Re-simulates a replay, from its start or from any step."""
+
+    def __init__(self, path):
+        """Initialize ReplayReader."""
+        self.path = path
+        with open(path, "rb") as replay:
+            self.header = json.loads(replay.readline())["header"]
+        if self.header["version"] != REPLAY_VERSION:
+            raise ValueError(f"Unsupported replay version {self.header['version']}")
+        self.snapshots = self._load_index()  # (step, byte offset), in step order
+
+    def _load_index(self):
+        if os.path.isfile(index_path(self.path)):
+            with open(index_path(self.path)) as index:
+                return [tuple(map(int, line.split())) for line in index if line.strip()]
+
+        # no sidecar, find the snapshots by scanning the replay
+        snapshots = []
+        with open(self.path, "rb") as replay:
+            offset = 0
+            for line in replay:
+                if line.startswith(b'{"snapshot"'):
+                    snapshots.append((json.loads(line)["snapshot"]["step"], offset))
+                offset += len(line)
+        return snapshots
+
+    @property
+    def result(self):
+        """The "end" record of the replay, None if the game was interrupted."""
+        with open(self.path, "rb") as replay:
+            replay.seek(max(0, os.path.getsize(self.path) - 4096))
+            last = replay.read().splitlines()[-1]
+        if last.startswith(b'{"end"'):
+            return json.loads(last)["end"]
+        return None
+
+    def _new_game(self):
+        return Game(
+            size=tuple(self.header["size"]),
+            game_speed=self.header.get("fps", GAME_SPEED),
+            compact_sight=self.header.get("compact_sight", False),
+            rng=random.Random(),
+        )
+
+    def _records(self, offset):
+        with open(self.path, "rb") as replay:
+            replay.seek(offset)
+            for line in replay:
+                yield json.loads(line)
+
+    def _start(self, step):
+        """Game restored from the last snapshot at or before step, and the records after it."""
+        snapshot_step, offset = self.snapshots[0]
+        for candidate in self.snapshots:
+            if candidate[0] > step:
+                break
+            snapshot_step, offset = candidate
+
+        records = self._records(offset)
+        game = self._new_game()
+        game.restore(next(records)["snapshot"])
+        return game, records
+
+    def states(self, step=0):
+        """Yield the game state of every step after `step`, as Game.update() returns it."""
+        for _, state in self.frames(step):
+            yield state
+
+    def frames(self, step=0):
+        """Like states(), with the Game each state came from.
+
+        After each step the snakes still hold, in lastkey, the key that moved them.
+        """
+        game, records = self._start(step)
+        for state in self._run(game, records):
+            if state["step"] > step:
+                yield game, state
+
+    def game(self, step=None):
+        """A Game positioned right after `step` (the end of the replay if None)."""
+        game, records = self._start(step if step is not None else float("inf"))
+        if step is None or game._step < step:
+            for state in self._run(game, records):
+                if step is not None and state["step"] >= step:
+                    break
+        return game
+
+    def _run(self, game, records):
+        pending = None
+        while game.running:
+            if pending is None:
+                for record in records:
+                    if isinstance(record, list):
+                        pending = record
+                        break
+                    if "end" in record:
+                        break
+
+            if pending is not None and pending[0] == game._step + 1:
+                for name, key in pending[1].items():
+                    game.snakes[name].lastkey = key
+                pending = None
+
+            yield game.update()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("replay", help="Replay file written by server.py --record")
+    parser.add_argument(
+        "--step", help="Stop at this step instead of the end of the game", type=int
+    )
+    args = parser.parse_args()
+
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    reader = ReplayReader(args.replay)
+    print("Players:", ", ".join(reader.header["players"]))
+
+    start = time.perf_counter()
+    game = reader.game(args.step)
+    elapsed = time.perf_counter() - start
+    scores = {name: snake.score for name, snake in game.snakes.items()}
+    print(f"Step {game._step} reached in {elapsed:.3f}s, scores {scores}")
+
+    result = reader.result
+    if args.step is None and result is not None:
+        if (result["step"], result["scores"]) != (game._step, scores):
+            print("MISMATCH with the recorded result:", result)
+            raise SystemExit(1)
+        print("Matches the recorded result")
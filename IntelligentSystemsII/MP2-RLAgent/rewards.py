@@ -0,0 +1,244 @@
+"""
+Reward shaping of SnakeTrainEnv, computed for a batch of games at once.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+
+# Shaping terms, in the order they are added up
+TERMS = ("food", "survival", "distance", "danger", "efficiency", "exploration")
+# The game over replaces the sum of the terms, unclipped
+GAME_OVER = "game_over"
+
+DEFAULT_WEIGHTS = {term: 1.0 for term in (*TERMS, GAME_OVER)}
+
+# Grid offsets of actions 0=up, 1=down, 2=left, 3=right, the grid indexed as [body x, body y]
+ACTION_OFFSETS = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]], dtype=np.int64)
+NO_ACTION = -1  # no action taken yet, never in danger
+
+FOOD_REWARD = 50.0
+LENGTH_BONUS = 0.5  # per body cell when eating, up to MAX_LENGTH_BONUS
+MAX_LENGTH_BONUS = 10.0
+SURVIVAL_REWARD = 0.5
+CLOSER_REWARD = 0.1  # per cell nearer the food
+FARTHER_PENALTY = 0.02  # per cell farther from the food
+DANGER_PENALTY = -8.0
+HUNGER_STEPS = 200  # steps without food before the efficiency penalty
+HUNGER_PENALTY = -0.001  # per step above HUNGER_STEPS
+MAX_HUNGER_PENALTY = -2.0
+EXPLORATION_BONUS = 0.1  # first visit of a cell in the episode
+GAME_OVER_PENALTY = -100.0
+REWARD_RANGE = (-50.0, 150.0)
+
+
+def parse_weights(text):
+    """
+    Weights given as "term=weight,..." (REWARD_WEIGHTS or --reward-weights),
+    0 turning a term off. The terms not given keep their weight of 1.
+    """
+    weights = {}
+    for item in filter(None, (part.strip() for part in (text or "").split(","))):
+        term, _, weight = item.partition("=")
+        if term not in DEFAULT_WEIGHTS:
+            raise ValueError(f"Unknown reward term {term}, the terms are {list(DEFAULT_WEIGHTS)}")
+        weights[term] = float(weight)
+    return weights
+
+
+class RewardStats:
+    """Count, sum, sum of squares, nonzero count and extremes of the weighted terms."""
+
+    FIELDS = ("count", "total", "squares", "nonzero", "minimum", "maximum")
+
+    def __init__(self, terms):
+        self.terms = tuple(terms)
+        self.reset()
+
+    def reset(self):
+        self.values = np.zeros((len(self.FIELDS), len(self.terms)), dtype=np.float64)
+        self.values[4] = np.inf
+        self.values[5] = -np.inf
+
+    def record(self, values, terms=slice(None)):
+        """Add a step of the games, values being (terms, games) for the `terms` indices."""
+        if values.size:
+            stats = self.values[:, terms]
+            stats[0] += values.shape[1]
+            stats[1] += values.sum(axis=1)
+            stats[2] += np.square(values).sum(axis=1)
+            stats[3] += np.count_nonzero(values, axis=1)
+            np.minimum(stats[4], values.min(axis=1), out=stats[4])
+            np.maximum(stats[5], values.max(axis=1), out=stats[5])
+            self.values[:, terms] = stats
+
+    def merge(self, other):
+        """Add the statistics of another RewardStats of the same terms."""
+        self.values[:4] += other.values[:4]
+        np.minimum(self.values[4], other.values[4], out=self.values[4])
+        np.maximum(self.values[5], other.values[5], out=self.values[5])
+
+    def summary(self):
+        """Mean, standard deviation, share of nonzero steps and extremes of each term."""
+        summary = {}
+        for index, term in enumerate(self.terms):
+            count, total, squares, nonzero, minimum, maximum = self.values[:, index]
+            if not count:
+                continue
+            mean = total / count
+            summary[term] = {
+                "mean": mean,
+                "std": float(np.sqrt(max(squares / count - mean * mean, 0.0))),
+                "nonzero": nonzero / count,
+                "min": minimum,
+                "max": maximum,
+            }
+        return summary
+
+    def format(self):
+        return " ".join(
+            f"{term}={stats['mean']:+.3f}({100 * stats['nonzero']:.0f}%)" for term, stats in self.summary().items()
+        )
+
+
+class RewardEngine:
+    """
+    Shaping rewards of a batch of games, each term computed over arrays.
+
+    Every game is a row: its last score, distance to the food, steps without
+    food and a visit count grid. A step gives the reward of every game from
+    the food cells, the danger mask of the map and the heads, so no map is
+    scanned in Python. Each term has a weight, and a weight of 0 skips it.
+    """
+
+    def __init__(self, batch_size, grid_shape, weights=None):
+        """
+        Args:
+            batch_size: Number of games
+            grid_shape: Shape of the observation grid, (width, height) of the game
+            weights: Weight of each term, see TERMS, those not given are 1
+        """
+        self.batch_size = batch_size
+        self.grid_shape = tuple(grid_shape)
+        self.weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        self.terms = [term for term in TERMS if self.weights[term]]
+        self._weights = np.array([[self.weights[term]] for term in TERMS])
+        self._enabled = np.array([TERMS.index(term) for term in self.terms], dtype=np.int64)
+        self.stats = RewardStats((*TERMS, GAME_OVER))
+
+        self.last_score = np.zeros(batch_size, dtype=np.int64)
+        self.distance = np.full(batch_size, np.nan)  # nan while no food was seen
+        self.hunger = np.zeros(batch_size, dtype=np.int64)  # steps without food
+        self.visits = np.zeros((batch_size, *self.grid_shape), dtype=np.int32)
+
+    def reset(self, index=slice(None), heads=None, foods=None):
+        """
+        Start new episodes.
+
+        Args:
+            index: Games to reset, all of them by default
+            heads: Grid cells of their heads, to measure the first distance to the food
+            foods: Food cells of their first maps, see food_distance
+        """
+        self.last_score[index] = 0
+        self.hunger[index] = 0
+        self.visits[index] = 0
+        self.distance[index] = np.nan
+        if heads is not None and foods is not None:
+            self.distance[index] = self.food_distance(heads, foods)
+
+    @staticmethod
+    def food_distance(heads, foods):
+        """
+        Manhattan distance from each head to the nearest food, nan without food:
+        the distance transform of the food cells, read at the heads.
+
+        Args:
+            heads: (batch, 2) grid cells
+            foods: One (n, 2) array of food cells per game
+        """
+        distance = np.full(len(heads), np.nan)
+        counts = [len(cells) for cells in foods]
+        if sum(counts):
+            owner = np.repeat(np.arange(len(heads)), counts)
+            cells = np.concatenate([cells for cells in foods if len(cells)])
+            np.fmin.at(distance, owner, np.abs(cells - heads[owner]).sum(axis=1))
+        return distance
+
+    def rewards(self, scores, lengths, heads, has_body, actions, foods, danger, traverse, game_over,
+                index=slice(None)):
+        """
+        Rewards of one step of the games.
+
+        Args:
+            scores: (batch,) score of each game
+            lengths: (batch,) length of each body, 1 without body
+            heads: (batch, 2) grid cell of each head, anything without body
+            has_body: (batch,) whether the state carried the body
+            actions: (batch,) action taken before this step, NO_ACTION for none
+            foods: One (n, 2) array of food cells per game
+            danger: (batch, *grid_shape) cells that kill the snake
+            traverse: (batch,) whether the snake crosses the walls
+            game_over: (batch,) games whose episode just ended
+            index: Rows of the engine holding these games, all of them by default
+
+        Returns:
+            (batch,) float32 rewards
+        """
+        rows = np.arange(self.batch_size)[index]
+        alive = ~np.asarray(game_over, dtype=bool)
+        total = np.zeros(len(rows))
+        live = rows[alive]
+        body = np.asarray(has_body, dtype=bool)[alive]
+        heads = np.asarray(heads, dtype=np.int64)[alive]
+
+        scores = np.asarray(scores)[alive]
+        eaten = scores > self.last_score[live]
+        self.last_score[live] = scores
+        self.hunger[live] = np.where(eaten, 0, self.hunger[live]) + 1
+
+        # one row per term, weighted and added up at the end
+        values = np.zeros((len(TERMS), len(live)))
+        food, survival, distance, danger_, efficiency, exploration = values
+        if "food" in self.terms:
+            bonus = np.minimum(LENGTH_BONUS * np.asarray(lengths)[alive], MAX_LENGTH_BONUS)
+            food[eaten] = FOOD_REWARD + bonus[eaten]
+        if "survival" in self.terms:
+            survival[:] = SURVIVAL_REWARD
+        if "distance" in self.terms:
+            current = self.food_distance(heads, [foods[i] for i in np.flatnonzero(alive)])
+            measured = body & ~np.isnan(current) & ~np.isnan(self.distance[live])
+            change = (self.distance[live] - current)[measured]
+            distance[measured] = np.where(change > 0, CLOSER_REWARD, FARTHER_PENALTY) * change
+            seen = body & ~np.isnan(current)
+            self.distance[live[seen]] = current[seen]
+        if "danger" in self.terms:
+            danger_[body & self._deadly(danger, heads, actions, traverse, alive)] = DANGER_PENALTY
+        if "efficiency" in self.terms:
+            hunger = self.hunger[live]
+            efficiency[:] = np.where(
+                hunger > HUNGER_STEPS, np.maximum(HUNGER_PENALTY * (hunger - HUNGER_STEPS), MAX_HUNGER_PENALTY), 0.0
+            )
+        if "exploration" in self.terms:
+            cells = (live[body], *(heads[body] % self.grid_shape).T)
+            exploration[body] = np.where(self.visits[cells] == 0, EXPLORATION_BONUS, 0.0)
+            self.visits[cells] += 1
+
+        values *= self._weights
+        self.stats.record(values[self._enabled], self._enabled)
+        total[alive] = np.clip(values.sum(axis=0), *REWARD_RANGE)
+        if not alive.all():
+            over = np.full((1, np.count_nonzero(~alive)), self.weights[GAME_OVER] * GAME_OVER_PENALTY)
+            self.stats.record(over, slice(len(TERMS), None))
+            total[~alive] = over[0]
+        return total.astype(np.float32)
+
+    def _deadly(self, danger, heads, actions, traverse, alive):
+        """Whether the cell each action leads to is a body cell or, without traverse, off the grid."""
+        actions = np.asarray(actions, dtype=np.int64)[alive]
+        acted = actions != NO_ACTION
+        cells = heads + ACTION_OFFSETS[np.where(acted, actions, 0)]
+        shape = np.array(self.grid_shape)
+        wrap = np.asarray(traverse, dtype=bool)[alive]
+        outside = ((cells < 0) | (cells >= shape)).any(axis=1) & ~wrap
+        cells = cells % shape
+        danger = np.asarray(danger)[alive]
+        return acted & (outside | danger[np.arange(len(cells)), cells[:, 0], cells[:, 1]])
@@ -0,0 +1,137 @@
+"""
+League self-play: train against frozen checkpoints of the agent, rated with Elo.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import argparse
+import logging
+import multiprocessing as mp
+
+import numpy as np
+
+from batched_snake_env import AGENTS, TRAIN_EVERY, BatchedSnakeEnv, train
+from league import League, LeagueGame, MatchScheduler
+from policy_export import EXPORTERS, export_policy
+from rewards import parse_weights
+
+# The loop:
+#
+#   learner      A BatchedSnakeEnv of LeagueGames: every game is the learner's
+#                snake against opponents drawn from the league, the checkpoints
+#                the learner loses to most drawn most often. Each game is rated
+#                when the learner's episode ends.
+#   snapshots    Every --snapshot-every game steps the agent is exported with
+#                policy_export.py into the league as a new frozen checkpoint.
+#   evaluation   Each snapshot schedules --eval-matches games between the
+#                checkpoints, played in worker processes with NumPy alone and
+#                rated as they end, between two batched steps of the learner.
+
+SNAPSHOT_EVERY = 50_000  # game steps between two checkpoints
+EVAL_MATCHES = 8  # evaluation matches scheduled after each checkpoint
+
+logger = logging.getLogger("SelfPlay")
+
+
+class SelfPlay:
+    """Adds checkpoints of a training agent to a league and rates them."""
+
+    def __init__(self, agent, agent_type, env, league, scheduler, snapshot_every=SNAPSHOT_EVERY,
+                 eval_matches=EVAL_MATCHES):
+        """
+        Initialize the loop.
+
+        Args:
+            agent: Agent being trained
+            agent_type: Key of AGENTS, for policy_export.py
+            env: BatchedSnakeEnv of the agent, for its observation options
+            league: League the checkpoints are added to
+            scheduler: MatchScheduler of the evaluation matches
+            snapshot_every: Game steps between two checkpoints
+            eval_matches: Evaluation matches scheduled after each checkpoint
+        """
+        self.agent = agent
+        self.agent_type = agent_type
+        self.env = env
+        self.league = league
+        self.scheduler = scheduler
+        self.snapshot_every = snapshot_every
+        self.eval_matches = eval_matches
+        self._last_snapshot = 0
+
+    def snapshot(self):
+        """Export the agent as the league's newest checkpoint and schedule its evaluation."""
+        self.agent.get_weights()  # the DQN networks are built on first use
+        name = f"checkpoint-{len(self.league.checkpoints):04d}"
+        export_policy(self.agent, self.agent_type, self.env.envs[0], self.league.path(name))
+        self.league.add(name)
+        self.scheduler.schedule(self.eval_matches)
+        self.league.save()
+        logger.info("Checkpoint %s added, %s matches pending\n%s", name, self.scheduler.pending, self.league.table())
+        return name
+
+    def on_step(self, steps):
+        """train() callback: rate the matches that ended and take the snapshots that are due."""
+        self.scheduler.collect()
+        if steps - self._last_snapshot >= self.snapshot_every:
+            self._last_snapshot = steps
+            self.snapshot()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train an agent against a league of its own checkpoints")
+    # the agents policy_export.py can freeze into a checkpoint
+    parser.add_argument("--agent", choices=EXPORTERS, default="dqn")
+    parser.add_argument("--league", default="league", help="League directory, created if missing")
+    parser.add_argument("--envs", type=int, default=8, help="Games played at once")
+    parser.add_argument("--steps", type=int, default=1_000_000, help="Game steps, over all games")
+    parser.add_argument("--train-every", type=int, help="Batched steps between updates")
+    parser.add_argument("--opponents", type=int, default=1, help="Checkpoints the learner plays in each game")
+    parser.add_argument("--snapshot-every", type=int, default=SNAPSHOT_EVERY, help="Game steps between checkpoints")
+    parser.add_argument("--eval-matches", type=int, default=EVAL_MATCHES, help="Evaluation matches per checkpoint")
+    parser.add_argument("--eval-workers", type=int, default=max(1, mp.cpu_count() - 2))
+    parser.add_argument("--eval-players", type=int, default=2, help="Snakes in each evaluation match")
+    parser.add_argument("--timeout", type=int, help="Steps of each game")
+    parser.add_argument("--name", default="student")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--crop", type=int, help="Side of the egocentric observation crop, odd")
+    parser.add_argument("--memory", action="store_true", help="Remember what earlier steps saw")
+    parser.add_argument("--frames", type=int, default=1, help="Last maps stacked in the observations")
+    parser.add_argument("--reward-weights", type=parse_weights, help='Weights of the reward terms, e.g. "danger=0,distance=0.5"')
+    parser.add_argument("--reachability", action="store_true", help="Add the area and food distance of each move")
+    parser.add_argument("--policy", help="Saved policy to start from")
+    parser.add_argument("--output", help="Where to save the policy")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+    league = League(args.league)
+    game_args = {"timeout": args.timeout} if args.timeout else {}
+    games = [
+        LeagueGame(league, f"{args.name}{i}", None if args.seed is None else args.seed + i, args.opponents, **game_args)
+        for i in range(args.envs)
+    ]
+    env = BatchedSnakeEnv(args.envs, name=args.name, crop_size=args.crop, memory=args.memory, frames=args.frames,
+                          reward_weights=args.reward_weights, reachability=args.reachability, games=games)
+    agent = AGENTS[args.agent](env)
+    if args.policy:
+        agent.load(args.policy)
+    scheduler = MatchScheduler(league, args.eval_workers, args.eval_players, args.timeout)
+    self_play = SelfPlay(agent, args.agent, env, league, scheduler, args.snapshot_every, args.eval_matches)
+    if not league.checkpoints:
+        self_play.snapshot()  # the first opponent is the untrained agent
+    try:
+        scores = train(agent, env, args.steps, args.train_every or TRAIN_EVERY[args.agent], on_step=self_play.on_step)
+        self_play.snapshot()
+        scheduler.collect(wait=True)
+    finally:
+        env.close()
+        scheduler.close()
+        league.save()
+
+    if scores:
+        logger.info("%s episodes, avg score %.2f, max %s", len(scores), np.mean(scores), max(scores))
+    logger.info("League after %s learner games\n%s", sum(game.games for game in games), league.table())
+    output = args.output or f"policy/{args.agent}_agent_self_play"
+    agent.save(output)
+    logger.info("Policy saved: %s", output)
@@ -7,8 +7,9 @@ import json
 import logging
 import os.path
 import random
+import time
 from collections import namedtuple
-from typing import Any, Dict, Set
+from typing import Any, Dict, Optional, Set
 
 import requests
 import websockets
@@ -17,6 +18,15 @@ from websockets.legacy.protocol import WebSocketCommonProtocol
 
 from game import Game
 from consts import TIMEOUT
+from replay import ReplayRecorder
+from protocol import (
+    PROTOCOL_BINARY,
+    PROTOCOL_JSON,
+    PROTOCOLS,
+    diff_viewer_state,
+    encode_state,
+    viewer_keyframe,
+)
 
 logging.basicConfig(
     level=logging.DEBUG, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s"
@@ -27,149 +37,288 @@ wslogger.setLevel(logging.WARN)
 logger = logging.getLogger("Server")
 logger.setLevel(logging.INFO)
 
-Player = namedtuple("Player", ["name", "ws"])
+Player = namedtuple("Player", ["name", "ws", "protocol"], defaults=[PROTOCOL_JSON])
 
 HIGHSCORE_FILE = "highscores.json"
 MAX_HIGHSCORES = 10
 
-
-class GameServer:
-    """Network Game Server."""
-
-    def __init__(
-        self,
-        level: int,
-        timeout: int,
-        seed: int = 0,
-        players=1,
-        grading: str = None,
-        dbg: bool = False,
-    ):
-        """Initialize Gameserver."""
-        self.dbg = dbg
-        self.seed = seed
-        self.game = Game(timeout=timeout)
+CLIENT_QUEUE_SIZE = 64  # messages waiting for a slow client before the policy kicks in
+DROP_OLDEST = "drop-oldest"
+DISCONNECT = "disconnect"
+FLUSH_TIMEOUT = 1.0  # seconds to deliver pending messages before closing a client
+
+
+class ClientChannel:
+    """Outgoing messages of one client.
+
+    Messages are queued and sent by a background task, so the game loop never
+    waits on a socket. When a client falls CLIENT_QUEUE_SIZE messages behind,
+    its oldest message is dropped or the client is disconnected.
+    """
+
+    def __init__(self, websocket: WebSocketCommonProtocol, size: int, policy: str):
+        """Initialize ClientChannel."""
+        self.ws = websocket
+        self.policy = policy
+        self.dropped = 0
+        self.resync = False  # set when a message was dropped since the last keyframe
+        self.closed = False
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=size)
+        self._sender = asyncio.create_task(self._send_loop())
+
+    def push(self, payload) -> bool:
+        """Queue an already encoded message, returns False if the client is gone."""
+        if self.closed or self.ws.closed:
+            return False
+        try:
+            self._queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            if self.policy == DISCONNECT:
+                logger.warning("Disconnecting slow client %s", self.ws.remote_address)
+                self.closed = True
+                asyncio.create_task(self.close(flush=False))
+                return False
+            self._queue.get_nowait()
+            self._queue.task_done()
+            self._queue.put_nowait(payload)
+            self.dropped += 1
+            self.resync = True
+        return True
+
+    async def _send_loop(self):
+        try:
+            while True:
+                payload = await self._queue.get()
+                await self.ws.send(payload)
+                self._queue.task_done()
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.closed = True
+            await self.ws.close()
+
+    async def close(self, flush: bool = True):
+        """Close the client, first giving pending messages a chance to go out."""
+        if flush and not self.closed and not self.ws.closed:
+            try:
+                await asyncio.wait_for(self._queue.join(), FLUSH_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+        self.closed = True
+        self._sender.cancel()
+        await self.ws.close()
+
+
+class Room:
+    """One game table: its own Game, step loop, players, viewers and results."""
+
+    def __init__(self, server: GameServer, room_id: int, players: int):
+        """Initialize Room."""
+        self.server = server
+        self.room_id = room_id
+        # until the first game starts, a placeholder that draws from no shared generator
+        self.game = Game(timeout=server._timeout, rng=random.Random())
         self.players: asyncio.Queue[Player] = asyncio.Queue()
         self.viewers: Set[WebSocketCommonProtocol] = set()
-        self.grading = grading
-        self._level = level  # game level
-        self._timeout = timeout  # timeout for game
+        # viewers that get a keyframe and then per step deltas
+        self.delta_viewers: Set[WebSocketCommonProtocol] = set()
+        self._needs_keyframe: Set[WebSocketCommonProtocol] = set()
+        self._viewer_state = None
         self.game_player = {}  # websocket to player mapping
         self.number_of_players = players
-
-        self._highscores = []
-        if os.path.isfile(HIGHSCORE_FILE):
-            with open(HIGHSCORE_FILE, "r") as infile:
-                self._highscores = json.load(infile)
+        self.logger = logging.getLogger(f"Server.Room{room_id}")
+
+        self.games_played = 0
+        self.total_steps = 0
+        self.total_step_time = 0.0
+        self.results = []  # (player, score) of every game played in this room
+
+    @property
+    def waiting(self):
+        """Number of players queued for the next game."""
+        return self.players.qsize()
+
+    def game_clients(self):
+        """Websockets of the players in the current game, not of those queued for the next."""
+        return [ws for ws, name in self.game_player.items() if name in self.game.snakes]
+
+    def free_slots(self):
+        """Seats left in the next game of this room."""
+        if self.game.running:
+            return 0
+        return max(0, self.number_of_players - self.waiting)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Per-room statistics."""
+        return {
+            "room": self.room_id,
+            "running": self.game.running,
+            "step": self.game._step,
+            "waiting": self.waiting,
+            "viewers": len(self.viewers) + len(self.delta_viewers),
+            "games_played": self.games_played,
+            "total_steps": self.total_steps,
+            "steps_per_second": (
+                self.total_steps / self.total_step_time if self.total_step_time else 0.0
+            ),
+        }
 
     def save_highscores(self):
-        """Update highscores, storing to file."""
-
-        logger.debug("Save highscores")
+        """Record the scores of this room's game and update the server highscores."""
+        scores = []
         for player in self.game_player.values():
             if player not in self.game.snakes:
                 continue
-            logger.info(
+            self.logger.info(
                 "Saving: %s <%s>",
                 player,
                 self.game.snakes[player].score,
             )
+            scores.append((player, self.game.snakes[player].score))
 
-            self._highscores.append((player, self.game.snakes[player].score))
-            self._highscores = sorted(
-                self._highscores, key=lambda s: s[1], reverse=True
-            )[:MAX_HIGHSCORES]
-
-        with open(HIGHSCORE_FILE, "w") as outfile:
-            json.dump(self._highscores, outfile)
-
-        return self._highscores
+        self.results.extend(scores)
+        return self.server.save_highscores(scores)
 
     async def send_clients(self, group, info):
+        """Encode info once and queue it for every client of the group."""
         to_remove = []
 
         original_group = group
         if isinstance(group, dict):
             group = group.keys()
 
+        payload = json.dumps(info)
         for client in group:
-            try:
-                await client.send(json.dumps(info))
-            except Exception:
+            channel = self.server.channel(client)
+            if channel is None or not channel.push(payload):
                 to_remove.append(client)
-                await client.close()
         for client in to_remove:
             if isinstance(original_group, dict):
                 del original_group[client]        
             else:
                 original_group.remove(client)
 
-    async def incomming_handler(self, websocket: WebSocketCommonProtocol, path: str):
-        """Process new clients arriving at the server."""
-        try:
-            async for message in websocket:
-                data = json.loads(message)
-                if "cmd" not in data:
-                    continue
-                if data["cmd"] == "join":
-                    if path == "/player":
-                        if data["name"] in self.game_player.values():
-                            logger.error("Player <%s> already exists", data["name"])
-                            await websocket.close()
-                            continue
-                        logger.info("<%s> has joined", data["name"])
-                        await self.players.put(Player(data["name"], websocket))
-                        self.game_player[websocket] = data["name"]
-
-                    if path == "/viewer":
-                        logger.info("Viewer connected")
-                        self.viewers.add(websocket)
-
-                    if self.game.running:
-                        game_info = self.game.info()
-                        await websocket.send(json.dumps(game_info))
-
-                if data["cmd"] == "key":
-                    logger.debug((self.game_player[websocket], data))
-                    if len(data["key"]) > 0:
-                        self.game.keypress(self.game_player[websocket], data["key"][0])
-                    else:
-                        self.game.keypress(self.game_player[websocket], "")
-
-        except websockets.exceptions.ConnectionClosed as closed_reason:
-            logger.info("Client disconnected: %s", closed_reason)
-            if websocket in self.viewers:
-                self.viewers.remove(websocket)
+    async def close_clients(self, clients):
+        """Flush and close clients concurrently, dropping their channels."""
+        channels = {ws: self.server.channels.pop(ws, None) for ws in clients}
+        await asyncio.gather(
+            *(ws.close() if channel is None else channel.close() for ws, channel in channels.items())
+        )
+
+    async def end_game(self, clients, keep_sessions=True):
+        """Release the players of the game that ended, closing those without a session.
+
+        The players are released before anything is awaited, so a next_game
+        sent as soon as the game over arrives finds them free to be seated.
+        """
+        self.server.release_players(self, clients)
+        if keep_sessions:
+            clients = [ws for ws in clients if ws not in self.server.sessions]
+        await self.close_clients(clients)
+
+    def add_viewer(self, websocket: WebSocketCommonProtocol, delta: bool = False):
+        if delta:
+            self.delta_viewers.add(websocket)
+            self._needs_keyframe.add(websocket)
+        else:
+            self.viewers.add(websocket)
+
+    def remove_viewer(self, websocket: WebSocketCommonProtocol):
+        self.viewers.discard(websocket)
+        self.delta_viewers.discard(websocket)
+        self._needs_keyframe.discard(websocket)
+
+    async def send_viewers(self, info):
+        """Send a message that is the same for every kind of viewer."""
+        await self.send_clients(self.viewers, info)
+        await self.send_clients(self.delta_viewers, info)
+
+    async def send_viewers_state(self, state):
+        """Send the full state to plain viewers and a keyframe or delta to the others."""
+        await self.send_clients(self.viewers, state)
+        if not self.delta_viewers:
+            self._viewer_state = None
+            return
+
+        keyframe = viewer_keyframe(state)
+        if self._viewer_state is None:
+            self._needs_keyframe.update(self.delta_viewers)
+            delta = None
+        else:
+            delta = {"delta": diff_viewer_state(self._viewer_state, keyframe)}
+        self._viewer_state = keyframe
+
+        # a viewer that lost a message can no longer apply deltas
+        for ws in self.delta_viewers:
+            channel = self.server.channel(ws)
+            if channel is not None and channel.resync:
+                channel.resync = False
+                self._needs_keyframe.add(ws)
+
+        late = self._needs_keyframe & self.delta_viewers
+        self._needs_keyframe = set()
+        await self.send_clients(set(late), keyframe)
+        if delta is not None:
+            await self.send_clients(self.delta_viewers - late, delta)
+        self.delta_viewers = {ws for ws in self.delta_viewers if not ws.closed}
 
     async def mainloop(self):
-        """Run the game."""
+        """Run the games of this room."""
         while True:
             game_players = []
-            logger.info("Waiting for players")
+            self.logger.info("Waiting for players")
             while len(game_players) < self.number_of_players:
                 game_players.append(await self.players.get())
 
                 if game_players[-1].ws.closed:
-                    logger.error("<%s> disconnect while waiting", game_players[-1].name)
+                    self.logger.error("<%s> disconnect while waiting", game_players[-1].name)
                     continue
 
+            recorder = None
+            clients = None  # players of this game still to release, once it is over
             try:
-                logger.info("Starting game")
-                if self.seed > 0:
-                    random.seed(self.seed)
-
-                self.game = Game(timeout=self._timeout)
+                self.logger.info("Starting game")
+                clock_start = None
+                # each game draws from its own generator, so rooms don't disturb
+                # each other and a seeded game is the same in every room
+                rng = random.Random()
+                if self.server.seed > 0:
+                    rng.seed(self.server.seed)
+                    clock_start = datetime.fromtimestamp(self.server.seed)
+
+                if self.server.record:
+                    recorder = ReplayRecorder(
+                        os.path.join(
+                            self.server.record,
+                            f"{datetime.now():%Y%m%d-%H%M%S}"
+                            f"-room{self.room_id}-{self.games_played + 1}.replay",
+                        ),
+                        seed=self.server.seed,
+                        room=self.room_id,
+                    )
+
+                self.game = Game(
+                    timeout=self.server._timeout,
+                    turbo=self.server.turbo,
+                    step_deadline=self.server.step_deadline,
+                    clock_start=clock_start,
+                    compact_sight=self.server.compact_sight,
+                    rng=rng,
+                    recorder=recorder,
+                )
                 self.game.start([p.name for p in game_players])
+                self._viewer_state = None
+                game_start = time.perf_counter()
 
                 while self.game.running:
                     if self.game._step == 0:  # Starting a level ? Let's send the info
                         game_info = self.game.info()
 
-                        await self.send_clients(self.viewers, game_info)
-                        await self.send_clients(self.game_player, game_info)
+                        await self.send_viewers(game_info)
+                        await self.send_clients(self.game_clients(), game_info)
 
                     if state := await self.game.next_frame():
-                        await self.send_clients(self.viewers, state)
+                        await self.send_viewers_state(state)
 
                         snakes = state["snakes"]
                         del state[
@@ -179,50 +328,261 @@ class GameServer:
                             "food"
                         ]  # remove food from state as we only send our snake sight
 
-                        for player in game_players:
-                            state["ts"] = datetime.now().isoformat()
+                        for player in list(game_players):
+                            state["ts"] = self.game.now().isoformat()
                             for player_snake in snakes:
                                 if player_snake["name"] == player.name:
                                     state = {**state, **player_snake}
-                            try:
-                                await player.ws.send(json.dumps(state))
-                            except Exception as e:
-                                logger.error(
+                            if player.protocol == PROTOCOL_BINARY:
+                                payload = encode_state(state, self.game.map.size)
+                            else:
+                                payload = json.dumps(state)
+                            channel = self.server.channel(player.ws)
+                            if channel is None or not channel.push(payload):
+                                self.logger.error(
                                     "Player <%s> disconnected, could not send state",
                                     player.name,
                                 )
                                 game_players.remove(player)
 
-                game_over = {"highscores": self.save_highscores()}
-                await self.send_clients(self.viewers, game_over)
-                await self.send_clients(self.game_player, game_over)
+                self.games_played += 1
+                self.total_steps += self.game._step
+                self.total_step_time += time.perf_counter() - game_start
+                self.logger.info("Game over: %s", self.metrics())
 
-                for ws, player in self.game_player.items():
-                    await ws.close()
-                self.game_player = {}
+                game_over = {"highscores": self.save_highscores()}
+                clients = self.game_clients()
+                await self.send_viewers(game_over)
+                await self.send_clients(list(clients), game_over)
+                await self.end_game(clients)
+                clients = []
 
             except websockets.exceptions.ConnectionClosed as ws_closed:
                 if ws_closed in self.game_player:
                     self.game_player.pop(ws_closed)
-                logger.error("Player disconnected: %s", ws_closed)
+                self.logger.error("Player disconnected: %s", ws_closed)
             finally:
+                if recorder is not None:
+                    recorder.close()  # a game cut short keeps the steps played so far
                 try:
-                    if self.grading:
+                    if self.server.grading:
                         for player in game_players:
                             game_record = {
                                 "player": player.name,
                                 "score": self.game.snakes[player.name].score,
                                 "players": self.number_of_players, 
                             }
-                            requests.post(self.grading, json=game_record, timeout=2)
+                            requests.post(self.server.grading, json=game_record, timeout=2)
                 except RequestException as err:
-                    logger.error(err)
-                    logger.warning("Could not save score to server")
+                    self.logger.error(err)
+                    self.logger.warning("Could not save score to server")
+
+                # a game cut short also closes the players with a session
+                if clients is None:
+                    clients = self.game_clients()
+                for ws in clients:
+                    self.logger.info("Disconnecting <%s>", self.game_player.get(ws))
+                await self.end_game(clients, keep_sessions=False)
+
+
+class GameServer:
+    """Network Game Server."""
+
+    def __init__(
+        self,
+        level: int,
+        timeout: int,
+        seed: int = 0,
+        players=1,
+        grading: str = None,
+        dbg: bool = False,
+        turbo: bool = False,
+        step_deadline: float = None,
+        rooms: int = 1,
+        compact_sight: bool = False,
+        client_queue: int = CLIENT_QUEUE_SIZE,
+        slow_client_policy: str = DROP_OLDEST,
+        record: str = None,
+    ):
+        """Initialize Gameserver."""
+        self.dbg = dbg
+        self.seed = seed
+        self.turbo = turbo
+        self.step_deadline = step_deadline
+        self.compact_sight = compact_sight
+        self.grading = grading
+        self._level = level  # game level
+        self._timeout = timeout  # timeout for game
+        self.number_of_players = players
+        self.rooms = [Room(self, room_id, players) for room_id in range(rooms)]
+        self.player_room: Dict[WebSocketCommonProtocol, Room] = {}  # websocket to room mapping
+        # players that joined with "session": their connection outlives each game and
+        # the next_game command seats them again, without a new connection and join
+        self.sessions: Dict[WebSocketCommonProtocol, Player] = {}
+        self.client_queue = client_queue
+        self.slow_client_policy = slow_client_policy
+        self.channels: Dict[WebSocketCommonProtocol, ClientChannel] = {}
+        self.record = record  # directory for the replays of every game, if set
+        if record:
+            os.makedirs(record, exist_ok=True)
+
+        self._highscores = []
+        if os.path.isfile(HIGHSCORE_FILE):
+            with open(HIGHSCORE_FILE, "r") as infile:
+                self._highscores = json.load(infile)
+
+    @property
+    def game(self):
+        """Game of the first room."""
+        return self.rooms[0].game
+
+    def save_highscores(self, scores):
+        """Update highscores, storing to file."""
+
+        logger.debug("Save highscores")
+        for player, score in scores:
+            self._highscores.append((player, score))
+            self._highscores = sorted(
+                self._highscores, key=lambda s: s[1], reverse=True
+            )[:MAX_HIGHSCORES]
+
+        with open(HIGHSCORE_FILE, "w") as outfile:
+            json.dump(self._highscores, outfile)
+
+        return self._highscores
+
+    def open_channel(self, websocket: WebSocketCommonProtocol) -> ClientChannel:
+        """Outgoing queue of a client that joined, created by its handler."""
+        if websocket not in self.channels:
+            self.channels[websocket] = ClientChannel(
+                websocket, self.client_queue, self.slow_client_policy
+            )
+        return self.channels[websocket]
+
+    def channel(self, websocket: WebSocketCommonProtocol) -> Optional[ClientChannel]:
+        """Outgoing queue of a client, None once it is gone or closed."""
+        channel = self.channels.get(websocket)
+        if channel is None or channel.closed or websocket.closed:
+            return None
+        return channel
+
+    def metrics(self):
+        """Statistics of every room."""
+        return [room.metrics() for room in self.rooms]
+
+    def match_room(self) -> Room:
+        """Pick the room a new player should join.
+
+        Rooms already waiting for more players come first so their game can start,
+        then idle rooms, and when every room is busy the one with the shortest queue.
+        """
+        free = [room for room in self.rooms if room.free_slots() > 0]
+        if free:
+            return min(free, key=lambda room: (room.free_slots(), room.room_id))
+        return min(self.rooms, key=lambda room: (room.waiting, room.room_id))
+
+    def release_players(self, room: Room, clients=None):
+        """Forget the players of a finished game, keeping those queued for the next one."""
+        for ws in room.game_clients() if clients is None else clients:
+            if self.player_room.get(ws) is room:
+                del self.player_room[ws]
+            room.game_player.pop(ws, None)
+
+    async def seat(self, player: Player):
+        """Queue a player for the next game of the best room."""
+        room = self.match_room()
+        logger.info("<%s> has joined room %s", player.name, room.room_id)
+        await room.players.put(player)
+        room.game_player[player.ws] = player.name
+        self.player_room[player.ws] = room
+
+    def name_taken(self, name: str) -> bool:
+        """Whether a seated player or an open session already uses the name."""
+        return any(name in room.game_player.values() for room in self.rooms) or any(
+            player.name == name for player in self.sessions.values()
+        )
+
+    def viewer_room(self, path: str) -> Room:
+        """Rooms are watched at /viewer/<room>, plain /viewer watches the first one."""
+        try:
+            room_id = int(path.rstrip("/").rsplit("/", 1)[1])
+        except (IndexError, ValueError):
+            room_id = 0
+        return self.rooms[room_id] if 0 <= room_id < len(self.rooms) else self.rooms[0]
+
+    async def incomming_handler(self, websocket: WebSocketCommonProtocol, path: str):
+        """Process new clients arriving at the server."""
+        try:
+            async for message in websocket:
+                data = json.loads(message)
+                if "cmd" not in data:
+                    continue
+                if data["cmd"] == "join":
+                    if path == "/player":
+                        if self.name_taken(data["name"]):
+                            logger.error("Player <%s> already exists", data["name"])
+                            await websocket.close()
+                            continue
+                        version = data.get("protocol", PROTOCOL_JSON)
+                        if version not in PROTOCOLS:
+                            logger.warning(
+                                "<%s> asked for unknown protocol %s, using JSON",
+                                data["name"],
+                                version,
+                            )
+                            version = PROTOCOL_JSON
+                        player = Player(data["name"], websocket, version)
+                        if data.get("session", False):
+                            self.sessions[websocket] = player
+                        self.open_channel(websocket)
+                        await self.seat(player)
+
+                    if path.startswith("/viewer"):
+                        room = self.viewer_room(path)
+                        logger.info("Viewer connected to room %s", room.room_id)
+                        self.open_channel(websocket)
+                        room.add_viewer(websocket, data.get("delta", False))
+
+                        # players queued in a busy room get the info when their game starts
+                        if room.game.running:
+                            game_info = room.game.info()
+                            self.open_channel(websocket).push(json.dumps(game_info))
+
+                if data["cmd"] == "next_game":
+                    player = self.sessions.get(websocket)
+                    if player is None:
+                        logger.warning("next_game from a client that joined without a session")
+                        continue
+                    if websocket in self.player_room:
+                        logger.warning("<%s> asked for a game while still seated", player.name)
+                        continue
+                    await self.seat(player)
+
+                if data["cmd"] == "key":
+                    room = self.player_room.get(websocket)
+                    if room is None:
+                        continue  # a late key of a session between two games
+                    logger.debug((room.game_player[websocket], data))
+                    if room.game_player[websocket] not in room.game.snakes:
+                        continue  # still waiting for the next game of this room
+                    if len(data["key"]) > 0:
+                        room.game.keypress(room.game_player[websocket], data["key"][0])
+                    else:
+                        room.game.keypress(room.game_player[websocket], "")
 
-                for ws, player in self.game_player.items():
-                    logger.info("Disconnecting <%s>", player)
-                    await ws.close()
-                self.game_player = {}
+        except websockets.exceptions.ConnectionClosed as closed_reason:
+            logger.info("Client disconnected: %s", closed_reason)
+            for room in self.rooms:
+                room.remove_viewer(websocket)
+        finally:
+            self.sessions.pop(websocket, None)
+            channel = self.channels.pop(websocket, None)
+            if channel is not None:
+                await channel.close(flush=False)
+
+    async def mainloop(self):
+        """Run the game loop of every room."""
+        await asyncio.gather(*(room.mainloop() for room in self.rooms))
 
 
 if __name__ == "__main__":
@@ -234,6 +594,42 @@ if __name__ == "__main__":
         "--debug", help="Open Bitmap with map on gameover", action="store_true"
     )
     parser.add_argument("--players", help="Number of players", type=int, default=1)
+    parser.add_argument(
+        "--rooms", help="Number of games hosted at the same time", type=int, default=1
+    )
+    parser.add_argument(
+        "--client-queue",
+        help="Messages queued for a slow client before dropping or disconnecting",
+        type=int,
+        default=CLIENT_QUEUE_SIZE,
+    )
+    parser.add_argument(
+        "--slow-client-policy",
+        help="What to do with clients that fall behind",
+        choices=[DROP_OLDEST, DISCONNECT],
+        default=DROP_OLDEST,
+    )
+    parser.add_argument(
+        "--record",
+        help="Directory where a replay of every game is written (see replay.py)",
+        default=None,
+    )
+    parser.add_argument(
+        "--compact-sight",
+        help="Send each snake's sight as a square window instead of a dict of dicts",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--turbo",
+        help="Step as soon as every player sent its key instead of at a fixed FPS",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--step-deadline",
+        help="Seconds to wait for slow players in turbo mode (default: 1/FPS)",
+        type=float,
+        default=None,
+    )
     parser.add_argument(
         "--grading-server",
         help="url of grading server",
@@ -243,7 +639,21 @@ if __name__ == "__main__":
 
     async def main():
         """Start server tasks."""
-        g = GameServer(0, TIMEOUT, args.seed, args.players, args.grading_server, args.debug)
+        g = GameServer(
+            0,
+            TIMEOUT,
+            args.seed,
+            args.players,
+            args.grading_server,
+            args.debug,
+            args.turbo,
+            args.step_deadline,
+            args.rooms,
+            args.compact_sight,
+            args.client_queue,
+            args.slow_client_policy,
+            args.record,
+        )
 
         game_loop_task = asyncio.ensure_future(g.mainloop())
 
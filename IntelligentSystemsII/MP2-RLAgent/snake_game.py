@@ -3,12 +3,16 @@ Logging and WebSocket management for Snake game.
 Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
 """
 import asyncio
+import bisect
 import json
 import os
 import logging
+import time
 from datetime import datetime
 import websockets
 
+from protocol import PROTOCOL_BINARY, decode_message
+
 
 def setup_logging(log_level=logging.INFO, log_file=None):
     """Setup logging configuration."""
@@ -37,15 +41,63 @@ def setup_logging(log_level=logging.INFO, log_file=None):
     return logger
 
 
+class LatencyHistogram:
+    """Latencies of one stage counted in power-of-two millisecond buckets."""
+
+    BOUNDS_MS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128, 256)  # upper bounds, the last bucket is above
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        milliseconds = 1000.0 * seconds
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, milliseconds)] += 1
+        self.count += 1
+        self.total += milliseconds
+        self.max = max(self.max, milliseconds)
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile, in milliseconds."""
+        rank = q / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.BOUNDS_MS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def summary(self):
+        if not self.count:
+            return f"{self.name}: no samples"
+        buckets = " ".join(
+            f"<{bound}:{count}" for bound, count in zip(self.BOUNDS_MS, self.counts) if count
+        )
+        if self.counts[-1]:
+            buckets += f" >{self.BOUNDS_MS[-1]}:{self.counts[-1]}"
+        return (
+            f"{self.name}: n={self.count} mean={self.total / self.count:.2f}ms "
+            f"p50<={self.percentile(50)}ms p99<={self.percentile(99)}ms max={self.max:.2f}ms [{buckets}]"
+        )
+
+
 class SnakeGame:
     """Class to manage the Snake game state and communication."""
     
     def __init__(self, logger=None):
         self.first_state = None
-        self.message_queue = asyncio.Queue()
+        self.message_queue = asyncio.Queue()  # (state, time.perf_counter() at its arrival)
         self.listener_task = None
         self.first_state_received = asyncio.Event()
+        self.first_state_at = None
         self.logger = logger or logging.getLogger('SnakeGame')
+        self.decode_latency = LatencyHistogram("decode")
 
     async def start_listener(self, websocket):
         """Start the WebSocket listener task."""
@@ -67,17 +119,20 @@ class SnakeGame:
         try:
             message_count = 0
             async for message in websocket:
-                state = json.loads(message)
+                received_at = time.perf_counter()
+                state = decode_message(message)
+                self.decode_latency.record(time.perf_counter() - received_at)
                 message_count += 1
                 
                 # If this is the first state, set it and signal
                 if self.first_state is None:
                     self.first_state = state
+                    self.first_state_at = received_at
                     # self.logger.info(f"First state received: Score={state.get('score', 0)}, Lives={state.get('lives', 0)}")
                     self.first_state_received.set()
                 else:
                     # Put subsequent states in the queue
-                    await self.message_queue.put(state)
+                    await self.message_queue.put((state, received_at))
                     if message_count % 100 == 0:  # Log every 100 messages to avoid spam
                         self.logger.debug(f"Processed {message_count} WebSocket messages")
                     
@@ -106,11 +161,16 @@ class SnakeGame:
 
     async def get_state(self):
         """Async method to get the next state from the queue."""
+        state, _ = await self.get_timed_state()
+        return state
+
+    async def get_timed_state(self):
+        """The next state and the time.perf_counter() when it arrived."""
         try:
-            state = await self.message_queue.get()
-            if state is None:
+            item = await self.message_queue.get()
+            if item is None:
                 raise ConnectionError("WebSocket connection closed or error occurred")
-            return state
+            return item
         except Exception as e:
             self.logger.error(f"Error getting state: {e}")
             raise
@@ -119,6 +179,7 @@ class SnakeGame:
         """Reset the game state for a new episode."""
         self.logger.debug("Resetting game state")
         self.first_state = None
+        self.first_state_at = None
         # Clear the message queue
         cleared_messages = 0
         while not self.message_queue.empty():
@@ -130,3 +191,66 @@ class SnakeGame:
         if cleared_messages > 0:
             self.logger.debug(f"Cleared {cleared_messages} messages from queue")
         self.first_state_received.clear()
+
+
+class PlayerSession:
+    """
+    One player connection to server.py kept open across games.
+
+    The first game joins with a session, the next ones are asked for with the
+    next_game command, so neither the connection nor the listener of the
+    SnakeGame are set up again. A game left before its game over drops the
+    connection, the next game then connects again.
+    """
+
+    def __init__(self, server_address, agent_name, game, protocol=PROTOCOL_BINARY):
+        """
+        Args:
+            server_address: "host:port" of server.py
+            agent_name: Name of the player
+            game: SnakeGame receiving the messages
+            protocol: Protocol of the states sent by the server
+        """
+        self.url = f"ws://{server_address}/player"
+        self.agent_name = agent_name
+        self.game = game
+        self.protocol = protocol
+        self.websocket = None
+        self.connections = 0
+
+    @property
+    def connected(self):
+        return self.websocket is not None and not self.websocket.closed
+
+    async def next_game(self, timeout=10.0):
+        """Ask for a new game and wait for its info, returns False if it did not come."""
+        self.game.reset()
+        try:
+            if self.connected:
+                await self.websocket.send(json.dumps({"cmd": "next_game"}))
+            else:
+                await self.close()
+                self.websocket = await websockets.connect(self.url)
+                self.connections += 1
+                await self.game.start_listener(self.websocket)
+                await self.websocket.send(json.dumps(
+                    {"cmd": "join", "name": self.agent_name, "protocol": self.protocol, "session": True}
+                ))
+        except (OSError, websockets.exceptions.WebSocketException) as e:
+            self.game.logger.error(f"Could not start a game: {e}")
+            await self.close()
+            return False
+        if not await self.game.wait_for_first_state(timeout):
+            await self.close()
+            return False
+        return True
+
+    async def send_key(self, key):
+        await self.websocket.send(json.dumps({"cmd": "key", "key": key}))
+
+    async def close(self):
+        """Stop the listener and close the connection."""
+        await self.game.stop_listener()
+        if self.websocket is not None:
+            await self.websocket.close()
+            self.websocket = None
@@ -3,6 +3,7 @@ Train and run policy for the Snake game.
 Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
 """
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import getpass
 import json
 import os
@@ -10,81 +11,149 @@ from sys import argv
 import time
 from datetime import datetime
 import websockets
-from snake_train_env import SnakeTrainEnv
-from agents.snake_dqn_agent import DQNAgent
-from agents.snake_ppo_agent import PPOAgent
-from snake_game import SnakeGame, setup_logging
-
-
-# Dictionary to map "agent types" to their classes
-AGENTS = {
-    "dqn": DQNAgent,
-    "ppo": PPOAgent,
-    # Add other agents here
-}
+from snake_game import LatencyHistogram, PlayerSession, SnakeGame, setup_logging
+from protocol import PROTOCOL_BINARY
+from policy_runtime import play as play_exported
+from rewards import parse_weights
+# The environment, agents and datasets import TensorFlow and TF-Agents, so they
+# are imported where they are used: a .npz policy plays without them
+
+
+def load_agents():
+    """Dictionary to map "agent types" to their classes."""
+    from agents.snake_dqn_agent import DQNAgent
+    from agents.snake_ppo_agent import PPOAgent
+    from agents.snake_expert_agent import ExpertAgent
+
+    return {
+        "dqn": DQNAgent,
+        "ppo": PPOAgent,
+        "expert": ExpertAgent,
+        # Add other agents here
+    }
+
+# Side of the egocentric observation crop (CROP=13), the whole map if not set
+CROP_SIZE = int(os.environ["CROP"]) if os.environ.get("CROP") else None
+# Remember what was seen in earlier steps (MEMORY=1)
+MEMORY = bool(os.environ.get("MEMORY"))
+# Number of the last maps stacked in the observations (FRAMES=4)
+FRAMES = int(os.environ.get("FRAMES") or 1)
+# Weights of the reward terms, 0 turning one off (REWARD_WEIGHTS="danger=0,distance=0.5")
+REWARD_WEIGHTS = parse_weights(os.environ.get("REWARD_WEIGHTS"))
+# Add the free area and food distance of each move to the observations (REACHABILITY=1)
+REACHABILITY = bool(os.environ.get("REACHABILITY"))
+# Seconds before the next server tick by which a key must be sent, a fallback
+# key going out if the policy is late (TICK_MARGIN=0.02)
+TICK_MARGIN = float(os.environ.get("TICK_MARGIN") or 0.02)
+
+DIRECTIONS = ["w", "s", "a", "d"]  # up, down, left, right
 
 async def play_single_episode(
-    websocket, agent_name,
-    game, train_env, agent,
-    episode_num, total_steps, logger
+    session, train_env, agent,
+    episode_num, total_steps, logger, dataset=None, executor=None
 ):
-    """Play a single episode and return updated total_steps and episode_reward."""
+    """
+    Play a single episode and return updated total_steps and episode_reward.
+
+    The episode is a new game of `session`, over the connection of the
+    previous episodes when it is still open.
+
+    The steps are pipelined: the listener decodes the states as they arrive,
+    the policy runs in `executor`, and if it is not done TICK_MARGIN seconds
+    before the next server tick a safe fallback key is sent instead, so the
+    server never reuses a stale key. The agents are not thread safe, so a late
+    inference is waited for before the agent is used again.
+    """
     
     episode_start_time = time.time()
     print("\n")
     # logger.info(f"Starting Episode {episode_num}")
     
-    # Reset game state for new episode
-    game.reset()
-
-    # Start listening for messages
-    await game.start_listener(websocket)
-
-    # Join the game
-    await websocket.send(json.dumps({"cmd": "join", "name": agent_name}))
-    logger.debug("Sent join command to server")
-
-    # Wait for first state
-    if not await game.wait_for_first_state():
+    # Ask for a new game, its info being the first state
+    game = session.game
+    if not await session.next_game():
         logger.error(f"Failed to receive first state for episode {episode_num}, skipping episode")
-        await game.stop_listener()
-        return total_steps, 0, False
+        return total_steps, 0, False, 0
 
     logger.info(f"Episode {episode_num} started successfully")
     
     time_step = train_env.call_reset(game.get_first_state())
+    if dataset is not None:
+        dataset.begin_episode(time_step)
     episode_reward = 0
     episode_steps = 0
     episode_score = 0
+
+    tick = 1.0 / (game.get_first_state().get("fps") or 10)
+    received_at = game.first_state_at
+    loop = asyncio.get_running_loop()
+    latency = {name: LatencyHistogram(name) for name in ("observe", "inference", "store", "react")}
+    game.decode_latency.reset()
+    fallbacks = 0
+    inference = None
+    pending = None  # inference that missed its deadline and may still run
+    previous = None  # time step and action of the transition waiting to be stored
+    game_over = False
+
+    def timed_inference(observed):
+        started = time.perf_counter()
+        action = agent.get_action(observed)
+        latency["inference"].record(time.perf_counter() - started)
+        return action
     
     try:
-        while not time_step.is_last():
-            # Get action from agent
-            action = agent.get_action(time_step)
+        while True:
+            done = game_over or time_step.is_last()
+
+            # A late inference ends before the agent stores the last transition
+            if pending is not None:
+                await asyncio.gather(pending, return_exceptions=True)
+                pending = None
+            if previous is not None:
+                started = time.perf_counter()
+                agent.store_experience(previous[0], previous[1], time_step)
+                if dataset is not None:
+                    dataset.add(previous[1], time_step)
+                latency["store"].record(time.perf_counter() - started)
+            if done:
+                break
+
+            # The first step has no deadline, the networks may still be built then
+            action = None
+            inference = loop.run_in_executor(executor, timed_inference, time_step)
+            timeout = None if previous is None else max(0.0, received_at + tick - TICK_MARGIN - time.perf_counter())
+            try:
+                action = await asyncio.wait_for(asyncio.shield(inference), timeout)
+            except asyncio.TimeoutError:
+                pending = inference  # its action will be too late, it is dropped
+            if action is None:
+                action = train_env.safe_action(previous[1] if previous is not None else None)
+                fallbacks += 1
             
             # Send action to server
-            directions = ["w", "s", "a", "d"]  # up, down, left, right
-            key = directions[action]
+            key = DIRECTIONS[action]
             
             if episode_steps % 50 == 0:  # Log every 50 steps to reduce noise
                 logger.debug(f"Episode {episode_num}, Step {episode_steps}, Action: {key}")
             
             try:
-                await websocket.send(json.dumps({"cmd": "key", "key": key}))
+                await session.send_key(key)
             except websockets.exceptions.ConnectionClosed:
                 logger.warning(f"Connection closed while sending action in episode {episode_num}")
                 break
+            latency["react"].record(time.perf_counter() - received_at)
+            previous = (time_step, action)
             
             # Get next state
             try:
-                current_state = await game.get_state()
+                current_state, received_at = await game.get_timed_state()
 
                 # Also check if this is an incomplete state (missing essential fields)
                 if not is_valid_game_state(current_state):
                     # logger.debug(f"Episode {episode_num} - Skipping incomplete state: {current_state}")
                     # Get the next state (should be the highscores message)
                     try:
-                        current_state = await game.get_state()
+                        current_state, received_at = await game.get_timed_state()
                     except ConnectionError:
                         logger.warning(f"Connection lost while waiting for final message in episode {episode_num}")
                         break
@@ -96,13 +165,11 @@ async def play_single_episode(
                 logger.warning(f"Connection lost during episode {episode_num}")
                 break
 
-            next_time_step = train_env.call_step(current_state, action)
-            
-            # Store experience and train
-            agent.store_experience(time_step, action, next_time_step)
+            started = time.perf_counter()
+            time_step = train_env.call_step(current_state, action)
+            latency["observe"].record(time.perf_counter() - started)
             
-            # Update for next iteration
-            time_step = next_time_step
+            # Update for next iteration, the transition is stored with the next inference
             episode_reward += time_step.reward
             episode_steps += 1
             total_steps += 1
@@ -110,7 +177,7 @@ async def play_single_episode(
             # Check if game ended
             if current_state.get('highscores') is not None:
                 logger.info(f"Episode {episode_num} - Game Over! Final score: {episode_score}")
-                break
+                game_over = True
             
     except websockets.exceptions.ConnectionClosed:
         logger.warning(f"WebSocket connection closed during episode {episode_num}")
@@ -119,8 +186,19 @@ async def play_single_episode(
         import traceback
         logger.error(traceback.format_exc())
     finally:
-        # Always stop the listener
-        await game.stop_listener()
+        # Nothing may run in the executor once the agent trains or the next episode starts
+        running = [future for future in (inference, pending) if future is not None and not future.done()]
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
+        # Without its game over the connection may still carry this game, start over
+        if not game_over:
+            await session.close()
+
+    logger.info(f"Episode {episode_num} latencies, {fallbacks} fallback keys:")
+    for histogram in (game.decode_latency, *latency.values()):
+        logger.info(f"  {histogram.summary()}")
+    logger.info(f"Episode {episode_num} reward terms: {train_env.rewards.stats.format()}")
+    train_env.rewards.stats.reset()
     
     # Perform training step periodically
     if episode_num % 4 == 0:
@@ -140,6 +218,8 @@ async def play_single_episode(
 async def agent_loop(server_address="localhost:8000", agent_name="student",
                      episode_limit=100, policy_train=None, agent_type="dqn"):
     """Example client loop with proper RL integration and logging."""
+    from snake_train_env import SnakeTrainEnv
+    from dataset_builder import DatasetWriter, ShardDataset
    
     logger = setup_logging()
     logger.info("Starting training mode...")
@@ -148,18 +228,22 @@ async def agent_loop(server_address="localhost:8000", agent_name="student",
     if policy_train:
         logger.info(f"Pre-trained policy will be loaded: {policy_train}")
     
-    game = SnakeGame(logger)
+    # One connection and listener for every episode
+    session = PlayerSession(server_address, agent_name, SnakeGame(logger))
 
     # Initialize environment with initial state
-    train_env = SnakeTrainEnv()
+    train_env = SnakeTrainEnv(
+        crop_size=CROP_SIZE, memory=MEMORY, frames=FRAMES, reward_weights=REWARD_WEIGHTS, reachability=REACHABILITY
+    )
     logger.info("Environment initialized")
 
     # Initialize agent
-    if agent_type not in AGENTS:
-        logger.error(f"Unknown agent type: {agent_type}. Available agents: {list(AGENTS.keys())}")
+    agents = load_agents()
+    if agent_type not in agents:
+        logger.error(f"Unknown agent type: {agent_type}. Available agents: {list(agents.keys())}")
         return
     
-    agent = AGENTS[agent_type](train_env)
+    agent = agents[agent_type](train_env)
     logger.info("Agent initialized")
 
     episode = 0
@@ -174,6 +258,15 @@ async def agent_loop(server_address="localhost:8000", agent_name="student",
         except Exception as e:
             logger.error(f"Failed to load pre-trained policy: {e}")
             return
+
+    # Optional offline data: PREFILL=<dataset dir> to start from recorded
+    # transitions, DATASET=<dataset dir> to record this training run
+    if os.environ.get("PREFILL"):
+        stored = agent.prefill(ShardDataset(os.environ["PREFILL"]))
+        logger.info(f"Prefilled {stored} transitions from {os.environ['PREFILL']}")
+    dataset = DatasetWriter(os.environ["DATASET"], options=train_env.observer.options) if os.environ.get("DATASET") else None
+    # one thread for the policy, so the event loop can send a fallback key while it runs
+    executor = ThreadPoolExecutor(max_workers=1)
     
     total_steps = 0
     episode_rewards = []
@@ -182,50 +275,47 @@ async def agent_loop(server_address="localhost:8000", agent_name="student",
     
     while episode < episode_limit:
         try:
-            # Create new WebSocket connection for each episode
-            logger.debug(f"Creating WebSocket connection for episode {episode + 1}")
-            async with websockets.connect(f"ws://{server_address}/player") as websocket:
-                episode += 1
-                total_steps, episode_reward, success, episode_score = await play_single_episode(
-                    websocket, agent_name, game,
-                    train_env, agent, episode,
-                    total_steps, logger
-                )
-                
-                if not success:
-                    episode -= 1  # Don't count failed episodes
-                    logger.warning(f"Episode {episode + 1} failed, retrying...")
-                    continue
-                
-                episode_rewards.append(episode_reward)
-                episode_scores.append(episode_score)
-                
-                # Print training stats periodically
-                # if episode % 10 == 0:
-                #     stats = agent.get_training_stats()
-                #     avg_reward_last_10 = sum(episode_rewards[-10:]) / min(10, len(episode_rewards))
-                #     logger.info(f"Training Stats after {episode} episodes:")
-                #     logger.info(f"  Average reward (last 10): {avg_reward_last_10:.2f}")
-                #     for key, value in stats.items():
-                #         logger.info(f"  {key}: {value}")
-                
-                # Save model periodically
-                if episode % 1000 == 0:
-                    model_path = f"policy/backups/{agent_type}_agent_episode_{episode}"
-                    agent.save(model_path)
-                    logger.info(f"Model saved: {model_path}")
+            episode += 1
+            total_steps, episode_reward, success, episode_score = await play_single_episode(
+                session, train_env, agent, episode,
+                total_steps, logger, dataset, executor
+            )
+            
+            if not success:
+                episode -= 1  # Don't count failed episodes
+                logger.warning(f"Episode {episode + 1} failed, retrying...")
+                await asyncio.sleep(1.0)  # the server may be starting or restarting
+                continue
+            
+            episode_rewards.append(episode_reward)
+            episode_scores.append(episode_score)
+            
+            # Print training stats periodically
+            # if episode % 10 == 0:
+            #     stats = agent.get_training_stats()
+            #     avg_reward_last_10 = sum(episode_rewards[-10:]) / min(10, len(episode_rewards))
+            #     logger.info(f"Training Stats after {episode} episodes:")
+            #     logger.info(f"  Average reward (last 10): {avg_reward_last_10:.2f}")
+            #     for key, value in stats.items():
+            #         logger.info(f"  {key}: {value}")
+            
+            # Save model periodically
+            if episode % 1000 == 0:
+                model_path = f"policy/backups/{agent_type}_agent_episode_{episode}"
+                agent.save(model_path)
+                logger.info(f"Model saved: {model_path}")
+            
+            # Progress report every 25 episodes
+            # if episode % 25 == 0:
+            #     elapsed_time = time.time() - training_start_time
+            #     avg_time_per_episode = elapsed_time / episode
+            #     remaining_episodes = episode_limit - episode
+            #     estimated_remaining_time = avg_time_per_episode * remaining_episodes
                 
-                # Progress report every 25 episodes
-                # if episode % 25 == 0:
-                #     elapsed_time = time.time() - training_start_time
-                #     avg_time_per_episode = elapsed_time / episode
-                #     remaining_episodes = episode_limit - episode
-                #     estimated_remaining_time = avg_time_per_episode * remaining_episodes
-                    
-                #     logger.info(f"Progress Report - Episode {episode}/{episode_limit}")
-                #     logger.info(f"  Elapsed time: {elapsed_time/60:.1f} minutes")
-                #     logger.info(f"  Estimated remaining time: {estimated_remaining_time/60:.1f} minutes")
-                #     logger.info(f"  Average episode duration: {avg_time_per_episode:.2f} seconds")
+            #     logger.info(f"Progress Report - Episode {episode}/{episode_limit}")
+            #     logger.info(f"  Elapsed time: {elapsed_time/60:.1f} minutes")
+            #     logger.info(f"  Estimated remaining time: {estimated_remaining_time/60:.1f} minutes")
+            #     logger.info(f"  Average episode duration: {avg_time_per_episode:.2f} seconds")
 
         except Exception as e:
             logger.error(f"Error in episode {episode}: {e}")
@@ -233,6 +323,12 @@ async def agent_loop(server_address="localhost:8000", agent_name="student",
             logger.error(traceback.format_exc())
             continue
             
+    await session.close()
+    logger.info(f"Played over {session.connections} connection(s)")
+    if dataset is not None:
+        dataset.close()
+    executor.shutdown()
+
     total_training_time = time.time() - training_start_time
     logger.info(f"Training completed! Total time: {total_training_time/60:.1f} minutes")
     logger.info(f"Reached episode limit of {episode_limit}")
@@ -257,17 +353,24 @@ async def run_policy(server_address="localhost:8000", agent_name="student",
                      model_path='dqn_agent_final', agent_type="dqn"):
     """Load a trained model and use it to play the game WITHOUT training infrastructure."""
     logger = setup_logging(log_file=f'logs/snake_inference_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log')
+    if model_path.endswith(".npz"):
+        # policy exported with policy_export.py, run with NumPy alone
+        await play_exported(server_address, agent_name, model_path)
+        return
+    from snake_train_env import SnakeTrainEnv
+
     logger.info(f"Loading trained model from {model_path}...")
     
     # Initialize minimal environment just for specs (no training logic)
-    dummy_env = SnakeTrainEnv()
+    dummy_env = SnakeTrainEnv(crop_size=CROP_SIZE, memory=MEMORY, frames=FRAMES, reachability=REACHABILITY)
 
     # Load Agent and weights
-    if agent_type not in AGENTS:
-        logger.error(f"Unknown agent type: {agent_type}. Available agents: {list(AGENTS.keys())}")
+    agents = load_agents()
+    if agent_type not in agents:
+        logger.error(f"Unknown agent type: {agent_type}. Available agents: {list(agents.keys())}")
         return
     
-    agent = AGENTS[agent_type](dummy_env)
+    agent = agents[agent_type](dummy_env)
     
     # Load ONLY the policy
     try:
@@ -283,7 +386,7 @@ async def run_policy(server_address="localhost:8000", agent_name="student",
             await game.start_listener(websocket)
             
             # Join the game
-            await websocket.send(json.dumps({"cmd": "join", "name": agent_name}))
+            await websocket.send(json.dumps({"cmd": "join", "name": agent_name, "protocol": PROTOCOL_BINARY}))
             logger.info("Trained agent joined the game!")
 
             if not await game.wait_for_first_state():
@@ -303,7 +406,7 @@ async def run_policy(server_address="localhost:8000", agent_name="student",
                 action = agent.get_action(time_step, False)
                 
                 # Map action to key
-                key = ["w", "s", "a", "d"][action]
+                key = DIRECTIONS[action]
                 await websocket.send(json.dumps({"cmd": "key", "key": key}))
                 
                 if steps % 50 == 0:  # Log every 50 steps
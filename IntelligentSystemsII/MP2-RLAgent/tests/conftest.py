@@ -0,0 +1,8 @@
+"""
+The modules of the project are imported from its directory, as the scripts run.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,109 @@
+"""
+BatchedGame against game.Game: the same moves from the same states give the same games.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import logging
+import random
+
+import numpy as np
+import pytest
+
+from batched_game import BatchedGame
+from consts import Tiles
+from game import Game
+from policy_runtime import KEYS
+from protocol import player_state
+
+NAME = "student"
+MOVES = ((0, -1), (0, 1), (-1, 0), (1, 0))  # (dx, dy) of the actions
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def pick_action(game, rng):
+    """A random action, mostly towards the nearest food without running into the body, for long games."""
+    snake = game.snakes[NAME]
+    x, y = snake.head
+    width, height = game.map.size
+    safe = [
+        action for action, (dx, dy) in enumerate(MOVES)
+        if ((x + dx) % width, (y + dy) % height) not in snake.body
+    ]
+    if not safe or rng.random() < 0.02:
+        return rng.randrange(4)
+    food = [(fx, fy) for fx, fy, _ in game.map.food]
+    if food and rng.random() < 0.8:
+        def distance(action):
+            dx, dy = MOVES[action]
+            return min(abs(x + dx - fx) + abs(y + dy - fy) for fx, fy in food)
+        return min(safe, key=distance)
+    return rng.choice(safe)
+
+
+def shuffle_effects(snake, rng):
+    """Superfood effects are rare in short games, so set them at random in the Game instead."""
+    if rng.random() < 0.05:
+        snake._traverse = not snake._traverse
+    if rng.random() < 0.05:
+        snake.grow(rng.randint(-3, 2))
+    if rng.random() < 0.05:
+        snake.range = rng.randint(2, 6)
+
+
+def assert_same_state(batched, game, state):
+    snake = game.snakes[NAME]
+    expected = player_state(state, NAME)
+    actual = batched.player_state(0, NAME)
+    assert actual["body"] == [list(cell) for cell in expected["body"]]
+    for key in ("step", "score", "range", "traverse"):
+        assert actual[key] == expected[key], key
+    sight = expected["sight"]
+    assert (actual["sight"]["x"], actual["sight"]["y"]) == (sight["x"], sight["y"])
+    np.testing.assert_array_equal(actual["sight"]["tiles"], np.asarray(sight["tiles"]))
+    assert batched._to_grow[0] == snake.to_grow
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rules_match_game(seed):
+    """
+    Every step, load the state of a Game into a BatchedGame and play the same
+    action in both. Where the food spawns and what a superfood does are random
+    draws, so on those steps only the moves are compared, and the next step
+    starts again from the Game.
+    """
+    rng = random.Random(seed)
+    game = Game(rng=random.Random(seed), compact_sight=True, timeout=200)
+    game.start([NAME])
+    batched = BatchedGame(1, timeout=200, seed=seed)
+    batched.reset()
+    while game.running:
+        snake = game.snakes[NAME]
+        shuffle_effects(snake, rng)
+        batched.load(0, game.snapshot())
+        action = pick_action(game, rng)
+        tiles = np.array(game.map.map)
+
+        game.keypress(NAME, KEYS[action])
+        state = game.update()
+        _, reward, done = batched.step([action])
+
+        assert bool(batched.alive[0]) == snake.alive
+        assert bool(done[0]) == (not game.running)
+        if not snake.alive:
+            break
+        eaten = tiles[snake.head]
+        if eaten == Tiles.SUPER:
+            assert batched.player_state(0, NAME)["body"] == [list(cell) for cell in state["snakes"][0]["body"]]
+            continue
+        assert reward[0] == (1.0 if eaten == Tiles.FOOD else 0.0)
+        if eaten != Tiles.FOOD and state["step"] % 100:
+            # no food spawned, so the whole state is the same
+            assert_same_state(batched, game, state)
+        # the sight of the state the Game is in, wherever the food spawned
+        batched.load(0, game.snapshot())
+        assert_same_state(batched, game, state)
+
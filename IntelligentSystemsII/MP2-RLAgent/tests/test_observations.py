@@ -0,0 +1,53 @@
+"""
+Observer.tiles over every layout of the observation map.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import json
+import logging
+import random
+
+import numpy as np
+import pytest
+
+from consts import Tiles
+from game import Game
+from observations import HEAD, Observer
+from policy_runtime import KEYS
+from protocol import player_state
+
+NAME = "student"
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+@pytest.mark.parametrize("memory", [False, True])
+@pytest.mark.parametrize("crop_size", [None, 7])
+def test_tiles_are_the_newest_frame(crop_size, memory):
+    rng = random.Random(0)
+    game = Game(rng=random.Random(0), compact_sight=True, timeout=100)
+    game.start([NAME])
+    game.snakes[NAME].grow(5)
+    single = Observer(game.map.size, 100, crop_size, memory)
+    stacked = Observer(game.map.size, 100, crop_size, memory, frames=3)
+    info = json.loads(json.dumps(game.info()))
+    single.reset(info)
+    stacked.reset(info)
+
+    while game.running and game.snakes[NAME].alive:
+        game.keypress(NAME, KEYS[rng.randrange(4)] if rng.random() < 0.2 else "")
+        state = json.loads(json.dumps(player_state(game.update(), NAME)))
+        if "body" not in state:
+            break
+        tiles = single.tiles(single.step(state, None)["map"])
+
+        np.testing.assert_array_equal(stacked.tiles(stacked.step(state, None)["map"]), tiles)
+        if crop_size is None:
+            assert tiles.shape == game.map.size
+        else:
+            assert tiles.shape == (crop_size, crop_size)
+            assert tiles[crop_size // 2, crop_size // 2] == HEAD
+            assert ((tiles >= -1) & (tiles <= Tiles.SNAKE)).all()
@@ -0,0 +1,26 @@
+"""
+NumPy layers of policy_runtime.py against direct definitions.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import numpy as np
+import pytest
+
+from policy_runtime import max_pool
+
+
+@pytest.mark.parametrize("pool_size", [(2, 2), (3, 3), (3, 2), (4, 3)])
+@pytest.mark.parametrize("shape", [(7, 7), (8, 5), (24, 48), (13, 13)])
+def test_max_pool_same_padding(shape, pool_size):
+    """Windows start where TensorFlow puts them: half the padding before the input, half after."""
+    x = np.random.default_rng(0).normal(size=(2, *shape, 3))
+    y = max_pool(x, {}, {"pool_size": list(pool_size), "padding": "same"})
+
+    starts = []
+    for size, pool in zip(shape, pool_size):
+        before = (-size % pool) // 2
+        starts.append(range(-before, size, pool))
+    assert y.shape[1:3] == tuple(len(s) for s in starts)
+    for i, row in enumerate(starts[0]):
+        for j, column in enumerate(starts[1]):
+            window = x[:, max(row, 0):row + pool_size[0], max(column, 0):column + pool_size[1]]
+            np.testing.assert_array_equal(y[:, i, j], window.max(axis=(1, 2)))
@@ -0,0 +1,56 @@
+"""
+Binary frames against JSON: decoding a frame gives back the state it was packed from.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import json
+import logging
+import random
+
+import numpy as np
+import pytest
+
+from game import Game
+from observations import sight_cells
+from policy_runtime import KEYS
+from protocol import decode_state, encode_state, player_state
+
+NAMES = ["student", "other"]
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+def cells(sight, size):
+    xs, ys, tiles = sight_cells(sight, *size)
+    return sorted(zip(xs.tolist(), ys.tolist(), tiles.tolist()))
+
+
+@pytest.mark.parametrize("compact", [True, False])
+@pytest.mark.parametrize("size", [(48, 24), (300, 24)])
+@pytest.mark.parametrize("seed", range(3))
+def test_frames_round_trip(seed, size, compact):
+    """Over random games, also on maps wider than 255 cells and with bodies wrapping around the edges."""
+    rng = random.Random(seed)
+    game = Game(rng=random.Random(seed), size=size, compact_sight=compact, timeout=150)
+    game.start(NAMES)
+    snake = game.snakes[NAMES[0]]
+    snake.grow(20)
+    while game.running and snake.alive:
+        if rng.random() < 0.05:
+            snake.range = rng.randint(2, 6)
+        for name in NAMES:
+            game.keypress(name, KEYS[rng.randrange(4)] if rng.random() < 0.2 else "")
+        state = game.update()
+        message = dict(player_state(state, NAMES[0]), ts=game.now().isoformat())
+        expected = json.loads(json.dumps(message))
+
+        actual = decode_state(encode_state(message, size))
+
+        for key in ("players", "step", "timeout", "name", "score", "range", "traverse"):
+            assert actual.get(key) == expected.get(key), key
+        if "body" in expected:
+            np.testing.assert_array_equal(actual["body"], np.array(expected["body"]).reshape(-1, 2))
+            assert cells(actual["sight"], size) == cells(expected["sight"], size)
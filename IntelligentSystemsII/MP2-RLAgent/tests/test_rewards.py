@@ -0,0 +1,230 @@
+"""
+RewardEngine against the per-step reward SnakeTrainEnv computed before it.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import json
+import logging
+import random
+
+import numpy as np
+import pytest
+
+from game import Game
+from observations import Observer
+from policy_runtime import KEYS
+from protocol import player_state
+from rewards import NO_ACTION, RewardEngine
+
+NAME = "student"
+MOVES = ((0, -1), (0, 1), (-1, 0), (1, 0))  # (dx, dy) of the actions
+DIRECTION_ACTIONS = (0, 3, 1, 2)  # action of each Direction, north, east, south, west
+
+
+@pytest.fixture(autouse=True)
+def quiet():
+    for name in ("Game", "Map"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
+class OldReward:
+    """
+    The reward methods of SnakeTrainEnv before RewardEngine, as they were, on
+    the state and ObservationBuilder of the environment. One change: the food
+    is the nearest one, not the first of a row-major scan, as RewardEngine
+    measures the distance to the nearest food on purpose.
+    """
+
+    def __init__(self, builder, size, info):
+        self._builder = builder
+        self._grid_sizeY, self._grid_sizeX = size
+        self._state = info
+        self._action = None
+        self._last_score = 0
+        self._previous_distance = None
+        self._steps_without_food = 0
+        self._visited_positions = set()
+
+        fruit_pos = self._find_fruit_position([0, 0])
+        if fruit_pos is not None:
+            snake_body = self._state.get('body', [[0, 0]])
+            if snake_body and len(snake_body) > 0:
+                snake_head = snake_body[0]
+                head_x, head_y = snake_head[1], snake_head[0]  # Convert to x, y
+                fruit_x, fruit_y = fruit_pos[0], fruit_pos[1]
+                self._previous_distance = abs(head_x - fruit_x) + abs(head_y - fruit_y)
+
+    def step(self, state, action):
+        self._state = state
+        self._action = action
+        return self._calculate_reward()
+
+    def _calculate_reward(self):
+        game_over_penalty = -100.0 if self._state.get("highscores") is not None else 0.0
+        if game_over_penalty != 0:
+            return game_over_penalty
+
+        reward = self._calculate_food_reward()
+        reward += 0.5
+        reward += self._calculate_distance_reward_fixed()
+        reward += self._calculate_smart_danger_penalty()
+        reward += self._calculate_gentle_efficiency_penalty()
+        reward += self._calculate_exploration_bonus()
+        return float(max(-50, min(reward, 150)))
+
+    def _calculate_food_reward(self):
+        current_score = self._state.get('score', 0)
+        score_diff = current_score - self._last_score
+        self._last_score = current_score
+        if score_diff > 0:
+            snake_body = self._state.get('body', [])
+            snake_length = len(snake_body) if snake_body else 1
+            self._steps_without_food = 0
+            return 50.0 + min(snake_length * 0.5, 10.0)
+        return 0.0
+
+    def _calculate_distance_reward_fixed(self):
+        snake_body = self._state.get('body', [])
+        if not snake_body:
+            return 0.0
+        snake_head = snake_body[0]
+        fruit_pos = self._find_fruit_position(snake_head)
+        if fruit_pos is None:
+            return 0.0
+
+        head_y, head_x = snake_head[0], snake_head[1]
+        fruit_y, fruit_x = fruit_pos[1], fruit_pos[0]
+        current_distance = abs(head_x - fruit_x) + abs(head_y - fruit_y)
+
+        distance_reward = 0.0
+        if self._previous_distance is not None:
+            distance_change = self._previous_distance - current_distance
+            if distance_change > 0:
+                distance_reward = 0.1 * distance_change
+            elif distance_change < 0:
+                distance_reward = 0.02 * distance_change
+        self._previous_distance = current_distance
+        return distance_reward
+
+    def _calculate_smart_danger_penalty(self):
+        if self._action is None:
+            return 0.0
+        snake_body = self._state.get('body', [])
+        if not snake_body:
+            return 0.0
+        next_pos = self._get_next_position(snake_body[0], self._action)
+        return -8.0 if self._is_position_deadly(next_pos) else 0.0
+
+    def _calculate_gentle_efficiency_penalty(self):
+        self._steps_without_food += 1
+        if self._steps_without_food > 200:
+            excess_steps = self._steps_without_food - 200
+            return max(-0.01 * excess_steps * 0.1, -2.0)
+        return 0.0
+
+    def _find_fruit_position(self, head):
+        cells = self._builder.food_cells  # [row, column], the row being the x of the game
+        if not len(cells):
+            return None
+        row, column = cells[np.abs(cells - head[:2]).sum(axis=1).argmin()]
+        return [column, row]  # as ObservationBuilder.food
+
+    def _get_next_position(self, current_pos, action):
+        head_y, head_x = current_pos[0], current_pos[1]
+        return [
+            [head_y - 1, head_x], [head_y + 1, head_x], [head_y, head_x - 1], [head_y, head_x + 1]
+        ][action]
+
+    def _is_position_deadly(self, pos):
+        y, x = pos
+        if not self._state.get('traverse', False):
+            if y < 0 or y >= self._grid_sizeY or x < 0 or x >= self._grid_sizeX:
+                return True
+        else:
+            y = y % self._grid_sizeY
+            x = x % self._grid_sizeX
+        return bool(self._builder.danger[y, x])
+
+    def _calculate_exploration_bonus(self):
+        snake_body = self._state.get('body', [])
+        if not snake_body:
+            return 0.0
+        head_pos = tuple(snake_body[0])
+        if head_pos not in self._visited_positions:
+            self._visited_positions.add(head_pos)
+            return 0.1
+        return 0.0
+
+
+def new_reward(engine, builder, state, action):
+    """The reward as SnakeTrainEnv._calculate_reward asks RewardEngine for it."""
+    snake_body = state.get('body', [])
+    return float(engine.rewards(
+        scores=[state.get('score', 0)],
+        lengths=[max(len(snake_body), 1)],
+        heads=[snake_body[0][:2] if len(snake_body) else [0, 0]],
+        has_body=[len(snake_body) > 0],
+        actions=[action if action is not None else NO_ACTION],
+        foods=[builder.food_cells],
+        danger=builder.danger[None],
+        traverse=[bool(state.get('traverse', False))],
+        game_over=[state.get("highscores") is not None],
+    )[0])
+
+
+def pick_action(game, rng):
+    """
+    Mostly a move that does not run into the body or a stone: going on, no
+    action, towards the nearest food or at random. Rarely any move.
+    """
+    snake = game.snakes[NAME]
+    x, y = snake.head
+    width, height = game.map.size
+
+    def cell(action):
+        dx, dy = MOVES[action]
+        return ((x + dx) % width, (y + dy) % height) if snake._traverse else (x + dx, y + dy)
+
+    safe = [
+        action for action in range(4)
+        if cell(action) not in snake.body and not game.map.is_blocked(cell(action), snake._traverse)
+    ]
+    if not safe or rng.random() < 0.01:
+        return rng.randrange(4)
+    ahead = DIRECTION_ACTIONS[snake.direction]
+    if ahead in safe and rng.random() < 0.7:
+        return None if rng.random() < 0.2 else ahead
+    food = [(fx, fy) for fx, fy, _ in game.map.food]
+    if food and rng.random() < 0.2:
+        return min(safe, key=lambda action: min(abs(cell(action)[0] - fx) + abs(cell(action)[1] - fy) for fx, fy in food))
+    return rng.choice(safe)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_rewards_match_old_env(seed):
+    rng = random.Random(seed)
+    game = Game(rng=random.Random(seed), compact_sight=True, timeout=600)
+    game.start([NAME])
+    snake = game.snakes[NAME]
+    snake.grow(10)
+    observer = Observer(game.map.size, 600)
+    info = json.loads(json.dumps(game.info()))
+    observer.reset(info)
+    engine = RewardEngine(1, observer.builder.shape)
+    engine.reset(heads=np.array([info.get('body', [[0, 0]])[0][:2]]), foods=[observer.builder.food_cells])
+    old = OldReward(observer.builder, game.map.size, info)
+
+    while True:
+        if rng.random() < 0.02:
+            snake._traverse = not snake._traverse
+        action = pick_action(game, rng)
+        game.keypress(NAME, KEYS[action] if action is not None else "")
+        state = game.update()
+        if snake.alive and game.running:
+            state = json.loads(json.dumps(player_state(state, NAME)))
+            observer.step(state, action)
+        else:
+            state = {"highscores": []}
+
+        assert new_reward(engine, observer.builder, state, action) == pytest.approx(old.step(state, action))
+        if "highscores" in state:
+            break
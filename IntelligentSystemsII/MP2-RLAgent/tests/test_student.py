@@ -0,0 +1,95 @@
+"""
+run_policy over a stub server connection, with a stub environment and policy.
+Authors: [David Palricas, Daniel Emídio, Marcio Tavares]
+"""
+import asyncio
+import json
+import sys
+import types
+
+import student
+
+STEPS = 5
+
+
+class StubWebSocket:
+    """Sends the game info, then one state per key received and a game over."""
+
+    def __init__(self):
+        self.sent = []
+        self.keys = asyncio.Queue()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def send(self, message):
+        self.sent.append(json.loads(message))
+        if self.sent[-1]["cmd"] == "key":
+            await self.keys.put(self.sent[-1]["key"])
+
+    async def __aiter__(self):
+        yield json.dumps({"size": [48, 24], "map": [], "fps": 10, "timeout": 100, "level": 1})
+        for step in range(1, STEPS + 1):
+            await self.keys.get()
+            yield json.dumps({"body": [[step, 1], [step - 1, 1]], "score": 0, "step": step, "sight": {}})
+        await self.keys.get()
+        yield json.dumps({"highscores": []})
+
+
+class StubEnv:
+    """The calls run_policy makes to SnakeTrainEnv."""
+
+    def __init__(self, **options):
+        self.states = []
+
+    def call_reset(self, state):
+        self.states.append(state)
+        return len(self.states)
+
+    def call_step(self, state, action):
+        self.states.append(state)
+        return len(self.states)
+
+    def render(self, mode="human"):
+        pass
+
+
+class StubAgent:
+    """Goes through the actions in turn."""
+
+    def __init__(self, env):
+        self.env = env
+        self.time_steps = []
+
+    def load(self, path):
+        pass
+
+    def get_action(self, time_step, explore):
+        self.time_steps.append(time_step)
+        return len(self.time_steps) % 4
+
+
+def test_run_policy_sends_one_key_per_state(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)  # for the log file
+    websocket = StubWebSocket()
+    agents = []
+
+    def make_agent(env):
+        agents.append(StubAgent(env))
+        return agents[-1]
+
+    monkeypatch.setattr(student.websockets, "connect", lambda url: websocket)
+    monkeypatch.setitem(sys.modules, "snake_train_env", types.SimpleNamespace(SnakeTrainEnv=StubEnv))
+    monkeypatch.setattr(student, "load_agents", lambda: {"stub": make_agent})
+
+    asyncio.run(student.run_policy(agent_name="tester", model_path="policy/stub", agent_type="stub"))
+
+    assert websocket.sent[0] == {"cmd": "join", "name": "tester", "protocol": student.PROTOCOL_BINARY}
+    keys = [message["key"] for message in websocket.sent[1:]]
+    assert keys == [student.DIRECTIONS[step % 4] for step in range(1, STEPS + 2)]
+    (agent,) = agents
+    assert agent.time_steps == list(range(1, STEPS + 2))
+    assert len(agent.env.states) == STEPS + 1
@@ -4,9 +4,10 @@ import json
 import logging
 import os
 import sys
-import pprint
 
 from consts import Tiles
+from protocol import apply_viewer_delta
+from replay import ReplayReader
 import pygame
 import websockets
 
@@ -72,13 +73,19 @@ async def main(SCALE):
     prev_foods = None
 
     step_info = Info(text="0")
+    state = None
 
     while True:
         should_quit()
 
         try:
-            state = json.loads(q.get_nowait())
-            pprint.pprint(state)
+            message = json.loads(q.get_nowait())
+            if "delta" in message:
+                if state is None or "snakes" not in state:
+                    continue  # wait for the keyframe
+                state = apply_viewer_delta(state, message["delta"])
+            else:
+                state = message
 
             if "snakes" in state and "food" in state:
                 snakes_update = state["snakes"]
@@ -198,15 +205,30 @@ async def main(SCALE):
         pygame.display.flip()
 
 
-async def messages_handler(ws_path, queue):
+async def messages_handler(ws_path, queue, delta=True):
     async with websockets.connect(ws_path) as websocket:
-        await websocket.send(json.dumps({"cmd": "join"}))
+        await websocket.send(json.dumps({"cmd": "join", "delta": delta}))
 
         while True:
             r = await websocket.recv()
             queue.put_nowait(r)
 
 
+async def replay_handler(path, queue, step=0):
+    """Feed the viewer from a replay file instead of a server."""
+    reader = ReplayReader(path)
+    game = reader.game(step)
+    queue.put_nowait(json.dumps(game.info()))
+
+    for state in reader.states(game._step):
+        queue.put_nowait(json.dumps(state))
+        await asyncio.sleep(1 / reader.header["fps"])
+
+    if result := reader.result:
+        scores = sorted(result["scores"].items(), key=lambda s: s[1], reverse=True)
+        queue.put_nowait(json.dumps({"highscores": scores}))
+
+
 if __name__ == "__main__":
     SERVER = os.environ.get("SERVER", "localhost")
     PORT = os.environ.get("PORT", "8000")
@@ -217,6 +239,16 @@ if __name__ == "__main__":
         "--scale", help="reduce size of window by x times", type=int, default=1
     )
     parser.add_argument("--port", help="TCP port", type=int, default=PORT)
+    parser.add_argument("--room", help="Room to watch", type=int, default=0)
+    parser.add_argument(
+        "--full-state",
+        help="Receive the full state every step instead of deltas",
+        action="store_true",
+    )
+    parser.add_argument("--replay", help="Watch a replay file instead of a server")
+    parser.add_argument(
+        "--step", help="Step to start the replay from", type=int, default=0
+    )
     args = parser.parse_args()
     SCALE = 32 * (1 / args.scale)
 
@@ -225,11 +257,13 @@ if __name__ == "__main__":
     pygame.font.init()
     q: asyncio.Queue = asyncio.Queue()
 
-    ws_path = f"ws://{args.server}:{args.port}/viewer"
+    ws_path = f"ws://{args.server}:{args.port}/viewer/{args.room}"
+    if args.replay:
+        source = replay_handler(args.replay, q, args.step)
+    else:
+        source = messages_handler(ws_path, q, not args.full_state)
 
     try:
-        LOOP.run_until_complete(
-            asyncio.gather(messages_handler(ws_path, q), main_loop(q, SCALE=SCALE))
-        )
+        LOOP.run_until_complete(asyncio.gather(source, main_loop(q, SCALE=SCALE)))
     finally:
         LOOP.stop()